@@ -0,0 +1,375 @@
+"""Сквозной нагрузочный стенд: фейковый IMAP -> бот -> фейковый Bot API.
+
+Генерирует корпус .eml (обычные письма, HTML-рассылки, письма с десятком
+вложений и с огромным вложением), поднимает bench/fake_imap.py и
+bench/fake_bot_api.py и запускает yandex_mail_bot.py отдельным процессом
+с конфигурацией, указывающей на оба сервера. Часть писем лежит в ящике
+до старта (догон очереди), остальные приходят с заданной частотой (IDLE).
+
+    python bench/bench_end_to_end.py [--mails 200] [--backlog 100] [--arrival-rate 20]
+        [--api-latency 0.05] [--api-429-rate 0.02] [--real-limits]
+
+Отчет: писем в секунду, p50/p99 задержки от поступления письма до первого
+сообщения в Telegram и до отметки прочитанным, пиковый RSS процесса бота
+(VmHWM из /proc, по ходу работы) и всех его процессов вместе с пулом изображений.
+Код возврата 1, если не все письма доставлены за --timeout секунд.
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from email.message import EmailMessage
+from email import policy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from fake_bot_api import FakeBotApi
+from fake_imap import FakeImapServer
+
+CORPUS_DIR = os.path.join(ROOT, 'bench', 'html_corpus')
+BENCH_ID_RE = re.compile(r'bench-(\d{6})')
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def make_png(width, height, rng, label):
+    """PNG с шумом (плохо сжимается, как фотография); label делает файл уникальным"""
+    raw = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + png_chunk(b'tEXt', b'Comment\x00' + label.encode('ascii'))
+        + png_chunk(b'IDAT', zlib.compress(raw, 1))
+        + png_chunk(b'IEND', b'')
+    )
+
+def load_newsletters():
+    newsletters = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            newsletters.append(f.read())
+    return newsletters or ['<html><body><p>Рассылка</p></body></html>']
+
+class CorpusGenerator:
+    """Письма четырех видов; номер письма - в теме (bench-000042)"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.newsletters = load_newsletters()
+        width, height = map(int, args.image_size.split('x'))
+        self.image_size = (width, height)
+        self.huge_blob = self.rng.randbytes(args.huge_mb * 1024 * 1024)
+
+    def kind(self, number):
+        if self.args.huge_every and number % self.args.huge_every == 0:
+            return 'huge'
+        return self.rng.choices(('plain', 'html', 'attachments'), weights=(5, 3, 2))[0]
+
+    def message(self, number):
+        kind = self.kind(number)
+        message = EmailMessage()
+        message['From'] = f"Отправитель {number % 17} <sender{number % 17}@example.com>"
+        message['To'] = "bench@example.com"
+        message['Subject'] = f"bench-{number:06d} {kind}"
+        message['Date'] = time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime())
+        message['Message-ID'] = f"<bench-{number}@example.com>"
+
+        text = f"Письмо номер {number}.\n" + "Содержательный текст письма. " * self.rng.randint(5, 60)
+        if kind == 'html':
+            message.set_content(text)
+            message.add_alternative(self.rng.choice(self.newsletters), subtype='html')
+        else:
+            message.set_content(text)
+
+        if kind == 'attachments':
+            for index in range(self.args.images_per_mail):
+                image = make_png(*self.image_size, self.rng, f"bench-{number}-{index}")
+                message.add_attachment(image, maintype='image', subtype='png', filename=f"photo_{index}.png")
+            for index in range(3):
+                document = f"Отчет {number}/{index}\n".encode('utf-8') * self.rng.randint(100, 3000)
+                message.add_attachment(
+                    document, maintype='application', subtype='octet-stream', filename=f"report_{index}.txt"
+                )
+        elif kind == 'huge':
+            message.add_attachment(
+                self.huge_blob + str(number).encode('ascii'),
+                maintype='application', subtype='octet-stream', filename="archive.bin"
+            )
+        return message.as_bytes(policy=policy.SMTP)
+
+    def ensure_corpus(self, directory, count):
+        """Пишет недостающие .eml в directory и возвращает пути по порядку"""
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for number in range(1, count + 1):
+            path = os.path.join(directory, f"{number:06d}.eml")
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(self.message(number))
+            paths.append(path)
+        return paths
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def write_config(work_dir, args, imap, api):
+    config = {
+        'settings': {
+            'interval': 5,
+            'imap_host': '127.0.0.1',
+            'imap_port': imap.port,
+            'imap_ssl': False,
+            'digest_mode': args.digest_mode,
+            'catchup_connections': args.catchup_connections,
+            'catchup_threshold': args.catchup_threshold,
+            'catchup_newest_first': args.newest_first,
+            'metrics_log_interval': 3600,
+        },
+        'telegram': {
+            'bot_token': '123456:bench',
+            'chat_id': '1000',
+            'api_url': api.url,
+        },
+        'accounts': [{'email': 'bench@example.com', 'password': 'bench', 'folders': ['INBOX']}],
+    }
+    if not args.real_limits:
+        # Стенд меряет сам конвейер, а не лимиты Telegram
+        config['telegram']['rate_limits'] = {
+            'global_rate': 10000, 'private_chat_rate': 10000, 'chat_burst': 10000,
+        }
+    path = os.path.join(work_dir, 'bench_config.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return path
+
+def feed(mailbox, paths, rate, stop):
+    """Подбрасывает письма в ящик с заданной частотой"""
+    started = time.perf_counter()
+    for index, path in enumerate(paths):
+        delay = started + index / rate - time.perf_counter()
+        if delay > 0 and stop.wait(delay):
+            return
+        with open(path, 'rb') as f:
+            mailbox.add(f.read())
+
+def read_status(pid, field):
+    """Поле /proc/<pid>/status (VmHWM, VmRSS) в байтах; None - процесса нет или это не Linux"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def descendants(pid):
+    """PID всех потомков процесса (пул изображений) по /proc/<pid>/task/*/children"""
+    result = []
+    try:
+        tasks = os.listdir(f'/proc/{pid}/task')
+    except OSError:
+        return result
+    for task in tasks:
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children = [int(child) for child in f.read().split()]
+        except (OSError, ValueError):
+            continue
+        for child in children:
+            result.append(child)
+            result.extend(descendants(child))
+    return result
+
+class MemorySampler(threading.Thread):
+    """Пиковая память бота по /proc, пока он работает.
+    
+    ru_maxrss из wait4 не годится: после fork/exec он наследует пик
+    процесса стенда, в котором лежит весь корпус писем.
+    """
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stop = threading.Event()
+        # VmHWM самого бота и максимум суммы VmRSS бота и его потомков
+        self.peak = None
+        self.peak_total = None
+
+    def run(self):
+        while True:
+            self.sample()
+            if self.stop.wait(self.interval):
+                return
+
+    def sample(self):
+        hwm = read_status(self.pid, 'VmHWM')
+        if hwm is None:
+            return
+        self.peak = max(self.peak or 0, hwm)
+        total = sum(read_status(pid, 'VmRSS') or 0 for pid in [self.pid] + descendants(self.pid))
+        self.peak_total = max(self.peak_total or 0, total)
+
+def wait_child(pid, timeout):
+    """Ожидание процесса бота; возвращает (код, rusage) или None по тайм-ауту"""
+    deadline = time.monotonic() + timeout
+    while True:
+        waited_pid, status, usage = os.wait4(pid, os.WNOHANG)
+        if waited_pid:
+            return os.waitstatus_to_exitcode(status), usage
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.05)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mails', type=int, default=200, help="всего писем")
+    parser.add_argument('--backlog', type=int, default=100, help="писем в ящике до старта бота")
+    parser.add_argument('--arrival-rate', type=float, default=20, help="писем в секунду после старта")
+    parser.add_argument('--huge-every', type=int, default=25, help="каждое N-е письмо с огромным вложением")
+    parser.add_argument('--huge-mb', type=int, default=15)
+    parser.add_argument('--images-per-mail', type=int, default=8)
+    parser.add_argument('--image-size', default='640x480')
+    parser.add_argument('--imap-latency', type=float, default=0.0, help="задержка ответа IMAP на команду, с")
+    parser.add_argument('--api-latency', type=float, default=0.02, help="задержка ответа Bot API, с")
+    parser.add_argument('--api-429-rate', type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--real-limits', action='store_true', help="лимиты Telegram как в работе")
+    parser.add_argument('--digest-mode', default='off', choices=['off', 'auto', 'always'])
+    parser.add_argument('--catchup-connections', type=int, default=4, help="соединений для догона очереди")
+    parser.add_argument('--catchup-threshold', type=int, default=200)
+    parser.add_argument('--newest-first', action='store_true', help="догон с самых новых писем")
+    parser.add_argument('--corpus-dir', help="каталог .eml (по умолчанию - временный)")
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="показать вывод бота")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='mail2tg-bench-')
+    corpus_dir = args.corpus_dir or os.path.join(work_dir, 'corpus')
+    started = time.perf_counter()
+    paths = CorpusGenerator(args).ensure_corpus(corpus_dir, args.mails)
+    corpus_bytes = sum(os.path.getsize(path) for path in paths)
+    print(f"Корпус: {len(paths)} писем, {corpus_bytes / 1024 / 1024:.1f} МБ "
+          f"({time.perf_counter() - started:.1f} с) - {corpus_dir}")
+
+    first_message = {}
+    def on_call(call):
+        # Первое сообщение в Telegram, где упомянута тема письма
+        now = call.time
+        for match in BENCH_ID_RE.finditer(' '.join(str(value) for value in call.params.values())):
+            first_message.setdefault(int(match.group(1)), now)
+
+    imap = FakeImapServer(latency=args.imap_latency).start()
+    api = FakeBotApi(
+        latency=args.api_latency, error_rate=args.api_429_rate,
+        retry_after=args.retry_after, on_call=on_call, seed=args.seed,
+    ).start()
+    mailbox = imap.mailbox
+    backlog = paths[:args.backlog]
+    for path in backlog:
+        with open(path, 'rb') as f:
+            mailbox.add(f.read())
+
+    config_path = write_config(work_dir, args, imap, api)
+    log_path = os.path.join(work_dir, 'bot.log')
+    log = None if args.verbose else open(log_path, 'wb')
+    bot_started = time.time()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'yandex_mail_bot.py'), config_path],
+        cwd=work_dir, stdout=log, stderr=subprocess.STDOUT,
+    )
+    memory = MemorySampler(process.pid)
+    memory.start()
+
+    stop = threading.Event()
+    feeder = None
+    if len(paths) > len(backlog):
+        rate = args.arrival_rate or float('inf')
+        feeder = threading.Thread(target=feed, args=(mailbox, paths[len(backlog):], rate, stop), daemon=True)
+        feeder.start()
+
+    exit_code = 0
+    deadline = time.monotonic() + args.timeout
+    finished = None
+    while time.monotonic() < deadline:
+        # Последний замер - до того, как wait4 уберет процесс из /proc
+        memory.sample()
+        messages = mailbox.messages
+        if len(messages) == len(paths) and all(message.seen_at for message in messages):
+            break
+        finished = wait_child(process.pid, 0)
+        if finished:
+            print(f"✗ Бот завершился раньше времени с кодом {finished[0]} (вывод: {log_path})")
+            exit_code = 1
+            break
+        time.sleep(0.1)
+    else:
+        print(f"✗ Не все письма доставлены за {args.timeout:.0f} с")
+        exit_code = 1
+
+    stop.set()
+    if not finished:
+        memory.sample()
+        process.send_signal(signal.SIGINT)
+        finished = wait_child(process.pid, 30)
+        if not finished:
+            process.kill()
+            finished = wait_child(process.pid, 10)
+    memory.stop.set()
+    memory.join()
+    if log:
+        log.close()
+
+    messages = list(mailbox.messages)
+    delivered = [message for message in messages if message.seen_at]
+    def arrival(message):
+        # Письма из очереди ждут старта бота - задержку считаем от него
+        return max(message.added_at, bot_started)
+    seen_latency = [message.seen_at - arrival(message) for message in delivered]
+    first_latency = [
+        first_message[number] - arrival(message)
+        for number, message in enumerate(messages, 1) if number in first_message
+    ]
+    elapsed = max((message.seen_at for message in delivered), default=time.time()) - bot_started
+
+    print(f"\nДоставлено: {len(delivered)} из {len(paths)} за {elapsed:.1f} с "
+          f"- {len(delivered) / elapsed if elapsed > 0 else 0:.1f} писем/с")
+    print(f"Задержка до первого сообщения: p50 {percentile(first_latency, 0.5):.2f} с, "
+          f"p99 {percentile(first_latency, 0.99):.2f} с")
+    print(f"Задержка до отметки прочитанным: p50 {percentile(seen_latency, 0.5):.2f} с, "
+          f"p99 {percentile(seen_latency, 0.99):.2f} с")
+    if memory.peak is not None:
+        print(f"Пиковый RSS бота: {memory.peak / 1024 / 1024:.1f} МБ, "
+              f"вместе с пулом процессов: {memory.peak_total / 1024 / 1024:.1f} МБ")
+    else:
+        print("Пиковый RSS бота: не измерен (нужен /proc)")
+    print(f"Bot API: {dict(api.methods)}, ответов 429: {api.throttled}, "
+          f"загружено {api.upload_bytes / 1024 / 1024:.1f} МБ")
+    print(f"IMAP: {dict(imap.commands)}, отдано {imap.bytes_sent / 1024 / 1024:.1f} МБ")
+    if not args.verbose:
+        print(f"Вывод бота: {log_path}")
+
+    api.stop()
+    imap.stop()
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
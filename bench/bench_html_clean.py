@@ -0,0 +1,234 @@
+"""Бенчмарк и проверка эквивалентности очистки HTML.
+
+Сравнивает однопроходный HtmlTextExtractor со старой реализацией
+clean_html_to_text на BeautifulSoup и с basic_html_clean на корпусе
+bench/html_corpus/*.html и на синтетическом письме с вложенными таблицами.
+
+Результаты старой реализации для файлов корпуса лежат рядом с ними
+(<имя>.txt) и сравниваются всегда, даже без bs4. После добавления файла
+в корпус их пересоздает --write-expected (нужен bs4).
+
+    python bench/bench_html_clean.py [--repeat N] [--backend lxml] [--write-expected]
+
+Код возврата 1, если результат расходится со старой реализацией.
+"""
+
+import argparse
+import glob
+import html
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from yandex_mail_bot import Metrics, YandexMailToTelegramBot
+
+CORPUS_DIR = os.path.join(ROOT, 'bench', 'html_corpus')
+PREVIEW_CHARS = YandexMailToTelegramBot.PREVIEW_CHARS
+
+def legacy_clean_html_to_text(html_content):
+    """clean_html_to_text до перехода на HtmlTextExtractor"""
+    from bs4 import BeautifulSoup
+
+    if not html_content:
+        return ""
+
+    soup = BeautifulSoup(html_content, 'html.parser')
+
+    for element in soup(['script', 'style', 'meta', 'link', 'head', 'title']):
+        element.decompose()
+
+    garbage_selectors = [
+        '[class*="hidden"]', '[class*="hide"]', '.footer', '.header',
+        '[class*="banner"]', '[class*="ad"]', '.signature', '.disclaimer',
+        '.copyright', '.logo', '.social', '.share', '.button', '.btn',
+        '[style*="display:none"]', '[style*="display: none"]',
+        '.email-footer', '.email-header', '.mailing', '.campaign'
+    ]
+
+    for selector in garbage_selectors:
+        for element in soup.select(selector):
+            element.decompose()
+
+    text = soup.get_text()
+
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            lines.append(line)
+
+    clean_text = '\n'.join(lines)
+    clean_text = re.sub(r'\s+', ' ', clean_text)
+
+    garbage_patterns = [
+        r'\[.*?\]',
+        r'&nbsp;',
+        r'<!--.*?-->',
+        r'https?://\S+',
+    ]
+
+    for pattern in garbage_patterns:
+        clean_text = re.sub(pattern, ' ', clean_text)
+
+    clean_text = html.unescape(clean_text)
+    return re.sub(r'\s+', ' ', clean_text).strip()
+
+def legacy_basic_html_clean(html_content):
+    """basic_html_clean до предкомпиляции регулярных выражений"""
+    if not html_content:
+        return ""
+
+    text = re.sub('<[^<]+?>', ' ', html_content)
+    text = re.sub('<!--.*?-->', ' ', text)
+    text = html.unescape(text)
+    text = re.sub(r'\[.*?\]', ' ', text)
+    text = re.sub(r'&[a-z]+;', ' ', text)
+
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and len(line) > 2:
+            lines.append(line)
+
+    clean_text = '\n'.join(lines)
+    return re.sub(r'\s+', ' ', clean_text).strip()
+
+def synthetic_newsletter(rows=1500):
+    """Рассылка на ~300 КБ: вложенные таблицы, баннеры, скрытые блоки"""
+    parts = ['<html><head><title>Акция</title><style>td{padding:0}</style></head><body>']
+    parts.append('<div style="display: none">прехедер</div>')
+    parts.append('<table width="100%"><tr><td><table class="wrapper">')
+    for row in range(rows):
+        parts.append(
+            f'<tr><td><table><tr>'
+            f'<td class="product"><a href="https://shop.example.com/p/{row}">Товар №{row}</a></td>'
+            f'<td class="price">{row * 7 % 9000} ₽&nbsp;</td>'
+            f'<td class="{"banner-inline" if row % 10 == 0 else "cell"}">Описание товара {row} [фото]</td>'
+            f'</tr></table></td></tr>'
+        )
+    parts.append('</table></td></tr></table>')
+    parts.append('<div class="footer">Отписаться от рассылки</div></body></html>')
+    return ''.join(parts)
+
+def expected_path(name):
+    return os.path.join(CORPUS_DIR, os.path.splitext(name)[0] + '.txt')
+
+def load_corpus():
+    """[(имя, HTML, ожидаемый текст или None)]; для синтетического письма ожидаемого нет"""
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, '*.html'))):
+        name = os.path.basename(path)
+        with open(path, encoding='utf-8') as f:
+            html_content = f.read()
+        expected = None
+        if os.path.exists(expected_path(name)):
+            with open(expected_path(name), encoding='utf-8', newline='') as f:
+                expected = f.read()
+        corpus.append((name, html_content, expected))
+    corpus.append(('synthetic-newsletter', synthetic_newsletter(), None))
+    return corpus
+
+def write_expected(corpus):
+    """Сохраняет результаты старой реализации для файлов корпуса"""
+    for name, html_content, _ in corpus:
+        if name == 'synthetic-newsletter':
+            continue
+        with open(expected_path(name), 'w', encoding='utf-8', newline='') as f:
+            f.write(legacy_clean_html_to_text(html_content))
+        print(f"✓ {os.path.relpath(expected_path(name), ROOT)}")
+
+def timed(func, html_content, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(html_content)
+    return result, (time.perf_counter() - start) / repeat
+
+def make_cleaner(backend):
+    """Бот без __init__: для очистки HTML нужны только html_backend и константы (без кэша)"""
+    cleaner = YandexMailToTelegramBot.__new__(YandexMailToTelegramBot)
+    cleaner.html_backend = backend
+    cleaner.text_cache = None
+    cleaner.metrics = Metrics()
+    return cleaner
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--backend', default='html.parser', choices=['html.parser', 'lxml'])
+    parser.add_argument('--write-expected', action='store_true',
+                        help="пересоздать html_corpus/*.txt старой реализацией и выйти")
+    args = parser.parse_args()
+
+    try:
+        import bs4
+        have_bs4 = True
+    except ImportError:
+        have_bs4 = False
+
+    corpus = load_corpus()
+    if args.write_expected:
+        if not have_bs4:
+            print("✗ Для --write-expected нужен bs4 (pip install beautifulsoup4)")
+            return 1
+        write_expected(corpus)
+        return 0
+    if not have_bs4:
+        print("bs4 не установлен - сравнение со старой реализацией только по html_corpus/*.txt")
+
+    cleaner = make_cleaner(args.backend)
+    mismatches = 0
+
+    print(f"{'файл':<24}{'КБ':>8}{'старый, мс':>12}{'новый, мс':>12}{'превью, мс':>12}{'basic, мс':>12}")
+    for name, html_content, expected in corpus:
+        full, new_time = timed(cleaner.clean_html_to_text, html_content, args.repeat)
+        preview, preview_time = timed(
+            lambda content: cleaner.clean_html_to_text(content, PREVIEW_CHARS), html_content, args.repeat
+        )
+        basic, basic_time = timed(cleaner.basic_html_clean, html_content, args.repeat)
+
+        # Ранний останов не должен менять видимое превью
+        if preview[:PREVIEW_CHARS] != full[:PREVIEW_CHARS]:
+            print(f"✗ {name}: превью с ранним остановом отличается от полного текста")
+            mismatches += 1
+
+        if basic != legacy_basic_html_clean(html_content):
+            print(f"✗ {name}: basic_html_clean отличается от старой реализации")
+            mismatches += 1
+
+        if expected is None and name != 'synthetic-newsletter':
+            print(f"✗ {name}: нет ожидаемого результата {os.path.basename(expected_path(name))} (--write-expected)")
+            mismatches += 1
+
+        legacy_time = float('nan')
+        if have_bs4:
+            legacy, legacy_time = timed(legacy_clean_html_to_text, html_content, args.repeat)
+            if expected is None:
+                expected = legacy
+            elif legacy != expected:
+                # Другая версия bs4 - ориентир остается сохраненный результат
+                print(f"   {name}: bs4 {bs4.__version__} дает не тот результат, что сохранен в корпусе")
+        if expected is not None and full != expected:
+            print(f"✗ {name}: clean_html_to_text отличается от старой реализации")
+            print(f"   было:  {expected[:200]!r}")
+            print(f"   стало: {full[:200]!r}")
+            # lxml по-своему чинит битую разметку - расхождение только показываем
+            if args.backend == 'html.parser':
+                mismatches += 1
+
+        print(
+            f"{name:<24}{len(html_content) / 1024:>8.1f}{legacy_time * 1000:>12.2f}"
+            f"{new_time * 1000:>12.2f}{preview_time * 1000:>12.2f}{basic_time * 1000:>12.2f}"
+        )
+
+    if mismatches:
+        print(f"✗ Расхождений: {mismatches}")
+        return 1
+    print("✓ Результаты совпадают")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
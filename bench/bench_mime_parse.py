@@ -0,0 +1,176 @@
+"""Бенчмарк и проверка эквивалентности разбора MIME.
+
+Сравнивает однопроходный MimeIndex со старым разбором через
+email.message_from_bytes и два обхода msg.walk() на синтетическом корпусе:
+письма в cp1251/koi8-r, multipart/alternative, вложения base64 и
+quoted-printable, пересланные письма, переводы строк LF.
+
+    python bench/bench_mime_parse.py [--repeat N] [--attachment-kb N]
+
+Код возврата 1, если части, тексты или вложения расходятся с email.
+"""
+
+import argparse
+import email
+import hashlib
+import os
+import sys
+import time
+from email.message import EmailMessage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from yandex_mail_bot import MimeIndex
+
+TEXT = "Добрый день! Во вложении отчет за квартал, прошу посмотреть до пятницы.\n" * 20
+
+def make_message(subject, charset='utf-8'):
+    message = EmailMessage()
+    message['From'] = 'Отправитель <sender@example.ru>'
+    message['To'] = 'bot@yandex.ru'
+    message['Subject'] = subject
+    message.set_content(TEXT, charset=charset)
+    return message
+
+def build_corpus(attachment_bytes):
+    blob = os.urandom(attachment_bytes)
+    corpus = []
+
+    corpus.append(('plain-cp1251', make_message('cp1251', 'cp1251').as_bytes()))
+    corpus.append(('plain-koi8-r', make_message('koi8-r', 'koi8-r').as_bytes()))
+
+    message = make_message('alternative', 'cp1251')
+    message.add_alternative(f"<html><body><p>{TEXT}</p></body></html>", subtype='html', charset='koi8-r')
+    corpus.append(('alternative', message.as_bytes()))
+
+    message = make_message('html-only')
+    message.set_content(f"<html><body><p>{TEXT}</p></body></html>", subtype='html', charset='cp1251', cte='quoted-printable')
+    corpus.append(('html-qp-cp1251', message.as_bytes()))
+
+    message = make_message('attachments')
+    message.add_attachment(blob, maintype='image', subtype='png', filename='фото.png')
+    message.add_attachment(blob[:len(blob) // 2], maintype='application', subtype='pdf', filename='отчет.pdf')
+    message.add_attachment(TEXT.encode('cp1251'), maintype='text', subtype='csv', filename='table.csv')
+    corpus.append(('attachments', message.as_bytes()))
+
+    forwarded = make_message('вложенное', 'koi8-r')
+    forwarded.add_attachment(blob[:4096], maintype='image', subtype='jpeg', filename='inner.jpg')
+    message = make_message('forward')
+    message.add_attachment(forwarded)
+    corpus.append(('forwarded-rfc822', message.as_bytes()))
+
+    # Переводы строк LF и граница, с которой начинается другая граница
+    message = make_message('lf')
+    message.add_attachment(blob[:8192], maintype='application', subtype='octet-stream', filename='data.bin')
+    message.set_boundary('frontier')
+    raw = message.as_bytes().replace(b'\r\n', b'\n').replace(b'\n--frontier\n', b'\n--frontier\nX-Note: --frontier-x\n', 1)
+    corpus.append(('lf-newlines', raw))
+
+    return corpus
+
+def decode_part(part):
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, errors='ignore')
+    except LookupError:
+        return payload.decode('utf-8', errors='ignore')
+
+def reference(raw):
+    """Листовые части по email: (тип, имя файла, sha256 тела, текст)"""
+    parts = []
+    for part in email.message_from_bytes(raw).walk():
+        if part.is_multipart():
+            continue
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            continue
+        text = decode_part(part) if part.get_content_maintype() == 'text' else None
+        parts.append((part.get_content_type(), part.get_filename(), hashlib.sha256(payload).hexdigest(), text))
+    return parts
+
+def indexed(raw):
+    index = MimeIndex(raw)
+    parts = []
+    for part in index.parts:
+        payload = index.payload(part)
+        text = None
+        if part.type.startswith('text/'):
+            try:
+                text = payload.decode(part.charset or 'utf-8', errors='ignore')
+            except LookupError:
+                text = payload.decode('utf-8', errors='ignore')
+        parts.append((part.type, part.filename, hashlib.sha256(payload).hexdigest(), text))
+    index.release()
+    return parts
+
+def legacy_parse(raw):
+    """Разбор до MimeIndex: дерево Message и два обхода - текст и вложения"""
+    msg = email.message_from_bytes(raw)
+    text = ""
+    for part in msg.walk():
+        if part.get_content_type() in ('text/plain', 'text/html') and 'attachment' not in str(part.get("Content-Disposition", "")):
+            payload = part.get_payload(decode=True)
+            if payload:
+                text += payload.decode('utf-8', errors='ignore')
+    attachments = []
+    for part in msg.walk():
+        if part.get_filename():
+            data = part.get_payload(decode=True)
+            if data:
+                attachments.append(bytes(data))
+    return text, attachments
+
+def indexed_parse(raw):
+    index = MimeIndex(raw)
+    text = ""
+    attachments = []
+    for part in index.parts:
+        if part.filename:
+            attachments.append(b''.join(index.iter_payload(part)))
+        elif part.type in ('text/plain', 'text/html'):
+            text += index.payload(part).decode(part.charset or 'utf-8', errors='ignore')
+    index.release()
+    return text, attachments
+
+def timed(func, raw, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(raw)
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--attachment-kb', type=int, default=512, help="размер вложений в корпусе, КБ")
+    args = parser.parse_args()
+
+    mismatches = 0
+    print(f"{'письмо':<20}{'КБ':>8}{'частей':>8}{'email, мс':>12}{'MimeIndex, мс':>15}")
+    for name, raw in build_corpus(args.attachment_kb * 1024):
+        expected, actual = reference(raw), indexed(raw)
+        if expected != actual:
+            print(f"✗ {name}: части расходятся с email")
+            for want, got in zip(expected, actual):
+                if want != got:
+                    print(f"   email:     {str(want)[:160]}")
+                    print(f"   MimeIndex: {str(got)[:160]}")
+            if len(expected) != len(actual):
+                print(f"   частей: {len(expected)} и {len(actual)}")
+            mismatches += 1
+
+        print(
+            f"{name:<20}{len(raw) / 1024:>8.1f}{len(actual):>8}"
+            f"{timed(legacy_parse, raw, args.repeat) * 1000:>12.2f}"
+            f"{timed(indexed_parse, raw, args.repeat) * 1000:>15.2f}"
+        )
+
+    if mismatches:
+        print(f"✗ Расхождений: {mismatches}")
+        return 1
+    print("✓ Результаты совпадают")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""Локальный фейковый Bot API для нагрузочного стенда.
+
+Принимает запросы telebot по адресу /bot<token>/<method>, отвечает
+правдоподобными объектами Message (с file_id у фото и документов) и
+записывает каждый вызов. Умеет добавлять задержку ответа и отвечать
+429 Too Many Requests с заданной вероятностью.
+
+    api = FakeBotApi(latency=0.05, error_rate=0.02).start()
+    telegram_config['api_url'] = api.url
+"""
+
+import email.parser
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class ApiCall:
+    """Запись об одном запросе к API"""
+
+    __slots__ = ('time', 'method', 'params', 'upload_bytes', 'status')
+
+    def __init__(self, method, params, upload_bytes, status):
+        self.time = time.time()
+        self.method = method
+        self.params = params
+        self.upload_bytes = upload_bytes
+        self.status = status
+
+def parse_form(content_type, body):
+    """Текстовые поля тела запроса (urlencoded или multipart) и число байт файлов"""
+    if not body:
+        return {}, 0
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return dict(urllib.parse.parse_qsl(body.decode('utf-8'))), 0
+    if content_type.startswith('application/json'):
+        return json.loads(body), 0
+    if not content_type.startswith('multipart/form-data'):
+        return {}, len(body)
+    fields, file_bytes = {}, 0
+    message = email.parser.BytesParser().parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+    )
+    for part in message.get_payload():
+        name = part.get_param('name', header='content-disposition')
+        payload = part.get_payload(decode=True) or b''
+        if part.get_filename():
+            file_bytes += len(payload)
+        elif name:
+            fields[name] = payload.decode('utf-8', errors='replace')
+    return fields, file_bytes
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_call()
+
+    def do_POST(self):
+        self.handle_call()
+
+    def handle_call(self):
+        api = self.server.api
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        method = parts[1]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        fields, upload_bytes = parse_form(self.headers.get('Content-Type', ''), body)
+        params.update(fields)
+
+        if api.latency:
+            time.sleep(api.latency)
+        if api.error_rate and api.random.random() < api.error_rate:
+            api.record(method, params, upload_bytes, 429)
+            self.reply(429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {api.retry_after}",
+                'parameters': {'retry_after': api.retry_after},
+            })
+            return
+        api.record(method, params, upload_bytes, 200)
+        self.reply(200, {'ok': True, 'result': api.result(method, params)})
+
+    def reply(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeBotApi:
+    """Сервер в фоновом потоке; on_call(ApiCall) вызывается для каждого успешного запроса"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, retry_after=1,
+                 on_call=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.on_call = on_call
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.methods = Counter()
+        self.throttled = 0
+        self.upload_bytes = 0
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.server = ThreadingHTTPServer((host, port), BotApiHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, method, params, upload_bytes, status):
+        call = ApiCall(method, params, upload_bytes, status)
+        with self.lock:
+            self.calls.append(call)
+            if status == 429:
+                self.throttled += 1
+                return
+            self.methods[method] += 1
+            self.upload_bytes += upload_bytes
+        if self.on_call:
+            self.on_call(call)
+
+    def file_object(self, reference):
+        """Повторная отправка по file_id возвращает тот же file_id"""
+        if isinstance(reference, str) and reference.startswith('bench-file-'):
+            file_id = reference
+        else:
+            file_id = f"bench-file-{next(self.file_ids)}"
+        return {'file_id': file_id, 'file_unique_id': file_id.replace('file', 'unique')}
+
+    def message(self, params, **content):
+        chat_id = params.get('chat_id', 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group' if str(chat_id).startswith('-') else 'private'},
+        }
+        message.update(content)
+        return message
+
+    def photo_sizes(self, reference):
+        photo = self.file_object(reference)
+        photo.update({'width': 1280, 'height': 960})
+        return [photo]
+
+    def result(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'sendMessage':
+            return self.message(params, text=params.get('text', ''))
+        if method == 'sendPhoto':
+            return self.message(params, photo=self.photo_sizes(params.get('photo')))
+        if method == 'sendDocument':
+            return self.message(params, document=self.file_object(params.get('document')))
+        if method == 'sendMediaGroup':
+            media = params.get('media') or '[]'
+            media = json.loads(media) if isinstance(media, str) else media
+            group = []
+            for item in media:
+                if item.get('type') == 'photo':
+                    group.append(self.message(params, photo=self.photo_sizes(item.get('media'))))
+                else:
+                    group.append(self.message(params, document=self.file_object(item.get('media'))))
+            return group
+        return True
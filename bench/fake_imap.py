@@ -0,0 +1,354 @@
+"""Локальный IMAP4rev1-сервер для нагрузочного стенда.
+
+Одна папка в памяти, без TLS и без проверки пароля. Поддерживает ровно то,
+что использует бот: CAPABILITY, LOGIN, SELECT, UID SEARCH (UNSEEN, UID n:*),
+UID FETCH (UID, FLAGS, RFC822.SIZE, BODYSTRUCTURE, BODY[HEADER],
+BODY[HEADER.FIELDS (...)], BODY[n.m] и частичные BODY[...]<offset.count>),
+UID STORE, IDLE, NOOP, CLOSE, LOGOUT.
+
+    server = FakeImapServer().start()
+    server.mailbox.add(raw_bytes)   # письмо появится в IDLE как EXISTS
+"""
+
+import email
+import re
+import select
+import socketserver
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from email import policy
+
+FETCH_ITEM_RE = re.compile(r'BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[^\s()]+', re.IGNORECASE)
+PARTIAL_RE = re.compile(r'<(\d+)\.(\d+)>')
+
+def quote(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def param_list(pairs):
+    if not pairs:
+        return 'NIL'
+    return '(' + ' '.join(f'{quote(key)} {quote(value)}' for key, value in pairs) + ')'
+
+def part_body(part):
+    """Тело части в том виде, в каком оно лежит в письме (с кодированием передачи)"""
+    # get_payload() перекодирует 8-битные тела из charset в str - нужны исходные байты
+    payload = part._payload
+    if isinstance(payload, str):
+        return payload.replace('\r\n', '\n').replace('\n', '\r\n').encode('utf-8', 'surrogateescape')
+    return b''
+
+class StoredMessage:
+    """Письмо папки с заранее посчитанными BODYSTRUCTURE и секциями"""
+
+    __slots__ = ('uid', 'raw', 'flags', 'added_at', 'seen_at', 'header', 'bodystructure', 'sections')
+
+    def __init__(self, uid, raw):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set()
+        self.added_at = time.time()
+        # Когда письмо впервые помечено прочитанным - бот считает его доставленным
+        self.seen_at = None
+        end = raw.find(b'\r\n\r\n')
+        self.header = raw[:end + 4] if end >= 0 else raw
+        self.sections = {}
+        message = email.message_from_bytes(raw, policy=policy.compat32)
+        self.bodystructure = self.describe(message, '')
+
+    def describe(self, part, number):
+        """BODYSTRUCTURE части; попутно запоминает тела секций"""
+        if part.get_content_type() == 'message/rfc822':
+            # Вложенное письмо: части составного тела - number.N, простое тело - number.1
+            inner = part.get_payload(0)
+            body = inner.as_bytes().replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+            self.sections[number or '1'] = body
+            nested = self.describe(inner, number if inner.is_multipart() else f"{number or '1'}.1")
+            disposition = part.get_content_disposition()
+            filename = part.get_filename()
+            filename_params = [('filename', filename)] if filename else []
+            disposition = f'({quote(disposition)} {param_list(filename_params)})' if disposition else 'NIL'
+            lines = body.count(b'\r\n')
+            return (
+                f'("message" "rfc822" NIL NIL NIL "7bit" {len(body)} NIL {nested} '
+                f'{lines} NIL {disposition} NIL NIL)'
+            )
+        if part.is_multipart():
+            children = ''.join(
+                self.describe(child, f"{number}.{index}" if number else str(index))
+                for index, child in enumerate(part.get_payload(), 1)
+            )
+            boundary = param_list([('boundary', part.get_boundary())])
+            return f'({children} {quote(part.get_content_subtype())} {boundary} NIL NIL NIL)'
+        body = part_body(part)
+        self.sections[number or '1'] = body
+        maintype = part.get_content_maintype()
+        params = part.get_params() or []
+        encoding = part.get('Content-Transfer-Encoding', '7bit')
+        filename = part.get_filename()
+        if filename and not filename.isascii():
+            filename_params = [('filename*', "utf-8''" + urllib.parse.quote(filename))]
+        else:
+            filename_params = [('filename', filename)] if filename else []
+        disposition = part.get_content_disposition()
+        disposition = f'({quote(disposition)} {param_list(filename_params)})' if disposition else 'NIL'
+        lines = ' %d' % body.count(b'\r\n') if maintype == 'text' else ''
+        return (
+            f'({quote(maintype)} {quote(part.get_content_subtype())} {param_list(params[1:])} '
+            f'NIL NIL {quote(encoding)} {len(body)}{lines} NIL {disposition} NIL NIL)'
+        )
+
+    def set_flags(self, flags):
+        if '\\Seen' in flags and self.seen_at is None:
+            self.seen_at = time.time()
+        self.flags = flags
+
+    def section(self, name):
+        name = name.upper()
+        if name == '':
+            return self.raw
+        if name == 'HEADER':
+            return self.header
+        if name == 'TEXT':
+            return self.raw[len(self.header):]
+        if name.startswith('HEADER.FIELDS'):
+            wanted = set(name[name.index('(') + 1:name.rindex(')')].split())
+            lines = []
+            for field, value in email.message_from_bytes(self.header, policy=policy.compat32).items():
+                if field.upper() in wanted:
+                    lines.append(f"{field}: {value}\r\n")
+            return ''.join(lines).encode('utf-8', 'surrogateescape') + b'\r\n'
+        return self.sections.get(name, b'')
+
+class Mailbox:
+    """Единственная папка сервера; add() можно вызывать из любого потока"""
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.changed = threading.Condition()
+
+    def add(self, raw):
+        """Добавляет письмо и возвращает его UID"""
+        message = StoredMessage(self.next_uid, raw)
+        with self.changed:
+            self.messages.append(message)
+            self.next_uid += 1
+            self.changed.notify_all()
+        return message.uid
+
+    def __len__(self):
+        return len(self.messages)
+
+    def resolve(self, sequence_set, by_uid):
+        """Номера (или UID) из множества вида 1,3:5,7:*"""
+        messages = self.messages
+        if by_uid:
+            largest = messages[-1].uid if messages else 0
+        else:
+            largest = len(messages)
+        result = set()
+        for item in sequence_set.split(','):
+            first, _, last = item.partition(':')
+            first = largest if first == '*' else int(first)
+            last = first if not last else (largest if last == '*' else int(last))
+            result.update(range(min(first, last), max(first, last) + 1))
+        return result
+
+    def select(self, sequence_set, by_uid):
+        """Пары (номер, письмо) по множеству номеров или UID"""
+        wanted = self.resolve(sequence_set, by_uid)
+        for number, message in enumerate(list(self.messages), 1):
+            if (message.uid if by_uid else number) in wanted:
+                yield number, message
+
+class ImapHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        # Сколько писем клиент уже видел (SELECT или EXISTS)
+        self.reported = None
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def report_new(self):
+        """Как настоящий сервер, сообщает о новых письмах перед завершением любой команды"""
+        if self.reported is not None and len(self.server.mailbox) != self.reported:
+            self.reported = len(self.server.mailbox)
+            self.send(f'* {self.reported} EXISTS\r\n')
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send('* OK fake IMAP4rev1 ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode('utf-8', errors='replace').rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            by_uid = command == 'UID'
+            if by_uid:
+                command, _, args = args.partition(' ')
+                command = command.upper()
+            self.server.commands[command] += 1
+            if self.server.latency and command != 'IDLE':
+                # Время ответа удаленного сервера
+                time.sleep(self.server.latency)
+
+            if command == 'CAPABILITY':
+                self.send(f'* CAPABILITY IMAP4rev1 IDLE\r\n{tag} OK CAPABILITY completed\r\n')
+            elif command == 'LOGIN':
+                self.send(f'{tag} OK LOGIN completed\r\n')
+            elif command in ('SELECT', 'EXAMINE'):
+                self.reported = len(mailbox)
+                self.send(
+                    f'* {self.reported} EXISTS\r\n'
+                    f'* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n'
+                    f'* OK [UIDNEXT {mailbox.next_uid}] next UID\r\n'
+                    f'{tag} OK [READ-WRITE] SELECT completed\r\n'
+                )
+            elif command in ('NOOP', 'CLOSE', 'CHECK'):
+                self.report_new()
+                self.send(f'{tag} OK {command} completed\r\n')
+            elif command == 'LOGOUT':
+                self.send(f'* BYE logging out\r\n{tag} OK LOGOUT completed\r\n')
+                return
+            elif command == 'SEARCH':
+                found = ' '.join(map(str, self.search(args, by_uid)))
+                self.report_new()
+                self.send(f'* SEARCH{" " + found if found else ""}\r\n{tag} OK SEARCH completed\r\n')
+            elif command == 'FETCH':
+                self.fetch(args, by_uid)
+                self.report_new()
+                self.send(f'{tag} OK FETCH completed\r\n')
+            elif command == 'STORE':
+                self.store(args, by_uid)
+                self.report_new()
+                self.send(f'{tag} OK STORE completed\r\n')
+            elif command == 'IDLE':
+                self.idle()
+                self.send(f'{tag} OK IDLE terminated\r\n')
+            else:
+                self.send(f'{tag} BAD unknown command {command}\r\n')
+
+    def search(self, args, by_uid):
+        tokens = args.split()
+        # Необязательный CHARSET не влияет на поддерживаемые критерии
+        if tokens and tokens[0].upper() == 'CHARSET':
+            tokens = tokens[2:]
+        unseen = False
+        uid_range = None
+        index = 0
+        while index < len(tokens):
+            token = tokens[index].upper()
+            if token == 'UNSEEN':
+                unseen = True
+            elif token == 'UID':
+                index += 1
+                uid_range = self.server.mailbox.resolve(tokens[index], True)
+            index += 1
+        result = []
+        for number, message in enumerate(list(self.server.mailbox.messages), 1):
+            if unseen and '\\Seen' in message.flags:
+                continue
+            if uid_range is not None and message.uid not in uid_range:
+                continue
+            result.append(message.uid if by_uid else number)
+        return result
+
+    def fetch(self, args, by_uid):
+        sequence_set, _, items = args.partition(' ')
+        items = FETCH_ITEM_RE.findall(items)
+        for number, message in self.server.mailbox.select(sequence_set, by_uid):
+            simple = [f'UID {message.uid}']
+            literals = []
+            for item in items:
+                upper = item.upper()
+                if upper == 'FLAGS':
+                    simple.append(f'FLAGS ({" ".join(sorted(message.flags))})')
+                elif upper == 'RFC822.SIZE':
+                    simple.append(f'RFC822.SIZE {len(message.raw)}')
+                elif upper == 'BODYSTRUCTURE':
+                    simple.append(f'BODYSTRUCTURE {message.bodystructure}')
+                elif upper == 'RFC822' or upper.startswith('BODY'):
+                    section = item[item.index('[') + 1:item.index(']')] if '[' in item else ''
+                    data = message.raw if upper == 'RFC822' else message.section(section)
+                    name = 'RFC822' if upper == 'RFC822' else f'BODY[{section.upper()}]'
+                    partial = PARTIAL_RE.search(item)
+                    if partial:
+                        offset, count = int(partial.group(1)), int(partial.group(2))
+                        data = data[offset:offset + count]
+                        name += f'<{offset}>'
+                    if 'PEEK' not in upper:
+                        message.set_flags(message.flags | {'\\Seen'})
+                    literals.append((name, data))
+            chunks = [f'* {number} FETCH ({" ".join(simple)}'.encode('utf-8')]
+            for name, data in literals:
+                chunks.append(f' {name} {{{len(data)}}}\r\n'.encode('ascii'))
+                chunks.append(data)
+                self.server.bytes_sent += len(data)
+            chunks.append(b')\r\n')
+            self.send(b''.join(chunks))
+
+    def store(self, args, by_uid):
+        sequence_set, _, rest = args.partition(' ')
+        operation, _, flags = rest.partition(' ')
+        flags = set(flags.strip('()').split())
+        operation = operation.upper()
+        for number, message in self.server.mailbox.select(sequence_set, by_uid):
+            if operation.startswith('-'):
+                message.set_flags(message.flags - flags)
+            elif operation.startswith('+'):
+                message.set_flags(message.flags | flags)
+            else:
+                message.set_flags(flags)
+            if not operation.endswith('.SILENT'):
+                self.send(f'* {number} FETCH (UID {message.uid} FLAGS ({" ".join(sorted(message.flags))}))\r\n')
+
+    def idle(self):
+        """Ждет DONE от клиента, сообщая о новых письмах через EXISTS"""
+        mailbox = self.server.mailbox
+        self.send('+ idling\r\n')
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                self.rfile.readline()
+                return
+            with mailbox.changed:
+                if len(mailbox) == self.reported:
+                    mailbox.changed.wait(0.05)
+            self.report_new()
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """Сервер в фоновом потоке; порт 0 - любой свободный"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, mailbox=None, latency=0.0):
+        super().__init__((host, port), ImapHandler)
+        self.mailbox = mailbox or Mailbox()
+        self.latency = latency
+        self.commands = Counter()
+        self.bytes_sent = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-imap", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
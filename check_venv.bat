@@ -31,7 +31,7 @@ if exist "yandex_mail_bot_env" (
 
 echo.
 echo Checking dependencies...
-pip list | findstr "imapclient telebot pillow requests"
+pip list | findstr /i "pyTelegramBotAPI pillow requests lxml"
 echo.
 
 pause
\ No newline at end of file
@@ -1,5 +1,6 @@
 @echo off
 echo Alternative virtual environment creation...
+echo Python 3.11 or newer is required
 
 :: Try different Python commands
 echo Trying 'python' command...
@@ -29,10 +30,10 @@ echo Virtual environment created successfully!
 if exist "yandex_mail_bot_env\Scripts\activate.bat" (
     echo Activating and installing dependencies...
     call yandex_mail_bot_env\Scripts\activate.bat
-    pip install imapclient pytelegrambotapi pillow requests beautifulsoup4 lxml
+    pip install pytelegrambotapi pillow requests lxml
 ) else (
     echo Installing dependencies globally...
-    pip install imapclient pytelegrambotapi pillow requests beautifulsoup4 lxml
+    pip install pytelegrambotapi pillow requests lxml
 )
 
 echo Setup complete!
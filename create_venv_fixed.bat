@@ -8,6 +8,14 @@ if errorlevel 1 (
     exit /b 1
 )
 
+python -c "import sys; sys.exit(sys.version_info < (3, 11))"
+if errorlevel 1 (
+    echo ERROR: Python 3.11 or newer is required
+    echo Please install it from https://www.python.org/downloads/
+    pause
+    exit /b 1
+)
+
 echo Creating virtual environment...
 python -m venv yandex_mail_bot_env
 
@@ -34,7 +42,6 @@ echo Upgrading pip...
 python -m pip install --upgrade pip
 
 echo Installing dependencies...
-pip install imapclient
 pip install pytelegrambotapi
 pip install pillow
 pip install requests
@@ -47,7 +54,10 @@ echo.
 echo To activate the environment, run:
 echo   yandex_mail_bot_env\Scripts\activate.bat
 echo.
+echo Copy config.example.toml to config.toml and fill it in
+echo   (or set MAIL2TG_EMAIL, MAIL2TG_PASSWORD, MAIL2TG_BOT_TOKEN, MAIL2TG_CHAT_ID)
+echo.
 echo Then run the bot with:
-echo   python yandex_mail_bot.py
+echo   python yandex_mail_bot.py config.toml
 echo.
 pause
\ No newline at end of file
@@ -1,68 +1,2585 @@
 import imaplib
 import email
+import asyncio
 from email.header import decode_header
-import telebot
-from PIL import Image
+import email.policy
+import email.parser
+from email.utils import parsedate_to_datetime, getaddresses
 import io
 import os
 import time
+import random
+import select
+import tempfile
 import threading
+import queue
+import mmap
+import shutil
+import signal
+import weakref
+import hashlib
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 import re
 import sys
 import html
-from bs4 import BeautifulSoup
+import json
+import sqlite3
+import base64
+import quopri
+import urllib.parse
+import importlib.util
+import argparse
+import contextvars
+import logging
+import logging.handlers
+from html.parser import HTMLParser
+# telebot, PIL, cProfile, http.server и пул процессов импортируются при первом
+# использовании: проход без новых писем (--once под cron) их не загружает.
+# tomllib - тоже: на Python старше 3.11 модуль должен импортироваться,
+# чтобы check_dependencies сообщил о версии, а не упал с ImportError
+MIN_PYTHON = (3, 11)
+
+log = logging.getLogger('mail2tg')
+# Поля текущего письма для структурных логов: mailbox, uid, stage
+LOG_CONTEXT = contextvars.ContextVar('mail2tg_log_context', default={})
+
+@contextmanager
+def log_context(**fields):
+    """Добавляет поля ко всем записям лога внутри блока (и в задачах пула, см. MailPipeline.run_in)"""
+    token = LOG_CONTEXT.set({**LOG_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        LOG_CONTEXT.reset(token)
+
+class LogContextFilter(logging.Filter):
+    """Переносит поля LOG_CONTEXT в запись; явный extra= имеет приоритет"""
+    
+    FIELDS = ('mailbox', 'uid', 'stage', 'duration')
+    
+    def filter(self, record):
+        context = LOG_CONTEXT.get()
+        for field in self.FIELDS:
+            if getattr(record, field, None) is None:
+                setattr(record, field, context.get(field))
+        return True
+
+class LogRateLimiter(logging.Filter):
+    """Не больше burst записей WARNING и выше с одного места кода за interval секунд.
+    
+    Лишние отбрасываются еще до очереди, их число дописывается к первой
+    записи следующего окна: шторм переподключений не заливает диск.
+    """
+    
+    def __init__(self, burst=10, interval=60):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # (файл, строка) -> [начало окна, записей в окне, отброшено]
+        self.windows = {}
+        self.lock = threading.Lock()
+    
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} (пропущено похожих сообщений: {suppressed})"
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler с ограниченной очередью: при переполнении запись теряется, а не ждет"""
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            notice = logging.makeLogRecord({
+                'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"Очередь логов была переполнена, потеряно записей: {dropped}",
+            })
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                self.dropped += dropped
+
+class LogQueueListener(logging.handlers.QueueListener):
+    """QueueListener, который при остановке ждет места в очереди, а не падает на Full"""
+    
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна строка JSON на запись: время, уровень, сообщение и поля письма.
+    
+    Трассировку исключения QueueHandler.prepare уже дописал в message.
+    """
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in LogContextFilter.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMATS = ('text', 'json')
+
+def setup_logging(level='INFO', log_format='text', path=None, queue_size=10000):
+    """Логи через очередь: рабочие потоки только кладут записи, пишет поток QueueListener.
+    
+    Возвращает запущенный QueueListener; stop() при выходе дописывает очередь.
+    """
+    if log_format == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)-7s %(message)s')
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if path:
+        # WatchedFileHandler переоткрывает файл после logrotate
+        handlers.append(logging.handlers.WatchedFileHandler(path, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.Queue(queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    queue_handler.addFilter(LogRateLimiter())
+    log.handlers[:] = [queue_handler]
+    log.setLevel(str(level).upper())
+    log.propagate = False
+    listener = LogQueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
 
 def check_dependencies():
-    """Проверка установленных зависимостей"""
+    """Проверка версии Python и установленных зависимостей (без импорта - он откладывается до первой отправки)"""
+    if sys.version_info < MIN_PYTHON:
+        log.error(f"✗ Нужен Python {'.'.join(map(str, MIN_PYTHON))} или новее, установлен {sys.version.split()[0]}")
+        log.info("Установите свежий Python с https://www.python.org/downloads/ и пересоздайте окружение")
+        return False
+    missing = [name for name in ('telebot', 'PIL', 'requests') if importlib.util.find_spec(name) is None]
+    if missing:
+        log.error(f"✗ Отсутствует зависимость: {', '.join(missing)}")
+        log.info("Запустите create_venv_fixed.bat для установки зависимостей")
+        return False
+    log.info("✓ Все зависимости установлены")
+    return True
+
+class MemoryBudget:
+    """Общий бюджет памяти под данные вложений.
+    
+    Загрузка блокируется, пока бюджет исчерпан; при нехватке памяти
+    вложения, лежащие в RAM, сначала вытесняются на диск.
+    """
+    
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.used = 0
+        self.cond = threading.Condition(threading.RLock())
+        self.spools = weakref.WeakSet()
+    
+    def try_acquire(self, size):
+        with self.cond:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+    
+    def acquire(self, size):
+        """Резервирует память, ожидая освобождения (back-pressure на загрузку)"""
+        with self.cond:
+            # Запрос больше всего бюджета пропускаем, когда больше никто не занимает память
+            while self.used and self.used + size > self.limit:
+                if not self._spill_to_disk():
+                    self.cond.wait(1.0)
+            self.used += size
+    
+    def release(self, size):
+        with self.cond:
+            self.used = max(0, self.used - size)
+            self.cond.notify_all()
+    
+    def register(self, spool):
+        self.spools.add(spool)
+    
+    def _spill_to_disk(self):
+        """Вытесняет вложения из памяти на диск; True, если что-то освободилось.
+        
+        Спулы, которые сейчас читаются или пишутся другим потоком, пропускаются:
+        rollover подменяет файл до копирования данных.
+        """
+        spilled = False
+        for spool in list(self.spools):
+            if not spool.lock.acquire(blocking=False):
+                continue
+            try:
+                if spool.in_memory and spool.reserved:
+                    spool.rollover()
+                    spilled = True
+            finally:
+                spool.lock.release()
+        return spilled
+
+class TransferDecoder:
+    """Потоковое снятие Content-Transfer-Encoding по кускам произвольной длины"""
+    
+    # Байты вне алфавита base64 (переводы строк и мусор): bytes.translate быстрее re.sub
+    BASE64_JUNK = bytes(sorted(set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')))
+    
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.tail = b''
+    
+    def feed(self, data):
+        if self.encoding == 'base64':
+            data = self.tail + bytes(data).translate(None, self.BASE64_JUNK)
+            cut = len(data) // 4 * 4
+            self.tail = data[cut:]
+            return base64.b64decode(data[:cut])
+        if self.encoding == 'quoted-printable':
+            # Декодируем только целые строки, чтобы не разрезать "=XX" и мягкие переносы
+            data = self.tail + data
+            end = data.rfind(b'\n') + 1
+            self.tail = data[end:]
+            return quopri.decodestring(data[:end])
+        return data
+    
+    def finish(self):
+        tail, self.tail = self.tail, b''
+        if not tail:
+            return b''
+        if self.encoding == 'base64':
+            return base64.b64decode(tail + b'=' * (-len(tail) % 4))
+        return quopri.decodestring(tail)
+
+class MimePart:
+    """Листовая часть письма: метаданные и границы тела в исходном буфере"""
+    
+    __slots__ = ('type', 'disposition', 'charset', 'encoding', 'filename', 'start', 'end')
+    
+    def __init__(self, headers, start, end):
+        self.type = headers.get_content_type()
+        self.disposition = headers.get_content_disposition()
+        self.charset = headers.get_content_charset()
+        self.encoding = str(headers.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        self.filename = headers.get_filename()
+        self.start = start
+        self.end = end
+    
+    @property
+    def size(self):
+        return self.end - self.start
+
+class MimeIndex:
+    """Однопроходный разбор MIME: заголовки письма и плоский список листовых частей.
+    
+    Разбираются только заголовки частей, тела не копируются - части хранят
+    смещения в исходном буфере и декодируются по запросу из memoryview-срезов.
+    """
+    
+    MAX_DEPTH = 32
+    CHUNK_BYTES = 1024 * 1024
+    HEADER_PARSER = email.parser.BytesHeaderParser()
+    
+    def __init__(self, raw):
+        self.raw = raw
+        self.buffer = memoryview(raw)
+        self.parts = []
+        header_end, body_start = self.split_header(0, len(raw))
+        self.headers = self.parse_headers(0, header_end)
+        self._index(self.headers, body_start, len(raw), 0)
+    
+    def split_header(self, start, end):
+        """(конец заголовков, начало тела) части в диапазоне [start, end)"""
+        raw = self.raw
+        # Части без заголовков начинаются сразу с пустой строки
+        if raw.startswith(b'\r\n', start):
+            return start, start + 2
+        if raw.startswith(b'\n', start):
+            return start, start + 1
+        crlf = raw.find(b'\r\n\r\n', start, end)
+        lf = raw.find(b'\n\n', start, end)
+        if lf != -1 and (crlf == -1 or lf < crlf):
+            return lf + 1, lf + 2
+        if crlf != -1:
+            return crlf + 2, crlf + 4
+        return end, end
+    
+    def parse_headers(self, start, end):
+        return self.HEADER_PARSER.parsebytes(self.raw[start:end])
+    
+    def _index(self, headers, start, end, depth):
+        if depth < self.MAX_DEPTH:
+            if headers.get_content_maintype() == 'multipart':
+                boundary = headers.get_boundary()
+                if boundary:
+                    for part_start, part_end in self.split_multipart(boundary, start, end):
+                        header_end, body_start = self.split_header(part_start, part_end)
+                        self._index(self.parse_headers(part_start, header_end), body_start, part_end, depth + 1)
+                    return
+            elif headers.get_content_type() == 'message/rfc822':
+                # Пересланное письмо: его части - часть этого письма, как в Message.walk()
+                header_end, body_start = self.split_header(start, end)
+                self._index(self.parse_headers(start, header_end), body_start, end, depth + 1)
+                return
+        self.parts.append(MimePart(headers, start, end))
+    
+    def split_multipart(self, boundary, start, end):
+        """Границы тел вложенных частей multipart (перевод строки перед разделителем не входит)"""
+        raw = self.raw
+        marker = b'\n--' + boundary.encode('ascii', errors='replace')
+        # Первый разделитель может стоять в самом начале тела, без перевода строки
+        pos = start - 1 if raw.startswith(marker[1:], start) else raw.find(marker, start, end)
+        spans = []
+        part_start = None
+        while pos != -1:
+            line_start = pos + len(marker)
+            eol = raw.find(b'\n', line_start, end)
+            line_end = end if eol == -1 else eol
+            tail = raw[line_start:line_end].rstrip()
+            if tail not in (b'', b'--'):
+                # Граница с тем же началом, но длиннее - это не разделитель
+                pos = raw.find(marker, line_start, end)
+                continue
+            if part_start is not None:
+                part_end = pos - 1 if pos > part_start and raw[pos - 1] == 13 else pos
+                spans.append((part_start, max(part_start, part_end)))
+            if tail == b'--' or eol == -1:
+                return spans
+            part_start = eol + 1
+            pos = raw.find(marker, eol, end)
+        # Нет закрывающего разделителя - последняя часть тянется до конца
+        if part_start is not None:
+            spans.append((part_start, end))
+        return spans
+    
+    def iter_payload(self, part, chunk_bytes=None):
+        """Тело части без Content-Transfer-Encoding, кусками (7bit/8bit - срезы без копирования)"""
+        chunk_bytes = chunk_bytes or self.CHUNK_BYTES
+        decoder = TransferDecoder(part.encoding)
+        for offset in range(part.start, part.end, chunk_bytes):
+            data = decoder.feed(self.buffer[offset:min(offset + chunk_bytes, part.end)])
+            if data:
+                yield data
+        data = decoder.finish()
+        if data:
+            yield data
+    
+    def payload(self, part):
+        return b''.join(self.iter_payload(part))
+    
+    def release(self):
+        self.buffer.release()
+
+class AttachmentSpool:
+    """Данные вложения: в памяти до порога, дальше во временном файле на диске.
+    
+    Объект файлоподобный, поэтому отдается в telebot без копирования в BytesIO.
+    Все операции с файлом идут под self.lock: MemoryBudget может вытеснить
+    спул на диск из другого потока.
+    """
+    
+    def __init__(self, filename, budget, memory_threshold):
+        self.name = filename
+        self.budget = budget
+        self.file = tempfile.SpooledTemporaryFile(max_size=memory_threshold)
+        self.size = 0
+        self.reserved = 0
+        # Хэш считается по ходу записи - ключ кэша file_id без повторного чтения
+        self.digest = hashlib.sha256()
+        self.lock = threading.RLock()
+        budget.register(self)
+    
+    @property
+    def in_memory(self):
+        return not getattr(self.file, '_rolled', True)
+    
+    def write(self, data):
+        with self.lock:
+            if self.in_memory and not self.budget.try_acquire(len(data)):
+                self.rollover()
+            elif self.in_memory:
+                self.reserved += len(data)
+            self.file.write(data)
+            self.digest.update(data)
+            self.size += len(data)
+            # SpooledTemporaryFile сам ушел на диск по порогу - память больше не держим
+            if not self.in_memory and self.reserved:
+                self._release()
+    
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+    
+    def rollover(self):
+        with self.lock:
+            self.file.rollover()
+            self._release()
+    
+    def _release(self):
+        reserved, self.reserved = self.reserved, 0
+        if reserved:
+            self.budget.release(reserved)
+    
+    def open(self):
+        """Возвращает себя, перемотанным на начало, для отправки"""
+        with self.lock:
+            self.file.seek(0)
+        return self
+    
+    def read(self, size=-1):
+        with self.lock:
+            return self.file.read(size)
+    
+    def seek(self, offset, whence=0):
+        with self.lock:
+            return self.file.seek(offset, whence)
+    
+    def tell(self):
+        with self.lock:
+            return self.file.tell()
+    
+    def getvalue(self):
+        with self.lock:
+            self.file.seek(0)
+            return self.file.read()
+    
+    def copy_to(self, out):
+        """Копирует данные в открытый файл: из памяти - кусками, с диска - sendfile"""
+        with self.lock:
+            offset = 0
+            if not self.in_memory:
+                # fileno() у SpooledTemporaryFile вызывает rollover - только для файла на диске
+                self.file.flush()
+                try:
+                    while offset < self.size:
+                        sent = os.sendfile(out.fileno(), self.file.fileno(), offset, self.size - offset)
+                        if not sent:
+                            break
+                        offset += sent
+                except (AttributeError, OSError):
+                    # sendfile между файлами есть не везде (Windows, macOS)
+                    if offset:
+                        raise
+            if offset < self.size:
+                self.file.seek(offset)
+                shutil.copyfileobj(self.file, out)
+    
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self._release()
+
+def prepare_image(data, filename, max_dimension, max_bytes, image_format='JPEG', quality=85):
+    """Готовит изображение к send_photo; выполняется в отдельном процессе.
+    
+    Возвращает (действие, данные, имя файла): 'keep' - отправить как есть,
+    'photo' - отправить перекодированные данные, 'document' - как фото
+    не влезает в ограничения Telegram, отправить файлом.
+    """
+    from PIL import Image, ImageOps
+    
     try:
-        import imapclient
-        import telebot
-        from PIL import Image
+        # HEIC с iPhone открывается, только если установлен pillow-heif
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+    except ImportError:
+        pass
+    
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        # Ограничения Bot API для фото: сумма сторон до 10000, соотношение до 20
+        if max(width, height) > 20 * min(width, height):
+            return 'document', None, filename
+        if (image.format in ('JPEG', 'PNG', 'GIF', 'WEBP') and len(data) <= max_bytes
+                and max(width, height) <= max_dimension):
+            return 'keep', None, filename
+        
+        # JPEG декодируется сразу в уменьшенном масштабе (DCT scaling)
+        image.draft('RGB', (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            if image_format == 'JPEG':
+                # У JPEG нет прозрачности - подкладываем белый фон
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        
+        extension = '.webp' if image_format == 'WEBP' else '.jpg'
+        name = os.path.splitext(filename)[0] + extension
+        for scale in (1.0, 0.75, 0.5):
+            frame = image
+            if scale < 1.0:
+                size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+                frame = image.resize(size, Image.LANCZOS)
+            for step_quality in range(quality, 40, -10):
+                output = io.BytesIO()
+                frame.save(output, image_format, quality=step_quality, optimize=True)
+                if output.tell() <= max_bytes:
+                    return 'photo', output.getvalue(), name
+        return 'document', None, filename
+    except Exception as e:
+        # Дочерний процесс: очередь логов родителя здесь недоступна
+        print(f"Не удалось обработать изображение {filename}: {e}", file=sys.stderr)
+        return 'document', None, filename
+
+class RuntimeProfiler:
+    """cProfile, включаемый на ходу.
+    
+    Профилируется каждая задача, выполняемая в пулах потоков (команды IMAP,
+    разбор, отправка), результаты суммируются до выключения.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.stats = None
+    
+    def start(self):
+        with self.lock:
+            self.active = True
+            self.stats = None
+    
+    def stop(self, limit=40):
+        """Выключает профилирование и возвращает отчет по суммарному времени"""
+        with self.lock:
+            self.active = False
+            stats, self.stats = self.stats, None
+        if stats is None:
+            return "Профиль пуст: за время записи задач не было\n"
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+    
+    def call(self, func, *args):
+        if not self.active:
+            return func(*args)
+        import cProfile
+        import pstats
+        
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # В этом потоке уже работает другой профилировщик
+            return func(*args)
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.active:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+
+class Metrics:
+    """Счетчики, текущие значения и гистограммы задержек в формате Prometheus.
+    
+    Общие для всех папок процесса; метки передаются именованными аргументами.
+    """
+    
+    PREFIX = 'mail2tg_'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    # Задержка доставки считается от заголовка Date - это секунды и часы
+    DELAY_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 3600, 21600, 86400)
+    HELP = {
+        'stage_seconds': ('histogram', 'Длительность стадий обработки'),
+        'delivery_delay_seconds': ('histogram', 'Задержка от Date письма до ответа Telegram'),
+        'mails_total': ('counter', 'Обработанные письма по результату'),
+        'attachments_total': ('counter', 'Вложения по типу'),
+        'attachment_bytes_total': ('counter', 'Объем вложений'),
+        'errors_total': ('counter', 'Ошибки по стадиям'),
+        'telegram_retries_total': ('counter', 'Повторы запросов Bot API после 429'),
+        'telegram_requests_total': ('counter', 'Запросы Bot API по методу и HTTP-статусу'),
+        'rule_matches_total': ('counter', 'Срабатывания правил фильтрации'),
+        'archive_writes_total': ('counter', 'Вложения, переданные в архив, по результату'),
+        'archive_hits_total': ('counter', 'Вложения, взятые из архива вместо загрузки'),
+        'archive_evictions_total': ('counter', 'Файлы, вытесненные из архива'),
+        'archive_bytes': ('gauge', 'Объем архива вложений'),
+        'backlog': ('gauge', 'Новые письма, ожидающие доставки'),
+        'last_delivery_delay_seconds': ('gauge', 'Задержка доставки последнего письма'),
+    }
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # ключ -> [счетчики по корзинам, сумма, количество]
+        self.histograms = {}
+        self.last_summary = time.monotonic()
+        self.profiler = RuntimeProfiler()
+    
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+    
+    def observe(self, name, value, buckets=None, **labels):
+        buckets = buckets or self.BUCKETS
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][index] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+    
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Замеряет стадию; исключение внутри учитывается как ошибка стадии"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc('errors_total', stage=stage)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.observe('stage_seconds', duration, stage=stage, **labels)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f"Стадия {stage}: {duration * 1000:.1f} мс",
+                          extra={'stage': stage, 'duration': round(duration, 3)})
+    
+    def quantile(self, name, q, **labels):
+        """Оценка квантиля по корзинам (верхняя граница корзины); None - нет данных"""
+        buckets, counts, total = None, None, 0
+        with self.lock:
+            for (key_name, key_labels), (bounds, values, _, count) in self.histograms.items():
+                if key_name != name or not set(labels.items()) <= set(key_labels):
+                    continue
+                buckets = bounds
+                counts = values if counts is None else [a + b for a, b in zip(counts, values)]
+                total += count
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(buckets, counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float('inf')
+    
+    def total(self, name, **labels):
+        with self.lock:
+            return sum(
+                value for (key_name, key_labels), value in self.counters.items()
+                if key_name == name and set(labels.items()) <= set(key_labels)
+            )
+    
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+            for name, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+    
+    def render(self):
+        """Текст в формате экспозиции Prometheus"""
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: (bounds, list(values), total, count)
+                          for key, (bounds, values, total, count) in self.histograms.items()}
+        
+        lines = []
+        described = set()
+        
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, help_text = self.HELP.get(name, ('untyped', name))
+                lines.append(f"# HELP {self.PREFIX}{name} {help_text}")
+                lines.append(f"# TYPE {self.PREFIX}{name} {kind}")
+        
+        for (name, labels), value in sorted(list(counters.items()) + list(gauges.items())):
+            describe(name)
+            lines.append(f"{self.PREFIX}{name}{self.format_labels(labels)} {value}")
+        for (name, labels), (bounds, values, total, count) in sorted(histograms.items()):
+            describe(name)
+            cumulative = 0
+            for bound, value in zip(bounds, values):
+                cumulative += value
+                lines.append(f"{self.PREFIX}{name}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.PREFIX}{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.PREFIX}{name}_sum{self.format_labels(labels)} {total}")
+            lines.append(f"{self.PREFIX}{name}_count{self.format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+    
+    def summary(self):
+        def seconds(value):
+            return '-' if value is None else f"{value:g}с"
+        
+        with self.lock:
+            backlog = sum(value for (name, _), value in self.gauges.items() if name == 'backlog')
+        return (
+            f"писем доставлено {self.total('mails_total', status='delivered')}, "
+            f"ошибок доставки {self.total('mails_total', status='failed')}, "
+            f"вложений {self.total('attachments_total')} "
+            f"({self.total('attachment_bytes_total') / 1024 / 1024:.1f} МБ), "
+            f"повторов 429 {self.total('telegram_retries_total')}, "
+            f"ошибок {self.total('errors_total')}, в очереди {backlog}; "
+            f"разбор p95 {seconds(self.quantile('stage_seconds', 0.95, stage='parse'))}, "
+            f"Telegram p50/p95 {seconds(self.quantile('stage_seconds', 0.5, stage='telegram_request'))}/"
+            f"{seconds(self.quantile('stage_seconds', 0.95, stage='telegram_request'))}, "
+            f"доставка от Date p50 {seconds(self.quantile('delivery_delay_seconds', 0.5))}"
+        )
+    
+    def log_summary(self, interval):
+        """Печатает сводку не чаще раза в interval секунд (один раз на все папки)"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_summary < interval:
+                return
+            self.last_summary = now
+        log.info(f"📊 Метрики: {self.summary()}")
+
+class MetricsServer:
+    """HTTP на localhost: /metrics (Prometheus), /profile/start и /profile/stop (cProfile)"""
+    
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+    
+    def start(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        
+        metrics = self.metrics
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/metrics':
+                    body = metrics.render()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif path == '/profile/start':
+                    metrics.profiler.start()
+                    body = "Профилирование включено, отчет - /profile/stop\n"
+                    content_type = 'text/plain; charset=utf-8'
+                elif path == '/profile/stop':
+                    body = metrics.profiler.stop()
+                    content_type = 'text/plain; charset=utf-8'
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def log_message(self, format, *args):
+                # Запросы Prometheus не засоряют вывод
+                pass
+        
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            log.error(f"✗ Не удалось запустить сервер метрик на порту {self.port}: {e}")
+            return self
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        log.info(f"✓ Метрики: http://{self.host}:{self.port}/metrics")
+        return self
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity впрок"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+    
+    def reserve(self, cost=1):
+        """Забирает токены (допуская долг) и возвращает, сколько ждать до их появления"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        return max(wait, self.blocked_until - now)
+    
+    def block(self, seconds):
+        """Запрещает запросы на seconds секунд (ответ 429 с retry_after)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class TelegramRateLimiter:
+    """Ограничение частоты запросов к Bot API по опубликованным лимитам Telegram.
+    
+    Общее ведро на бота (~30 сообщений в секунду) и ведро на каждый чат:
+    1 сообщение в секунду в личный чат, 20 в минуту в группу. Ответ 429
+    не считается ошибкой: запрос повторяется после retry_after.
+    Ожидание идет в цикле событий (asyncio.sleep), в пул потоков запрос
+    попадает, только когда для него есть токены: чаты, упершиеся в лимит,
+    не занимают потоки, нужные IMAP.
+    """
+    
+    GLOBAL_RATE = 30
+    PRIVATE_CHAT_RATE = 1
+    GROUP_CHAT_RATE = 20 / 60
+    CHAT_BURST = 3
+    MAX_RETRIES = 5
+    
+    def __init__(self, metrics=None, limits=None):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        # Лимиты можно переопределить (например, для стенда с фейковым Bot API)
+        limits = limits or {}
+        self.global_rate = limits.get('global_rate', self.GLOBAL_RATE)
+        self.private_chat_rate = limits.get('private_chat_rate', self.PRIVATE_CHAT_RATE)
+        self.group_chat_rate = limits.get('group_chat_rate', self.GROUP_CHAT_RATE)
+        self.chat_burst = limits.get('chat_burst', self.CHAT_BURST)
+        self.global_bucket = TokenBucket(self.global_rate, self.global_rate)
+        self.chat_buckets = {}
+        self.waiting = 0
+    
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # У групп и каналов id отрицательный, для них лимит строже
+            rate = self.group_chat_rate if str(chat_id).startswith('-') else self.private_chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+    
+    @property
+    def queue_depth(self):
+        """Сколько запросов сейчас ждут своей очереди"""
+        return self.waiting
+    
+    async def acquire(self, chat_id, cost=1):
+        """Ждет (не занимая поток) момента, когда запрос укладывается в лимиты"""
+        with self.lock:
+            delay = max(self.global_bucket.reserve(cost), self.chat_bucket(chat_id).reserve(cost))
+            if delay > 0:
+                self.waiting += 1
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+    
+    @staticmethod
+    def retry_after(error):
+        """retry_after из ответа 429 или None для остальных ошибок"""
+        if getattr(error, 'error_code', None) != 429:
+            return None
+        result_json = getattr(error, 'result_json', None) or {}
+        return result_json.get('parameters', {}).get('retry_after', 1)
+    
+    async def call(self, chat_id, request, submit, cost=1):
+        """Выполняет request в пределах лимитов, переносит его при ответе 429.
+        
+        submit(request) - корутина, выполняющая блокирующий запрос (в пуле потоков).
+        """
+        for attempt in range(self.MAX_RETRIES + 1):
+            await self.acquire(chat_id, cost)
+            start = time.perf_counter()
+            try:
+                return await submit(request)
+            except Exception as e:
+                delay = self.retry_after(e)
+                if delay is None or attempt == self.MAX_RETRIES:
+                    if self.metrics:
+                        self.metrics.inc('errors_total', stage='telegram_request')
+                    raise
+                if self.metrics:
+                    self.metrics.inc('telegram_retries_total')
+                log.warning(f"Telegram просит подождать {delay} сек (429), запрос будет повторен")
+                with self.lock:
+                    self.chat_bucket(chat_id).block(delay)
+            finally:
+                if self.metrics:
+                    self.metrics.observe('stage_seconds', time.perf_counter() - start, stage='telegram_request')
+
+class MultipartStream:
+    """Тело multipart/form-data, которое читается кусками по ходу отправки.
+    
+    Файлы не собираются в памяти: длина известна заранее (Content-Length),
+    requests отдает объект в http.client, и тот читает его блоками.
+    """
+    
+    CHUNK_BYTES = 64 * 1024
+    
+    def __init__(self, fields, files):
+        self.boundary = os.urandom(16).hex()
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        # bytes или (файл, длина)
+        self.pieces = []
+        for name, value in (fields or {}).items():
+            if value is not None:
+                self.pieces.append(self.part_header(name) + str(value).encode('utf-8') + b'\r\n')
+        for name, value in files.items():
+            filename, fileobj = value[:2] if isinstance(value, tuple) else (None, value)
+            if not filename:
+                filename = getattr(fileobj, 'name', None)
+                filename = os.path.basename(filename) if isinstance(filename, str) else name
+            header = self.part_header(name, filename)
+            if isinstance(fileobj, str):
+                fileobj = fileobj.encode('utf-8')
+            if isinstance(fileobj, (bytes, bytearray, memoryview)):
+                self.pieces.append(header + bytes(fileobj) + b'\r\n')
+                continue
+            start = fileobj.tell()
+            fileobj.seek(0, os.SEEK_END)
+            size = fileobj.tell() - start
+            fileobj.seek(start)
+            self.pieces += [header, (fileobj, size), b'\r\n']
+        self.pieces.append(f"--{self.boundary}--\r\n".encode('ascii'))
+        self.length = sum(len(piece) if isinstance(piece, bytes) else piece[1] for piece in self.pieces)
+        self.index = 0
+        self.offset = 0
+    
+    @staticmethod
+    def quote(value):
+        # Экранирование имен как в HTML5 (так же делает urllib3)
+        return str(value).replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+    
+    def part_header(self, name, filename=None):
+        disposition = f'form-data; name="{self.quote(name)}"'
+        if filename is None:
+            return f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n\r\n".encode('utf-8')
+        return (
+            f"--{self.boundary}\r\nContent-Disposition: {disposition}; filename=\"{self.quote(filename)}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode('utf-8')
+    
+    def __len__(self):
+        return self.length
+    
+    def read(self, size=-1):
+        want = size if size is not None and size >= 0 else self.length
+        chunks = []
+        while want > 0 and self.index < len(self.pieces):
+            piece = self.pieces[self.index]
+            if isinstance(piece, bytes):
+                data = piece[self.offset:self.offset + want]
+                piece_size = len(piece)
+            else:
+                fileobj, piece_size = piece
+                data = fileobj.read(min(want, piece_size - self.offset))
+                if not data and self.offset < piece_size:
+                    raise IOError(f"файл {getattr(fileobj, 'name', '')} короче заявленной длины")
+            self.offset += len(data)
+            want -= len(data)
+            chunks.append(data)
+            if self.offset >= piece_size:
+                self.index += 1
+                self.offset = 0
+        return b''.join(chunks)
+    
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
+
+class BotApiSession:
+    """HTTP-клиент Bot API для telebot: один пул keep-alive соединений на процесс.
+    
+    По умолчанию telebot держит свою сессию requests в каждом потоке и
+    пересоздает ее по таймеру - под нагрузкой это новые TLS-рукопожатия.
+    Здесь одна сессия с пулом до pool_size соединений (при нехватке поток
+    ждет свободное), явные таймауты и потоковая отправка файлов.
+    Подключается через apihelper.CUSTOM_REQUEST_SENDER.
+    """
+    
+    def __init__(self, pool_size=8, connect_timeout=10, read_timeout=30, upload_timeout=120, metrics=None):
         import requests
-        from bs4 import BeautifulSoup
-        print("✓ Все зависимости установлены")
+        from requests.adapters import HTTPAdapter
+        
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Ответ на загрузку большого файла приходит только после его обработки
+        self.upload_timeout = upload_timeout
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    def install(self, apihelper):
+        apihelper.CUSTOM_REQUEST_SENDER = self.send
+        apihelper.CONNECT_TIMEOUT = self.connect_timeout
+        apihelper.READ_TIMEOUT = self.read_timeout
+        return self
+    
+    def send(self, method, url, params=None, files=None, timeout=None, proxies=None, **kwargs):
+        """Сигнатура как у requests.request; так telebot вызывает CUSTOM_REQUEST_SENDER"""
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+        else:
+            connect_timeout, read_timeout = self.connect_timeout, timeout or self.read_timeout
+        if files:
+            # Поля и файлы - потоковым multipart, а не строкой запроса
+            body = MultipartStream(params, files)
+            response = self.session.request(
+                'post', url, data=body, headers={'Content-Type': body.content_type},
+                timeout=(connect_timeout, max(read_timeout, self.upload_timeout)), proxies=proxies
+            )
+        elif method.lower() == 'post':
+            response = self.session.request('post', url, data=params, timeout=(connect_timeout, read_timeout), proxies=proxies)
+        else:
+            response = self.session.request(method, url, params=params, timeout=(connect_timeout, read_timeout), proxies=proxies)
+        if self.metrics:
+            self.metrics.inc('telegram_requests_total', method=url.rsplit('/', 1)[-1], status=response.status_code)
+        return response
+    
+    def close(self):
+        self.session.close()
+
+class SyncState:
+    """Состояние инкрементальной синхронизации папки: UIDVALIDITY и последний UID.
+    
+    unmarked - доставленные письма, которые не удалось пометить прочитанными: они
+    ниже отметки и поиском больше не найдутся, пометку повторяет следующий проход.
+    """
+    
+    # Файл общий для всех папок - чтение-изменение-запись по очереди
+    _save_lock = threading.Lock()
+    
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.uidvalidity = None
+        self.last_uid = 0
+        self.unmarked = set()
+        self.load()
+    
+    def load(self):
+        """Загружает состояние из файла (отсутствие файла - не ошибка)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f).get(self.key, {})
+            self.uidvalidity = data.get('uidvalidity')
+            self.last_uid = int(data.get('last_uid', 0))
+            self.unmarked = {int(uid) for uid in data.get('unmarked', [])}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error(f"✗ Не удалось прочитать состояние синхронизации {self.path}: {e}")
+    
+    def save(self):
+        """Атомарно сохраняет состояние, не затирая записи других папок"""
+        try:
+            with self._save_lock:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    data = {}
+                data[self.key] = {'uidvalidity': self.uidvalidity, 'last_uid': self.last_uid}
+                if self.unmarked:
+                    data[self.key]['unmarked'] = sorted(self.unmarked)
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.path)
+            return True
+        except Exception as e:
+            log.error(f"✗ Не удалось сохранить состояние синхронизации: {e}")
+            return False
+    
+    def reset(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.last_uid = 0
+        self.unmarked = set()
+
+class DeliveryJournal:
+    """Журнал доставки в SQLite (WAL): какие части письма уже ушли в Telegram.
+    
+    Частью считается текст, группа изображений или отдельный файл; запись
+    'done' означает, что письмо доставлено целиком. После падения доставка
+    продолжается с первой неотправленной части. Каждая запись фиксируется
+    сразу: в WAL с synchronous=NORMAL коммит не ждет fsync, а kill посреди
+    прохода не теряет уже отправленные части.
+    """
+    
+    DONE = 'done'
+    
+    def __init__(self, path, key):
+        self.key = key
+        self.uidvalidity = None
+        # uid -> множество отправленных частей
+        self.sent = {}
+        self.pending = []
+        self.prune_below = None
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS delivered_parts ('
+            ' mailbox TEXT NOT NULL, uidvalidity INTEGER NOT NULL, uid INTEGER NOT NULL,'
+            ' part TEXT NOT NULL, sent_at REAL NOT NULL,'
+            ' PRIMARY KEY (mailbox, uidvalidity, uid, part))'
+        )
+        self.db.commit()
+    
+    def load(self, uidvalidity):
+        """Загружает записи текущей эпохи папки, записи прежних UIDVALIDITY удаляет"""
+        with self.lock:
+            self.uidvalidity = uidvalidity
+            self.sent = {}
+            self.pending = []
+            self.db.execute(
+                'DELETE FROM delivered_parts WHERE mailbox = ? AND uidvalidity != ?',
+                (self.key, uidvalidity)
+            )
+            rows = self.db.execute(
+                'SELECT uid, part FROM delivered_parts WHERE mailbox = ? AND uidvalidity = ?',
+                (self.key, uidvalidity)
+            ).fetchall()
+            self.db.commit()
+            for uid, part in rows:
+                self.sent.setdefault(uid, set()).add(part)
+        if rows:
+            log.info(f"✓ Журнал доставки: {len(rows)} записей по {len(self.sent)} письмам")
+    
+    def is_sent(self, uid, part):
+        with self.lock:
+            return part in self.sent.get(uid, ())
+    
+    def record(self, uid, part):
+        with self.lock:
+            self.sent.setdefault(uid, set()).add(part)
+            self.pending.append((self.key, self.uidvalidity, uid, part, time.time()))
+            self._write_pending()
+    
+    def delivered_uids(self):
+        with self.lock:
+            return {uid for uid, parts in self.sent.items() if self.DONE in parts}
+    
+    def prune(self, last_uid):
+        """Забывает письма не выше отметки синхронизации (удаление - при flush)"""
+        with self.lock:
+            self.sent = {uid: parts for uid, parts in self.sent.items() if uid > last_uid}
+            self.prune_below = last_uid
+    
+    def flush(self):
+        """Дописывает то, что не записалось раньше, и удаляет забытые письма"""
+        with self.lock:
+            return self._write_pending()
+    
+    def _write_pending(self):
+        """Записывает накопленное одной транзакцией (вызывается под self.lock)"""
+        pending, self.pending = self.pending, []
+        prune_below, self.prune_below = self.prune_below, None
+        if not pending and prune_below is None:
+            return True
+        try:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO delivered_parts VALUES (?, ?, ?, ?, ?)', pending)
+                if prune_below is not None:
+                    self.db.execute(
+                        'DELETE FROM delivered_parts WHERE mailbox = ? AND uid <= ?',
+                        (self.key, prune_below)
+                    )
+            return True
+        except Exception as e:
+            # Не записалось - попробуем при следующей записи
+            self.pending = pending + self.pending
+            if prune_below is not None and self.prune_below is None:
+                self.prune_below = prune_below
+            log.error(f"✗ Не удалось записать журнал доставки: {e}")
+            return False
+    
+    def close(self):
+        self.flush()
+        self.db.close()
+
+class ArchivedAttachment:
+    """Вложение из архива: файл отображается в память (mmap), без чтения в буфер.
+    
+    Интерфейс как у AttachmentSpool - отдается в telebot и prepare_image.
+    """
+    
+    in_memory = False
+    
+    def __init__(self, filename, path, sha256):
+        self.name = filename
+        self.sha256 = sha256
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def open(self):
+        self.map.seek(0)
+        return self
+    
+    def read(self, size=-1):
+        return self.map.read(size)
+    
+    def seek(self, offset, whence=0):
+        self.map.seek(offset, whence)
+        return self.map.tell()
+    
+    def tell(self):
+        return self.map.tell()
+    
+    def getvalue(self):
+        return self.map[:]
+    
+    def copy_to(self, out):
+        out.write(self.map)
+    
+    def close(self):
+        if not self.map.closed:
+            self.map.close()
+
+class AttachmentArchive:
+    """Архив вложений на диске: файлы по SHA-256 содержимого и индекс письмо -> части.
+    
+    Файлы лежат в objects/ab/cd/<sha256>, одинаковые вложения хранятся один
+    раз. Спул после доставки передается архиву вместо закрытия, а пишет его
+    фоновый поток - запись не задерживает отправку. Сверх max_bytes и старше
+    max_age секунд вытесняются файлы, которые дольше всех не использовались.
+    """
+    
+    # Вытеснение оставляет запас, чтобы не чистить архив на каждой записи
+    EVICT_TO = 0.9
+    EXPIRE_INTERVAL = 3600
+    
+    def __init__(self, root, max_bytes, max_age=0, metrics=None):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.metrics = metrics
+        os.makedirs(self.objects_dir, exist_ok=True)
+        # Индекс читают потоки загрузки, пишет фоновый поток
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(root, 'index.db'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS blobs ('
+            ' sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS parts ('
+            ' mailbox TEXT NOT NULL, uidvalidity INTEGER NOT NULL, uid INTEGER NOT NULL,'
+            ' part TEXT NOT NULL, filename TEXT, type TEXT, sha256 TEXT NOT NULL,'
+            ' PRIMARY KEY (mailbox, uidvalidity, uid, part))'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS parts_sha256 ON parts (sha256)')
+        self.db.commit()
+        self.total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        self.last_expire = 0
+        self.queue = queue.Queue()
+        threading.Thread(target=self.write_loop, name="attachment-archive", daemon=True).start()
+    
+    def blob_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256[2:4], sha256)
+    
+    def store(self, key, file_info):
+        """Передает вложение архиву; спул закроет фоновый поток после записи.
+        
+        key - (папка, UIDVALIDITY, UID, часть письма).
+        """
+        self.queue.put((key, file_info))
+    
+    def flush(self):
+        """Ждет, пока фоновый поток запишет все переданные вложения"""
+        self.queue.join()
+    
+    def open(self, key, filename):
+        """Вложение письма из архива (ArchivedAttachment) или None"""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT sha256 FROM parts WHERE mailbox = ? AND uidvalidity = ? AND uid = ? AND part = ?', key
+            ).fetchone()
+            if row is None:
+                return None
+            with self.db:
+                self.db.execute('UPDATE blobs SET last_used = ? WHERE sha256 = ?', (time.time(), row[0]))
+        try:
+            attachment = ArchivedAttachment(filename, self.blob_path(row[0]), row[0])
+        except (OSError, ValueError):
+            # Файл удален вручную или пустой - загрузим заново
+            return None
+        if self.metrics:
+            self.metrics.inc('archive_hits_total')
+        return attachment
+    
+    def write_loop(self):
+        while True:
+            key, file_info = self.queue.get()
+            try:
+                self.write(key, file_info)
+            except Exception as e:
+                log.error(f"✗ Не удалось сохранить вложение {file_info['filename']} в архив: {e}")
+            finally:
+                file_info['spool'].close()
+                self.queue.task_done()
+    
+    def write(self, key, file_info):
+        spool = file_info['spool']
+        sha256 = spool.sha256
+        now = time.time()
+        with self.lock:
+            known = self.db.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        if not known:
+            path = self.blob_path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as out:
+                spool.copy_to(out)
+            os.replace(tmp_path, path)
+        
+        with self.lock:
+            with self.db:
+                if known:
+                    self.db.execute('UPDATE blobs SET last_used = ? WHERE sha256 = ?', (now, sha256))
+                else:
+                    self.db.execute('INSERT INTO blobs VALUES (?, ?, ?)', (sha256, spool.size, now))
+                    self.total += spool.size
+                self.db.execute(
+                    'INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    tuple(key) + (file_info['filename'], file_info['type'], sha256)
+                )
+        if self.metrics:
+            self.metrics.inc('archive_writes_total', status='dedup' if known else 'stored')
+            self.metrics.set('archive_bytes', self.total)
+        
+        if self.total > self.max_bytes or (self.max_age and now - self.last_expire >= self.EXPIRE_INTERVAL):
+            self.evict(now)
+    
+    def evict(self, now):
+        """Удаляет файлы старше max_age и давно не использованные сверх лимита объема"""
+        with self.lock:
+            victims = []
+            if self.max_age and now - self.last_expire >= self.EXPIRE_INTERVAL:
+                self.last_expire = now
+                victims = self.db.execute(
+                    'SELECT sha256, size FROM blobs WHERE last_used < ?', (now - self.max_age,)
+                ).fetchall()
+            remaining = self.total - sum(size for _, size in victims)
+            if remaining > self.max_bytes:
+                expired = {sha256 for sha256, _ in victims}
+                excess = remaining - int(self.max_bytes * self.EVICT_TO)
+                for sha256, size in self.db.execute('SELECT sha256, size FROM blobs ORDER BY last_used').fetchall():
+                    if excess <= 0:
+                        break
+                    if sha256 not in expired:
+                        victims.append((sha256, size))
+                        excess -= size
+            
+            removed = []
+            for sha256, size in victims:
+                try:
+                    os.remove(self.blob_path(sha256))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # Файл открыт (Windows) - удалим при следующей чистке
+                    continue
+                removed.append((sha256, size))
+            if not removed:
+                return
+            with self.db:
+                self.db.executemany('DELETE FROM parts WHERE sha256 = ?', [(sha256,) for sha256, _ in removed])
+                self.db.executemany('DELETE FROM blobs WHERE sha256 = ?', [(sha256,) for sha256, _ in removed])
+            freed = sum(size for _, size in removed)
+            self.total -= freed
+        
+        log.info(f"Архив вложений: вытеснено файлов - {len(removed)}, {freed / (1024 * 1024):.1f} МБ")
+        if self.metrics:
+            self.metrics.inc('archive_evictions_total', len(removed))
+            self.metrics.set('archive_bytes', self.total)
+    
+    def stats(self):
+        with self.lock:
+            count = self.db.execute('SELECT COUNT(*) FROM blobs').fetchone()[0]
+        return f"архив вложений: {count} файлов, {self.total / (1024 * 1024):.1f} из {self.max_bytes / (1024 * 1024):.0f} МБ"
+
+class TextCache:
+    """LRU-кэш строк по хэшу содержимого: очищенный текст писем, file_id Telegram.
+    
+    Рассылки и уведомления часто приходят с одинаковым HTML: повтор
+    шаблона стоит поиска по SHA-256 вместо разбора. Размер ограничен
+    суммой байт записей (UTF-8), старые вытесняются. Если задан path,
+    кэш сохраняется в JSON и переживает перезапуск.
+    """
+    
+    def __init__(self, max_bytes, path=None, label="кэш текста"):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.label = label
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        # Разбор писем идет в нескольких потоках
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+    
+    @staticmethod
+    def make_key(content, *params):
+        """Ключ: хэш декодированного тела плюс параметры, влияющие на результат"""
+        digest = hashlib.sha256(content.encode('utf-8', 'surrogatepass')).hexdigest()
+        return ':'.join([digest] + [str(param) for param in params])
+    
+    @staticmethod
+    def entry_size(key, value):
+        return len(key) + len(value.encode('utf-8', 'surrogatepass'))
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, value):
+        size = self.entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+            self.dirty = True
+    
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+                self.dirty = True
+    
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return (f"{self.label}: {len(self.entries)} записей, {self.size / 1024:.0f} КБ, "
+                f"попаданий {self.hits}/{total} ({ratio:.0f}%)")
+    
+    def load(self):
+        """Загружает сохраненный кэш (отсутствие файла - не ошибка)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Записи сохранены от старых к новым - порядок LRU восстанавливается
+            for key, value in data.get('entries', []):
+                self.put(key, value)
+            self.dirty = False
+            log.info(f"✓ Загружен {self.stats()}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error(f"✗ Не удалось прочитать {self.label} {self.path}: {e}")
+    
+    def save(self):
+        """Атомарно сохраняет кэш, если он менялся"""
+        if not self.path or not self.dirty:
+            return True
+        try:
+            with self.lock:
+                entries = [[key, value] for key, (value, _) in self.entries.items()]
+                self.dirty = False
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'entries': entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            return True
+        except Exception as e:
+            self.dirty = True
+            log.error(f"✗ Не удалось сохранить {self.label}: {e}")
+            return False
+
+class MailRule:
+    """Скомпилированное правило: действие, чат и число условий"""
+    
+    def __init__(self, number, name, action, chat_id, conditions):
+        self.number = number
+        self.name = name
+        self.action = action
+        self.chat_id = chat_id
+        self.conditions = conditions
+        self.matches = 0
+
+class MailRules:
+    """Правила фильтрации и маршрутизации по заголовкам письма.
+    
+    Проверяются до загрузки тела, поэтому отброшенные письма не скачиваются.
+    Правило срабатывает, если выполнены все его условия (внутри условия -
+    любое из значений); из сработавших побеждает первое по порядку.
+    Адреса, домены и ключевые слова темы (по первому слову) собраны
+    в словари, так что проверка не дорожает с числом правил.
+    
+        [[rules]]
+        name = "рассылки"
+        from_domain = ["news.example.com"]   # домен и его поддомены
+        action = "drop"                      # drop, mark_read, route, forward
+    """
+    
+    ACTIONS = ('forward', 'route', 'drop', 'mark_read')
+    # Действия, при которых тело письма не загружается
+    SKIP_ACTIONS = ('drop', 'mark_read')
+    CONDITIONS = ('from', 'from_domain', 'to', 'subject')
+    # Заголовки, которых достаточно для проверки правил
+    HEADER_FIELDS = ('FROM', 'TO', 'CC', 'SUBJECT')
+    WORD_RE = re.compile(r'\w+')
+    
+    def __init__(self, rules):
+        self.rules = []
+        # условие -> значение -> номера правил
+        self.index = {condition: {} for condition in self.CONDITIONS}
+        # Первое правило без условий срабатывает всегда
+        self.fallback = None
+        for number, config in enumerate(rules):
+            self.rules.append(self.compile_rule(number, config))
+        self.keywords = self.compile_keywords(self.index['subject'])
+    
+    @classmethod
+    def from_config(cls, rules):
+        return cls(rules) if rules else None
+    
+    def compile_rule(self, number, config):
+        name = str(config.get('name') or f"правило {number + 1}")
+        unknown = set(config) - set(self.CONDITIONS) - {'name', 'action', 'chat_id'}
+        if unknown:
+            raise ValueError(f"{name}: неизвестные ключи {', '.join(sorted(unknown))}")
+        action = config.get('action', 'route' if config.get('chat_id') else 'forward')
+        if action not in self.ACTIONS:
+            raise ValueError(f"{name}: неизвестное действие {action}")
+        if action == 'route' and not config.get('chat_id'):
+            raise ValueError(f"{name}: для route нужен chat_id")
+        
+        conditions = 0
+        for condition in self.CONDITIONS:
+            values = config.get(condition)
+            if not values:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            conditions += 1
+            for value in values:
+                value = str(value).strip().lower()
+                if condition == 'from_domain':
+                    value = value.lstrip('@.')
+                self.index[condition].setdefault(value, set()).add(number)
+        if not conditions and self.fallback is None:
+            self.fallback = number
+        return MailRule(number, name, action, config.get('chat_id'), conditions)
+    
+    @classmethod
+    def compile_keywords(cls, keywords):
+        """Первое слово ключевой фразы -> [(фраза, смещение слова в ней, номера правил)]"""
+        by_word = {}
+        for keyword, numbers in keywords.items():
+            word = cls.WORD_RE.search(keyword)
+            if word is None:
+                raise ValueError(f"ключевое слово без букв и цифр: {keyword!r}")
+            by_word.setdefault(word.group(), []).append((keyword, word.start(), numbers))
+        return by_word
+    
+    @staticmethod
+    def is_word_char(text, position):
+        return 0 <= position < len(text) and (text[position].isalnum() or text[position] == '_')
+    
+    def match_subject(self, subject):
+        """Номера правил, чьи ключевые фразы входят в тему целыми словами"""
+        numbers = set()
+        text = subject.lower()
+        for word in self.WORD_RE.finditer(text):
+            for keyword, offset, keyword_numbers in self.keywords.get(word.group(), ()):
+                start = word.start() - offset
+                end = start + len(keyword)
+                if (start >= 0 and text.startswith(keyword, start)
+                        and not self.is_word_char(text, start - 1) and not self.is_word_char(text, end)):
+                    numbers |= keyword_numbers
+        return numbers
+    
+    def match(self, senders, recipients, subject):
+        """Первое сработавшее правило или None; адреса - в нижнем регистре"""
+        index = self.index
+        matched = []
+        
+        by_address, by_domain = set(), set()
+        for address in senders:
+            by_address.update(index['from'].get(address, ()))
+            # a.mail.example.com -> mail.example.com -> example.com -> com
+            domain = address.rpartition('@')[2]
+            while domain:
+                by_domain.update(index['from_domain'].get(domain, ()))
+                domain = domain.partition('.')[2]
+        matched += [by_address, by_domain]
+        
+        by_recipient = set()
+        for address in recipients:
+            by_recipient.update(index['to'].get(address, ()))
+        matched.append(by_recipient)
+        
+        if subject and self.keywords:
+            matched.append(self.match_subject(subject))
+        
+        counts = Counter()
+        for numbers in matched:
+            counts.update(numbers)
+        best = self.fallback
+        for number, count in counts.items():
+            if count == self.rules[number].conditions and (best is None or number < best):
+                best = number
+        if best is None:
+            return None
+        rule = self.rules[best]
+        rule.matches += 1
+        return rule
+    
+    def match_message(self, msg):
+        """Проверка по заголовкам письма, разобранного с email.policy.default"""
+        senders = [address.lower() for _, address in getaddresses(msg.get_all('From', [])) if address]
+        recipients = [
+            address.lower()
+            for _, address in getaddresses(msg.get_all('To', []) + msg.get_all('Cc', []))
+            if address
+        ]
+        return self.match(senders, recipients, str(msg.get('Subject') or ''))
+    
+    def stats(self):
+        counts = ", ".join(f"{rule.name} {rule.matches}" for rule in self.rules if rule.matches)
+        return f"правила: {counts or 'не срабатывали'}"
+
+class ImapSession:
+    """Долгоживущее IMAP-соединение с IDLE (RFC 2177) и переподключением"""
+    
+    # RFC 2177: сервер может разорвать IDLE через 30 минут, перевзводим раньше
+    IDLE_REARM_SECONDS = 25 * 60
+    MAX_BACKOFF_SECONDS = 300
+    # Ограничения одной пакетной команды FETCH
+    FETCH_BATCH_MAX_MESSAGES = 50
+    FETCH_BATCH_MAX_BYTES = 20 * 1024 * 1024
+    
+    def __init__(self, email_config, mailbox="INBOX"):
+        self.email_config = email_config
+        self.mailbox = mailbox
+        self.host = email_config.get('imap_host', "imap.yandex.ru")
+        self.port = email_config.get('imap_port', 993)
+        # Без TLS - только для локальных стендов (bench/fake_imap.py)
+        self.ssl = email_config.get('imap_ssl', True)
+        # Зависший сервер не должен навсегда занять поток из общего пула
+        self.timeout = email_config.get('imap_timeout', 120)
+        self.mail = None
+        self.capabilities = set()
+        self.uidvalidity = None
+        self.idle_tag = None
+        self.failures = 0
+    
+    def connect(self):
+        """Подключение, авторизация и выбор папки"""
+        try:
+            log.info("Подключение к Яндекс.Почте...")
+            imap_class = imaplib.IMAP4_SSL if self.ssl else imaplib.IMAP4
+            mail = imap_class(self.host, self.port, timeout=self.timeout)
+            mail.login(self.email_config['email'], self.email_config['password'])
+            status, data = mail.select(self.encode_mailbox_name(self.mailbox))
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"папка {self.mailbox} недоступна: {data}")
+            self.mail = mail
+            _, data = mail.response('UIDVALIDITY')
+            self.uidvalidity = int(data[0]) if data and data[0] else None
+            # После LOGIN сервер может расширить список возможностей
+            self.capabilities = set(mail.capabilities)
+            try:
+                status, data = mail.capability()
+                if status == 'OK' and data and data[0]:
+                    self.capabilities = set(data[0].decode('ascii', errors='ignore').upper().split())
+            except Exception:
+                pass
+            log.info("✓ Успешно подключено к Яндекс.Почте")
+            return True
+        except Exception as e:
+            log.error(f"✗ Ошибка подключения к почте: {e}")
+            self.close()
+            return False
+    
+    def backoff_delay(self):
+        """Пауза перед очередной попыткой подключения (экспоненциальная, с разбросом)"""
+        if not self.failures:
+            return 0
+        delay = min(self.MAX_BACKOFF_SECONDS, 2 ** (self.failures - 1))
+        return delay * random.uniform(0.8, 1.2)
+    
+    def ensure_connected(self, wait=True):
+        """Возвращает живое соединение, при необходимости переподключается.
+        
+        wait=False - паузу перед повтором уже выдержал вызывающий код.
+        """
+        if self.mail is not None:
+            return True
+        
+        delay = self.backoff_delay() if wait else 0
+        if delay:
+            log.warning(f"Повторное подключение через {delay:.0f} сек...")
+            time.sleep(delay)
+        
+        if self.connect():
+            self.failures = 0
+            return True
+        
+        self.failures += 1
+        return False
+    
+    def close(self):
+        """Закрывает соединение без выброса исключений"""
+        mail, self.mail = self.mail, None
+        if mail is None:
+            return
+        if self.idle_tag is not None:
+            # Прерванный IDLE: сервер ждет DONE, а не CLOSE/LOGOUT - просто рвем соединение
+            self.idle_tag = None
+            try:
+                mail.shutdown()
+            except Exception:
+                pass
+            return
+        try:
+            mail.close()
+        except Exception:
+            pass
+        try:
+            mail.logout()
+        except Exception:
+            pass
+    
+    def supports_idle(self):
+        return self.mail is not None and 'IDLE' in self.capabilities
+    
+    def has_pending_changes(self):
+        """Есть ли уже полученные, но не обработанные уведомления о новых письмах"""
+        if self.mail is None:
+            return False
+        pending = False
+        for name in ('EXISTS', 'RECENT'):
+            if self.mail.untagged_responses.pop(name, None):
+                pending = True
+        return pending
+    
+    def reset_pending_changes(self):
+        """Сбрасывает уведомления, которые будут покрыты ближайшим поиском"""
+        self.has_pending_changes()
+    
+    @staticmethod
+    def encode_mailbox_name(name):
+        """Имя папки для SELECT: modified UTF-7 (RFC 3501, 5.1.3), в кавычках при необходимости"""
+        result = []
+        pending = []
+        
+        def flush():
+            if pending:
+                encoded = base64.b64encode(''.join(pending).encode('utf-16-be')).rstrip(b'=')
+                result.append('&' + encoded.decode('ascii').replace('/', ',') + '-')
+                pending.clear()
+        
+        for char in name:
+            if 0x20 <= ord(char) <= 0x7e:
+                flush()
+                result.append('&-' if char == '&' else char)
+            else:
+                pending.append(char)
+        flush()
+        
+        encoded = ''.join(result)
+        if not encoded or re.search(r'[\s"\\(){%*\]]', encoded):
+            encoded = '"' + encoded.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        return encoded
+    
+    @staticmethod
+    def format_uid_set(uids):
+        """Сворачивает UID в компактный набор IMAP: [1, 2, 3, 7] -> 1:3,7"""
+        ranges = []
+        for uid in sorted(set(uids)):
+            if ranges and uid == ranges[-1][1] + 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        return ','.join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+    
+    @staticmethod
+    def iter_fetch_literals(data):
+        """Потоково разбирает ответ FETCH, выдавая пары (uid, литерал)"""
+        for index, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            prefix, literal = item
+            match = re.search(rb'UID (\d+)', prefix)
+            # Некоторые серверы присылают UID после литерала
+            if not match and index + 1 < len(data) and isinstance(data[index + 1], bytes):
+                match = re.search(rb'UID (\d+)', data[index + 1])
+            if match:
+                yield int(match.group(1)), literal
+    
+    # Токены ответа IMAP: скобки, строки в кавычках, маркер литерала и атомы
+    # (атом может содержать секцию BODY[...] со скобками и смещение <n>)
+    FETCH_TOKEN_RE = re.compile(
+        rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+        rb'|\{(?P<literal>\d+)\}\s*$|(?P<atom>[^\s()"\[]+(?:\[[^\]]*\])?(?:<\d+>)?))'
+    )
+    
+    @classmethod
+    def parse_fetch_items(cls, data):
+        """Разбирает ответ FETCH с литералами в словари атрибутов, по одному на письмо.
+        
+        Атомы и строки в кавычках становятся str (NIL - None),
+        литералы остаются bytes, вложенные скобки - списками.
+        """
+        stack = []
+        segments = []
+        for element in data:
+            if isinstance(element, tuple):
+                segments.append(element)
+            elif element:
+                segments.append((element, None))
+        
+        for text, literal in segments:
+            pos = 0
+            while pos < len(text):
+                match = cls.FETCH_TOKEN_RE.match(text, pos)
+                if not match or match.end() == pos:
+                    break
+                pos = match.end()
+                if match.group('open') is not None:
+                    stack.append([])
+                elif match.group('close') is not None:
+                    if not stack:
+                        continue
+                    done = stack.pop()
+                    if stack:
+                        stack[-1].append(done)
+                    else:
+                        yield cls._fetch_list_to_dict(done)
+                elif match.group('literal') is not None:
+                    if stack:
+                        stack[-1].append(literal if literal is not None else b'')
+                elif stack:
+                    if match.group('quoted') is not None:
+                        value = re.sub(rb'\\(.)', rb'\1', match.group('quoted'))
+                        stack[-1].append(value.decode('utf-8', errors='replace'))
+                    else:
+                        atom = match.group('atom').decode('ascii', errors='replace')
+                        stack[-1].append(None if atom.upper() == 'NIL' else atom)
+    
+    @staticmethod
+    def _fetch_list_to_dict(items):
+        """(UID 5 BODY[HEADER] ...) -> {'UID': '5', 'BODY[HEADER]': ...}"""
+        result = {}
+        for i in range(0, len(items) - 1, 2):
+            key = items[i]
+            if isinstance(key, str):
+                # BODY[1]<0> -> BODY[1]; имя секции приводим к верхнему регистру
+                result[re.sub(r'<\d+>$', '', key).upper()] = items[i + 1]
+        return result
+    
+    @staticmethod
+    def _as_text(value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8', errors='replace')
+        return value
+    
+    @classmethod
+    def _params_to_dict(cls, node):
+        """("name" "value" ...) -> {'name': 'value'} с поддержкой RFC 2231"""
+        params = {}
+        if not isinstance(node, list):
+            return params
+        for i in range(0, len(node) - 1, 2):
+            params[str(cls._as_text(node[i])).lower()] = cls._as_text(node[i + 1])
+        
+        # filename*0*, filename*1* ... и filename*=utf-8''... собираем обратно
+        continued = {}
+        for key in sorted(k for k in params if '*' in k):
+            base, _, rest = key.partition('*')
+            order = rest.rstrip('*')
+            continued.setdefault(base, []).append((int(order) if order.isdigit() else 0, key))
+        for base, keys in continued.items():
+            value = ''.join(params.pop(key) or '' for _, key in sorted(keys))
+            if any(key.endswith('*') for _, key in keys) and value.count("'") >= 2:
+                charset, _, encoded = value.split("'", 2)
+                try:
+                    value = urllib.parse.unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+                except LookupError:
+                    value = urllib.parse.unquote(encoded, errors='replace')
+            params[base] = value
+        return params
+    
+    @classmethod
+    def parse_bodystructure(cls, node, section=''):
+        """Плоский список частей письма из BODYSTRUCTURE с номерами секций"""
+        if not isinstance(node, list) or not node:
+            raise ValueError("пустой BODYSTRUCTURE")
+        
+        # multipart: (часть)(часть)... "subtype" ...
+        if isinstance(node[0], list):
+            parts = []
+            index = 0
+            for child in node:
+                if not isinstance(child, list):
+                    break
+                index += 1
+                parts.extend(cls.parse_bodystructure(child, f"{section}.{index}" if section else str(index)))
+            return parts
+        
+        maintype = str(cls._as_text(node[0]) or 'text').lower()
+        subtype = str(cls._as_text(node[1]) or 'plain').lower()
+        
+        # Вложенное письмо: разбираем его тело, как email.walk() и MimeIndex.
+        # Части составного тела - section.N, единственная часть - section.1 (RFC 3501)
+        if (maintype, subtype) == ('message', 'rfc822') and len(node) > 8 and isinstance(node[8], list) and node[8]:
+            prefix = section or '1'
+            if isinstance(node[8][0], list):
+                return cls.parse_bodystructure(node[8], prefix)
+            return cls.parse_bodystructure(node[8], f"{prefix}.1")
+        
+        params = cls._params_to_dict(node[2])
+        encoding = str(cls._as_text(node[5]) or '7bit').lower()
+        size = int(node[6]) if node[6] and str(node[6]).isdigit() else 0
+        
+        # Расширенные поля: у text/* есть число строк, у message/rfc822 - еще конверт и тело
+        if maintype == 'text':
+            ext_index = 8
+        elif (maintype, subtype) == ('message', 'rfc822'):
+            ext_index = 10
+        else:
+            ext_index = 7
+        
+        disposition = None
+        disposition_params = {}
+        disposition_node = node[ext_index + 1] if len(node) > ext_index + 1 else None
+        if isinstance(disposition_node, list) and disposition_node:
+            disposition = str(cls._as_text(disposition_node[0]) or '').lower() or None
+            if len(disposition_node) > 1:
+                disposition_params = cls._params_to_dict(disposition_node[1])
+        
+        return [{
+            'section': section or '1',
+            'type': f"{maintype}/{subtype}",
+            'charset': params.get('charset'),
+            'encoding': encoding,
+            'size': size,
+            'disposition': disposition,
+            'filename': disposition_params.get('filename') or params.get('name'),
+        }]
+    
+    def fetch_structures(self, uids):
+        """Пакетно загружает заголовки и BODYSTRUCTURE без тел писем"""
+        for start in range(0, len(uids), self.FETCH_BATCH_MAX_MESSAGES):
+            batch = uids[start:start + self.FETCH_BATCH_MAX_MESSAGES]
+            status, data = self.mail.uid(
+                'FETCH', self.format_uid_set(batch),
+                '(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER])'
+            )
+            if status != 'OK':
+                log.error(f"✗ Ошибка получения структуры писем {self.format_uid_set(batch)}")
+                continue
+            for item in self.parse_fetch_items(data):
+                if item.get('UID'):
+                    yield item
+    
+    def fetch_header_fields(self, uids, fields):
+        """Пакетно загружает только перечисленные заголовки: пары (UID, байты)"""
+        item_name = f"BODY.PEEK[HEADER.FIELDS ({' '.join(fields)})]"
+        for start in range(0, len(uids), self.FETCH_BATCH_MAX_MESSAGES):
+            batch = uids[start:start + self.FETCH_BATCH_MAX_MESSAGES]
+            status, data = self.mail.uid('FETCH', self.format_uid_set(batch), f"(UID {item_name})")
+            if status != 'OK':
+                log.error(f"✗ Ошибка получения заголовков писем {self.format_uid_set(batch)}")
+                continue
+            for item in self.parse_fetch_items(data):
+                header = next(
+                    (value for key, value in item.items() if key.startswith('BODY[HEADER.FIELDS')), None
+                )
+                if item.get('UID') and isinstance(header, bytes):
+                    yield int(item['UID']), header
+    
+    def fetch_part(self, uid, section, max_bytes=None, offset=0):
+        """Загружает одну секцию письма (целиком или max_bytes байт со смещения)"""
+        item_name = f"BODY.PEEK[{section}]"
+        if max_bytes:
+            item_name += f"<{offset}.{max_bytes}>"
+        status, data = self.mail.uid('FETCH', str(uid), f"(UID {item_name})")
+        if status != 'OK':
+            return None
+        for item in self.parse_fetch_items(data):
+            value = item.get(f"BODY[{section}]")
+            if value is not None:
+                return value if isinstance(value, bytes) else str(value).encode('utf-8')
+        return None
+    
+    def fetch_sections(self, uids, section, max_bytes=None):
+        """Одна секция (или ее начало) у нескольких писем одним запросом: {UID: байты}"""
+        item_name = f"BODY.PEEK[{section}]"
+        if max_bytes:
+            item_name += f"<0.{max_bytes}>"
+        status, data = self.mail.uid('FETCH', self.format_uid_set(uids), f"(UID {item_name})")
+        sections = {}
+        if status != 'OK':
+            return sections
+        for item in self.parse_fetch_items(data):
+            value = item.get(f"BODY[{section}]")
+            if item.get('UID') and value is not None:
+                sections[int(item['UID'])] = value if isinstance(value, bytes) else str(value).encode('utf-8')
+        return sections
+    
+    def fetch_sizes(self, uids):
+        """Размеры писем (RFC822.SIZE) одним запросом"""
+        status, data = self.mail.uid('FETCH', self.format_uid_set(uids), '(UID RFC822.SIZE)')
+        sizes = {}
+        if status != 'OK':
+            return sizes
+        for item in data:
+            line = item[0] if isinstance(item, tuple) else item
+            if not line:
+                continue
+            uid_match = re.search(rb'UID (\d+)', line)
+            size_match = re.search(rb'RFC822\.SIZE (\d+)', line)
+            if uid_match and size_match:
+                sizes[int(uid_match.group(1))] = int(size_match.group(1))
+        return sizes
+    
+    def plan_fetch_batches(self, uids, sizes):
+        """Делит UID на пакеты, ограниченные числом писем и суммарным размером"""
+        batches = []
+        batch, batch_bytes = [], 0
+        for uid in uids:
+            size = sizes.get(uid, 0)
+            if batch and (len(batch) >= self.FETCH_BATCH_MAX_MESSAGES or
+                          batch_bytes + size > self.FETCH_BATCH_MAX_BYTES):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(uid)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+    
+    def fetch_messages(self, uids):
+        """Пакетно загружает письма, выдавая (uid, сырые байты) по мере разбора.
+        
+        PEEK не ставит \\Seen: недоставленное письмо останется непрочитанным.
+        """
+        sizes = self.fetch_sizes(uids) if len(uids) > 1 else {}
+        for batch in self.plan_fetch_batches(uids, sizes):
+            status, data = self.mail.uid('FETCH', self.format_uid_set(batch), '(UID BODY.PEEK[])')
+            if status != 'OK':
+                log.error(f"✗ Ошибка получения пакета писем {self.format_uid_set(batch)}")
+                continue
+            yield from self.iter_fetch_literals(data)
+    
+    def has_buffered_data(self):
+        """SSL мог уже расшифровать данные в свой буфер - select их не увидит"""
+        sock = self.mail.socket()
+        return hasattr(sock, 'pending') and sock.pending() > 0
+    
+    def idle_start(self):
+        """Входит в IDLE. False - уведомления уже есть, ждать не нужно"""
+        if self.has_pending_changes():
+            return False
+        
+        mail = self.mail
+        tag = mail._new_tag()
+        mail.send(tag + b' IDLE\r\n')
+        
+        # Ждем подтверждения "+ idling"
+        while mail._get_response() is not None:
+            if mail.tagged_commands.get(tag):
+                typ, data = mail.tagged_commands.pop(tag)
+                raise mail.error(f"IDLE отклонен сервером: {typ} {data}")
+        self.idle_tag = tag
         return True
-    except ImportError as e:
-        print(f"✗ Отсутствует зависимость: {e}")
-        print("Запустите create_venv_fixed.bat для установки зависимостей")
+    
+    def idle_read_response(self):
+        """Читает один ответ сервера во время IDLE; True - пришли новые письма"""
+        self.mail._get_response()
+        return 'EXISTS' in self.mail.untagged_responses or 'RECENT' in self.mail.untagged_responses
+    
+    def idle_done(self):
+        """Завершает IDLE и дочитывает ответы до тегированного OK"""
+        mail, tag = self.mail, self.idle_tag
+        self.idle_tag = None
+        mail.send(b'DONE\r\n')
+        while mail.tagged_commands.get(tag) is None:
+            mail._get_response()
+        mail.tagged_commands.pop(tag, None)
+        return self.has_pending_changes()
+
+class HtmlTextExtractor:
+    """Однопроходное извлечение текста из HTML без построения дерева.
+    
+    Повторяет результат BeautifulSoup(html.parser) + decompose мусорных
+    тегов и селекторов + get_text(): элемент-мусор выключает весь свой
+    текст вместе с потомками. Работает поверх токенизатора html.parser
+    или, если установлен, потокового парсера lxml (интерфейс target).
+    """
+    
+    # Теги, удаляемые целиком
+    DROP_TAGS = frozenset(['script', 'style', 'meta', 'link', 'head', 'title'])
+    # Текст внутри этих тегов get_text() не возвращает
+    SILENT_TAGS = frozenset(['template', 'rt', 'rp'])
+    # Пустые элементы закрываются сразу, как в BeautifulSoup
+    VOID_TAGS = frozenset([
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link',
+        'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound',
+        'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'
+    ])
+    # [class*="..."] - подстрока в атрибуте class
+    GARBAGE_CLASS_PARTS = ('hidden', 'hide', 'banner', 'ad')
+    # .name - класс целиком
+    GARBAGE_CLASSES = frozenset([
+        'footer', 'header', 'signature', 'disclaimer', 'copyright', 'logo', 'social',
+        'share', 'button', 'btn', 'email-footer', 'email-header', 'mailing', 'campaign'
+    ])
+    # [style*="..."]
+    GARBAGE_STYLES = ('display:none', 'display: none')
+    
+    class StopExtraction(Exception):
+        """Текста набрано достаточно - разбор дальше не нужен"""
+    
+    def __init__(self, max_chars=None):
+        self.max_chars = max_chars
+        # Стек открытых тегов: (имя, выключен ли текст)
+        self.stack = []
+        self.chunks = []
+        self.size = 0
+    
+    def is_garbage(self, tag, attrs):
+        if tag in self.DROP_TAGS:
+            return True
+        class_value = attrs.get('class')
+        if class_value:
+            classes = class_value.split()
+            joined = ' '.join(classes)
+            if any(part in joined for part in self.GARBAGE_CLASS_PARTS):
+                return True
+            if not self.GARBAGE_CLASSES.isdisjoint(classes):
+                return True
+        style = attrs.get('style')
+        if style and any(part in style for part in self.GARBAGE_STYLES):
+            return True
         return False
+    
+    def start(self, tag, attrs):
+        if tag in self.VOID_TAGS:
+            return
+        muted = bool(self.stack and self.stack[-1][1])
+        self.stack.append((tag, muted or tag in self.SILENT_TAGS or self.is_garbage(tag, attrs)))
+    
+    def end(self, tag):
+        # Как _popToTag: закрываем до ближайшего открытого тега с этим именем
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                del self.stack[index:]
+                break
+    
+    def data(self, text):
+        if self.stack and self.stack[-1][1]:
+            return
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.max_chars is not None and self.size > self.max_chars:
+            raise self.StopExtraction()
+    
+    def close(self):
+        return ''.join(self.chunks)
+    
+    @classmethod
+    def extract(cls, html_content, max_chars=None, backend='html.parser'):
+        """Текст HTML; при max_chars разбор прекращается, набрав столько символов"""
+        extractor = cls(max_chars)
+        if backend == 'lxml':
+            from lxml import etree
+            parser = etree.HTMLParser(target=extractor)
+        else:
+            parser = _HtmlTokenizer(extractor)
+        
+        try:
+            # Кусками, чтобы при раннем останове не токенизировать хвост
+            for start in range(0, len(html_content), 16384):
+                parser.feed(html_content[start:start + 16384])
+            parser.close()
+        except cls.StopExtraction:
+            pass
+        return extractor.close()
+
+class _HtmlTokenizer(HTMLParser):
+    """Токенизатор html.parser, передающий события в HtmlTextExtractor"""
+    
+    def __init__(self, extractor):
+        super().__init__(convert_charrefs=True)
+        self.extractor = extractor
+    
+    def handle_starttag(self, tag, attrs):
+        self.extractor.start(tag, {name: value or '' for name, value in attrs})
+    
+    def handle_endtag(self, tag):
+        self.extractor.end(tag)
+    
+    def handle_data(self, data):
+        self.extractor.data(data)
+    
+    def unknown_decl(self, data):
+        # CDATA get_text() возвращает, остальные декларации - нет
+        if data.startswith('CDATA['):
+            self.extractor.data(data[6:])
 
 class YandexMailToTelegramBot:
-    def __init__(self, email_config, telegram_config):
+    # Границы адаптивного опроса для серверов без IDLE
+    MIN_POLL_INTERVAL = 10
+    # Сколько символов текста письма попадает в сообщение
+    PREVIEW_CHARS = 1500
+    # Мусорные паттерны, часто встречающиеся в email рассылках
+    HTML_GARBAGE_PATTERNS = [
+        re.compile(r'\[.*?\]'),  # текст в квадратных скобках
+        re.compile(r'&nbsp;'),   # HTML неразрывные пробелы
+        re.compile(r'<!--.*?-->'),  # HTML комментарии
+        re.compile(r'https?://\S+'),  # ссылки (оставляем только текст)
+    ]
+    WHITESPACE_RE = re.compile(r'\s+')
+    BASIC_TAG_RE = re.compile('<[^<]+?>')
+    BASIC_COMMENT_RE = re.compile('<!--.*?-->')
+    BASIC_BRACKETS_RE = re.compile(r'\[.*?\]')
+    BASIC_ENTITY_RE = re.compile(r'&[a-z]+;')
+    # Ограничения Bot API на загрузку файлов
+    TELEGRAM_PHOTO_LIMIT = 10 * 1024 * 1024
+    TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+    # Ограничения Bot API на сообщение и медиагруппу
+    TELEGRAM_MESSAGE_LIMIT = 4096
+    TELEGRAM_MEDIA_GROUP_LIMIT = 10
+    # Текст одного письма в дайджесте
+    DIGEST_PREVIEW_CHARS = 300
+    # Символы разметки Markdown (legacy) и их экранирование
+    MARKDOWN_SPECIAL = re.compile(r'([_*`\[])')
+    MARKDOWN_ESCAPED = re.compile(r'\\([_*`\[])')
+    # За какой период считается поток писем для автоматического дайджеста
+    DIGEST_RATE_WINDOW = 60
+    
+    def __init__(self, email_config, telegram_config, shared=None):
         self.email_config = email_config
         self.telegram_config = telegram_config
-        self.bot = telebot.TeleBot(telegram_config['bot_token'])
-        self.processed_emails = set()
-        self.attachments_dir = "email_attachments"
-        
-        # Создаем папку для вложений
-        if not os.path.exists(self.attachments_dir):
-            os.makedirs(self.attachments_dir)
-        
-    def connect_to_email(self):
-        """Подключение к Яндекс.Почте"""
-        try:
-            print("Подключение к Яндекс.Почте...")
-            self.mail = imaplib.IMAP4_SSL("imap.yandex.ru", 993)
-            self.mail.login(self.email_config['email'], self.email_config['password'])
-            self.mail.select("INBOX")
-            print("✓ Успешно подключено к Яндекс.Почте")
-            return True
-        except Exception as e:
-            print(f"✗ Ошибка подключения к почте: {e}")
-            return False
+        # Общие для всех папок процесса объекты (см. MailSupervisor); None - свои
+        self.shared = shared
+        self.metrics = self.shared_resource(('metrics',), Metrics)
+        bot_token = telegram_config['bot_token']
+        # Бот Telegram создается при первой отправке (см. свойство bot)
+        self._bot = None
+        # Лимиты Bot API считаются на токен, а не на папку
+        self.rate_limiter = self.shared_resource(
+            ('rate_limiter', bot_token), lambda: TelegramRateLimiter(self.metrics, telegram_config.get('rate_limits'))
+        )
+        # Архив вложений (см. AttachmentArchive): лимит объема в МБ, 0 - не сохранять
+        self.attachments_dir = email_config.get('attachments_dir', "email_attachments")
+        self.archive = None
+        archive_max_mb = email_config.get('archive_max_mb', 512)
+        if archive_max_mb:
+            archive_max_age = email_config.get('archive_max_age_days', 0) * 86400
+            self.archive = self.shared_resource(
+                ('archive', self.attachments_dir),
+                lambda: AttachmentArchive(self.attachments_dir, archive_max_mb * 1024 * 1024, archive_max_age, self.metrics)
+            )
+        self.session = ImapSession(email_config, email_config.get('mailbox', "INBOX"))
+        # Метка папки в метриках
+        self.mailbox_key = f"{email_config['email']}/{self.session.mailbox}"
+        # Порт HTTP для метрик и профилирования (None - выключено), период сводки в выводе
+        self.metrics_port = email_config.get('metrics_port')
+        self.metrics_log_interval = email_config.get('metrics_log_interval', 300)
+        self.sync_state = SyncState(
+            email_config.get('state_file', "sync_state.json"),
+            f"{email_config['email']}/{self.session.mailbox}"
+        )
+        # Доставленные UID выше отметки (если письмо не удалось пометить прочитанным)
+        self.delivered_uids = set()
+        # Отправленные части писем - переживают перезапуск
+        self.journal = DeliveryJournal(
+            email_config.get('journal_file', "delivery_journal.db"),
+            f"{email_config['email']}/{self.session.mailbox}"
+        )
+        # 'structure' - по BODYSTRUCTURE только нужные части, 'full' - письмо целиком
+        self.fetch_mode = email_config.get('fetch_mode', 'structure')
+        # Запас байт исходного текста: с запасом на base64/quoted-printable и UTF-8
+        self.text_preview_bytes = email_config.get('text_preview_bytes', self.PREVIEW_CHARS * 12)
+        self.html_preview_bytes = email_config.get('html_preview_bytes', 128 * 1024)
+        # 'html.parser' (стандартная библиотека) или 'lxml', если установлен
+        self.html_backend = email_config.get('html_backend', 'html.parser')
+        if self.html_backend == 'lxml':
+            try:
+                import lxml.etree
+            except ImportError:
+                log.warning("lxml не установлен, для HTML используется html.parser")
+                self.html_backend = 'html.parser'
+        # Очищенный текст повторяющихся писем (0 - без кэша, файл - между запусками)
+        self.text_cache = None
+        text_cache_bytes = email_config.get('text_cache_bytes', 8 * 1024 * 1024)
+        if text_cache_bytes:
+            text_cache_file = email_config.get('text_cache_file')
+            self.text_cache = self.shared_resource(
+                ('text_cache', text_cache_bytes, text_cache_file),
+                lambda: TextCache(text_cache_bytes, text_cache_file)
+            )
+        # file_id уже загруженных в Telegram вложений по SHA-256 содержимого
+        self.file_id_cache = None
+        file_id_cache_bytes = email_config.get('file_id_cache_bytes', 1024 * 1024)
+        if file_id_cache_bytes:
+            file_id_cache_file = email_config.get('file_id_cache_file', "file_id_cache.json")
+            self.file_id_cache = self.shared_resource(
+                ('file_id_cache', file_id_cache_bytes, file_id_cache_file),
+                lambda: TextCache(file_id_cache_bytes, file_id_cache_file, "кэш file_id")
+            )
+        # Вложения качаются кусками и копятся в RAM только до порога, дальше - на диске
+        self.attachment_chunk_bytes = email_config.get('attachment_chunk_bytes', 4 * 1024 * 1024)
+        self.attachment_memory_threshold = email_config.get('attachment_memory_threshold', 1024 * 1024)
+        memory_budget_bytes = email_config.get('attachment_memory_budget', 64 * 1024 * 1024)
+        self.memory_budget = self.shared_resource(
+            ('memory_budget', memory_budget_bytes), lambda: MemoryBudget(memory_budget_bytes)
+        )
+        # Изображения уменьшаются до этой стороны и пережимаются (0 - отправлять как есть)
+        self.image_max_dimension = email_config.get('image_max_dimension', 2560)
+        self.image_format = email_config.get('image_format', 'JPEG')  # 'JPEG' или 'WEBP'
+        self.image_quality = email_config.get('image_quality', 85)
+        self.image_workers = email_config.get('image_workers', 2)
+        # Дайджест: 'auto' - при потоке от digest_threshold писем в минуту, 'always', 'off'
+        self.digest_mode = email_config.get('digest_mode', 'auto')
+        self.digest_threshold = email_config.get('digest_threshold', 10)
+        # Сколько секунд копить письма после уведомления и сколько писем в одном дайджесте
+        self.digest_window = email_config.get('digest_window', 30)
+        self.digest_max_items = email_config.get('digest_max_items', 50)
+        # Догон очереди: от catchup_threshold новых писем они загружаются
+        # диапазонами по catchup_range_size через catchup_connections соединений
+        self.catchup_threshold = email_config.get('catchup_threshold', 200)
+        self.catchup_connections = email_config.get('catchup_connections', 4)
+        self.catchup_range_size = email_config.get('catchup_range_size', 50)
+        # Сначала самые новые диапазоны: свежая почта видна сразу, старая догоняется следом
+        self.catchup_newest_first = email_config.get('catchup_newest_first', False)
+        # Лимит сервера на соединения одного ящика - общий для всех его папок
+        imap_max_connections = email_config.get('imap_max_connections', 5)
+        self.imap_slots = self.shared_resource(
+            ('imap_slots', email_config['email']), lambda: threading.Semaphore(imap_max_connections)
+        )
+        # Основное соединение папки занимает место всегда; папка сверх лимита
+        # открывала бы соединения, которых сервер не разрешает
+        if not self.imap_slots.acquire(blocking=False):
+            raise ValueError(
+                f"у ящика {email_config['email']} папок больше, чем imap_max_connections ({imap_max_connections})"
+            )
+        # (время, число новых писем) по проходам за DIGEST_RATE_WINDOW
+        self.arrivals = deque()
+        # Правила по заголовкам (см. MailRules) и чаты писем, направленных правилами
+        self.rules = MailRules.from_config(email_config.get('rules'))
+        self.message_chats = {}
+        self.mail = None
+        self.last_found_count = 0
+        # Сколько писем последнего прохода не удалось доставить (код выхода --once)
+        self.last_failed_count = 0
+        self.poll_interval = self.MIN_POLL_INTERVAL
+    
+    def start_metrics_server(self):
+        """Один сервер метрик на процесс"""
+        if self.metrics_port:
+            self.shared_resource(
+                ('metrics_server', self.metrics_port),
+                lambda: MetricsServer(self.metrics, self.metrics_port).start()
+            )
     
-    def mark_as_read(self, email_id):
-        """Помечает письмо как прочитанное"""
+    def caches(self):
+        return [cache for cache in (self.text_cache, self.file_id_cache) if cache is not None]
+    
+    @property
+    def bot(self):
+        """Бот Telegram; без новых писем telebot даже не импортируется"""
+        if self._bot is None:
+            self._bot = self.shared_resource(('bot', self.telegram_config['bot_token']), self.create_telegram_bot)
+        return self._bot
+    
+    def create_telegram_bot(self):
+        import telebot
+        
+        if self.telegram_config.get('api_url'):
+            # Адрес Bot API общий для всего telebot (свой сервер или bench/fake_bot_api.py)
+            telebot.apihelper.API_URL = self.telegram_config['api_url'].rstrip('/') + "/bot{0}/{1}"
+        # Запросы всех ботов процесса идут через общий пул соединений
+        config = self.telegram_config
+        self.shared_resource(('bot_api_session',), lambda: BotApiSession(
+            config.get('http_pool_size', 8), config.get('connect_timeout', 10),
+            config.get('read_timeout', 30), config.get('upload_timeout', 120), self.metrics
+        ).install(telebot.apihelper))
+        return telebot.TeleBot(config['bot_token'])
+    
+    def chat_for(self, uid):
+        """Чат письма: назначенный правилом или чат папки"""
+        return self.message_chats.get(uid, self.telegram_config['chat_id'])
+    
+    def apply_rules(self, uid, header):
+        """Проверяет правила по заголовкам; возвращает сработавшее правило или None"""
+        if self.rules is None or not header:
+            return None
+        # policy.default декодирует RFC 2047 и 8-битные заголовки в str
+        rule = self.rules.match_message(email.message_from_bytes(header, policy=email.policy.default))
+        if rule is None:
+            return None
+        self.metrics.inc('rule_matches_total', rule=rule.name)
+        if rule.action in MailRules.SKIP_ACTIONS:
+            log.info(f"Письмо {uid}: правило «{rule.name}» - {rule.action}, тело не загружается")
+        elif rule.chat_id:
+            self.message_chats[uid] = rule.chat_id
+        return rule
+    
+    def filter_by_headers(self, uids, session):
+        """Режим 'full': заголовки загружаются отдельно, чтобы не скачивать отброшенные письма.
+        
+        Возвращает (UID для загрузки, словари пропущенных писем).
+        """
+        skipped = {}
+        for uid, header in session.fetch_header_fields(uids, MailRules.HEADER_FIELDS):
+            rule = self.apply_rules(uid, header)
+            if rule is not None and rule.action in MailRules.SKIP_ACTIONS:
+                skipped[uid] = {'uid': uid, 'action': rule.action}
+        return [uid for uid in uids if uid not in skipped], list(skipped.values())
+    
+    def shared_resource(self, key, factory):
+        """Объект, общий для ботов одного процесса, или собственный без supervisor"""
+        if self.shared is None:
+            return factory()
+        if key not in self.shared:
+            self.shared[key] = factory()
+        return self.shared[key]
+    
+    def catchup_active(self, count):
+        return self.catchup_connections > 1 and count >= self.catchup_threshold
+    
+    def catchup_ranges(self, uids):
+        """Диапазоны UID для догона: по возрастанию или, с catchup_newest_first, с самых новых"""
+        size = max(1, self.catchup_range_size)
+        ranges = [uids[start:start + size] for start in range(0, len(uids), size)]
+        if self.catchup_newest_first:
+            ranges.reverse()
+        return ranges
+    
+    def open_catchup_session(self):
+        """Дополнительное соединение для догона или None, если лимит сервера исчерпан"""
+        if not self.imap_slots.acquire(blocking=False):
+            return None
+        session = ImapSession(self.email_config, self.session.mailbox)
+        # При другом UIDVALIDITY номера писем в соединениях не совпадают
+        if session.connect() and session.uidvalidity == self.session.uidvalidity:
+            return session
+        session.close()
+        self.imap_slots.release()
+        return None
+    
+    def close_catchup_session(self, session):
+        session.close()
+        self.imap_slots.release()
+    
+    def connect_to_email(self, wait=True):
+        """Подключение к Яндекс.Почте (повторно используется открытая сессия)"""
+        connected = self.session.ensure_connected(wait)
+        self.mail = self.session.mail
+        return connected
+    
+    def drop_connection(self):
+        """Закрывает соединение с неизвестным состоянием, следующий проход переподключится"""
+        self.session.close()
+        self.mail = None
+    
+    def mark_as_read(self, uids):
+        """Помечает письма как прочитанные одной командой STORE"""
+        if not uids:
+            return True
+        uid_set = self.session.format_uid_set(uids)
         try:
-            self.mail.store(email_id, '+FLAGS', '\\Seen')
-            print(f"✓ Письмо {email_id} помечено как прочитанное")
+            status, _ = self.mail.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Seen)')
+            if status != 'OK':
+                log.error(f"✗ Сервер отклонил пометку писем {uid_set}")
+                return False
+            log.info(f"✓ Письма {uid_set} помечены как прочитанные")
             return True
         except Exception as e:
-            print(f"✗ Ошибка пометки письма как прочитанного: {e}")
+            log.error(f"✗ Ошибка пометки письма как прочитанного: {e}")
             return False
     
+    def mark_delivered_read(self, uids):
+        """Помечает прочитанными доставленные письма и те, что не удалось пометить раньше.
+        
+        При ошибке STORE все они остаются в sync_state.json и повторяются в следующем проходе.
+        """
+        state = self.sync_state
+        pending = sorted(set(uids) | state.unmarked)
+        if not pending:
+            return True
+        marked = self.mark_as_read(pending)
+        unmarked = set() if marked else set(pending)
+        if unmarked != state.unmarked:
+            state.unmarked = unmarked
+            state.save()
+        return marked
+    
     def decode_mime_words(self, text):
         """Декодирование заголовков писем"""
         try:
@@ -82,232 +2599,291 @@ class YandexMailToTelegramBot:
         except:
             return str(text) if text else "Без темы"
     
-    def clean_html_to_text(self, html_content):
-        """Тщательная очистка HTML от мусора и преобразование в читаемый текст"""
+    def clean_html_to_text(self, html_content, max_chars=None):
+        """Тщательная очистка HTML от мусора и преобразование в читаемый текст.
+        
+        При max_chars разбор останавливается, когда текста заведомо хватает
+        на превью такой длины (с запасом на вычищаемые ссылки и [..]).
+        """
         if not html_content:
             return ""
         
+        cache = self.text_cache
+        if cache is None:
+            return self._clean_html_to_text(html_content, max_chars)
+        
+        key = TextCache.make_key(html_content, 'html', max_chars, self.html_backend)
+        clean_text = cache.get(key)
+        if clean_text is None:
+            clean_text = self._clean_html_to_text(html_content, max_chars)
+            cache.put(key, clean_text)
+        return clean_text
+    
+    def _clean_html_to_text(self, html_content, max_chars):
+        with self.metrics.timer('html_clean'):
+            return self._extract_clean_text(html_content, max_chars)
+    
+    def _extract_clean_text(self, html_content, max_chars):
         try:
-            # Используем BeautifulSoup для парсинга HTML
-            soup = BeautifulSoup(html_content, 'html.parser')
-            
-            # Удаляем ненужные элементы
-            for element in soup(['script', 'style', 'meta', 'link', 'head', 'title']):
-                element.decompose()
+            limit = max_chars * 4 + 1024 if max_chars else None
+            text = HtmlTextExtractor.extract(html_content, limit, self.html_backend)
             
-            # Удаляем элементы с определенными классами или ID (типичный мусор в письмах)
-            garbage_selectors = [
-                '[class*="hidden"]', '[class*="hide"]', '.footer', '.header',
-                '[class*="banner"]', '[class*="ad"]', '.signature', '.disclaimer',
-                '.copyright', '.logo', '.social', '.share', '.button', '.btn',
-                '[style*="display:none"]', '[style*="display: none"]',
-                '.email-footer', '.email-header', '.mailing', '.campaign'
-            ]
+            # Убираем лишние пробелы и переносы
+            clean_text = self.WHITESPACE_RE.sub(' ', text).strip()
             
-            for selector in garbage_selectors:
-                for element in soup.select(selector):
-                    element.decompose()
-            
-            # Получаем чистый текст
-            text = soup.get_text()
-            
-            # Очищаем текст от лишних пробелов и переносов
-            lines = []
-            for line in text.splitlines():
-                line = line.strip()
-                if line:  # убираем пустые строки
-                    lines.append(line)
-            
-            clean_text = '\n'.join(lines)
-            
-            # Убираем множественные пробелы
-            clean_text = re.sub(r'\s+', ' ', clean_text)
-            
-            # Убираем мусорные паттерны, часто встречающиеся в email рассылках
-            garbage_patterns = [
-                r'\[.*?\]',  # текст в квадратных скобках
-                r'&nbsp;',   # HTML неразрывные пробелы
-                r'<!--.*?-->',  # HTML комментарии
-                r'https?://\S+',  # ссылки (оставляем только текст)
-            ]
-            
-            for pattern in garbage_patterns:
-                clean_text = re.sub(pattern, ' ', clean_text)
+            for pattern in self.HTML_GARBAGE_PATTERNS:
+                clean_text = pattern.sub(' ', clean_text)
             
             # Декодируем HTML entities
             clean_text = html.unescape(clean_text)
             
             # Финальная очистка
-            clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+            clean_text = self.WHITESPACE_RE.sub(' ', clean_text).strip()
             
             return clean_text
             
         except Exception as e:
-            print(f"Ошибка очистки HTML: {e}")
-            # Если BeautifulSoup не справился, используем базовый метод
+            log.warning(f"Ошибка очистки HTML: {e}")
+            # Если разбор не справился, используем базовый метод
             return self.basic_html_clean(html_content)
     
     def basic_html_clean(self, html_content):
-        """Базовый метод очистки HTML без BeautifulSoup"""
+        """Базовый метод очистки HTML регулярными выражениями"""
         if not html_content:
             return ""
         
         # Удаляем HTML теги
-        text = re.sub('<[^<]+?>', ' ', html_content)
+        text = self.BASIC_TAG_RE.sub(' ', html_content)
         
         # Удаляем HTML комментарии
-        text = re.sub('<!--.*?-->', ' ', text)
+        text = self.BASIC_COMMENT_RE.sub(' ', text)
         
         # Заменяем HTML сущности
         text = html.unescape(text)
         
         # Убираем мусорные паттерны
-        text = re.sub(r'\[.*?\]', ' ', text)
-        text = re.sub(r'&[a-z]+;', ' ', text)
+        text = self.BASIC_BRACKETS_RE.sub(' ', text)
+        text = self.BASIC_ENTITY_RE.sub(' ', text)
         
         # Убираем лишние пробелы и переносы
-        lines = []
-        for line in text.splitlines():
-            line = line.strip()
-            if line and len(line) > 2:  # убираем очень короткие строки (часто мусор)
-                lines.append(line)
+        # (очень короткие строки - часто мусор)
+        lines = [line for line in map(str.strip, text.splitlines()) if len(line) > 2]
         
         clean_text = '\n'.join(lines)
-        clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+        clean_text = self.WHITESPACE_RE.sub(' ', clean_text).strip()
         
         return clean_text
     
-    def extract_text_from_email(self, msg):
-        """Извлечение текста из письма"""
+    def decode_transfer_encoding(self, data, encoding, partial=False):
+        """Снимает Content-Transfer-Encoding (в т.ч. с обрезанного фрагмента)"""
+        if encoding == 'base64':
+            clean = bytes(data).translate(None, TransferDecoder.BASE64_JUNK)
+            if partial:
+                clean = clean[:len(clean) // 4 * 4]
+            return base64.b64decode(clean)
+        if encoding == 'quoted-printable':
+            if partial:
+                # Отрезаем незавершенную escape-последовательность
+                data = re.sub(rb'=[0-9A-Fa-f]?$', b'', data)
+            return quopri.decodestring(data)
+        return data
+    
+    def decode_text_payload(self, payload, charset):
+        """Декодирование текста в объявленной кодировке с запасным UTF-8"""
+        try:
+            return payload.decode(charset or 'utf-8', errors='ignore')
+        except LookupError:
+            return payload.decode('utf-8', errors='ignore')
+    
+    def extract_text_from_email(self, index):
+        """Извлечение текста из разобранного письма (MimeIndex) с учетом кодировок частей"""
         text_content = ""
         html_content = ""
         
         try:
-            if msg.is_multipart():
-                for part in msg.walk():
-                    content_type = part.get_content_type()
-                    content_disposition = str(part.get("Content-Disposition", ""))
-                    
-                    # Пропускаем вложения
-                    if 'attachment' in content_disposition:
-                        continue
-                        
-                    if content_type == "text/plain" and "attachment" not in content_disposition:
-                        try:
-                            payload = part.get_payload(decode=True)
-                            if payload:
-                                decoded_text = payload.decode('utf-8', errors='ignore')
-                                text_content += decoded_text
-                        except:
-                            pass
-                    elif content_type == "text/html" and "attachment" not in content_disposition:
-                        try:
-                            payload = part.get_payload(decode=True)
-                            if payload:
-                                decoded_html = payload.decode('utf-8', errors='ignore')
-                                html_content += decoded_html
-                        except:
-                            pass
-            else:
-                content_type = msg.get_content_type()
-                if content_type == "text/plain":
-                    try:
-                        payload = msg.get_payload(decode=True)
-                        if payload:
-                            text_content = payload.decode('utf-8', errors='ignore')
-                    except:
-                        pass
-                elif content_type == "text/html":
-                    try:
-                        payload = msg.get_payload(decode=True)
-                        if payload:
-                            html_content = payload.decode('utf-8', errors='ignore')
-                    except:
-                        pass
+            for part in index.parts:
+                # Пропускаем вложения
+                if part.disposition == 'attachment' or part.type not in ('text/plain', 'text/html'):
+                    continue
+                try:
+                    payload = index.payload(part)
+                except Exception as e:
+                    log.warning(f"Ошибка декодирования текстовой части: {e}")
+                    continue
+                if not payload:
+                    continue
+                if part.type == 'text/plain':
+                    text_content += self.decode_text_payload(payload, part.charset)
+                else:
+                    html_content += self.decode_text_payload(payload, part.charset)
             
             # Предпочитаем чистый текст, если он есть
             if text_content.strip():
                 clean_text = text_content
             elif html_content.strip():
                 # Очищаем HTML от мусора
-                print("Обнаружен HTML контент, выполняется очистка...")
-                clean_text = self.clean_html_to_text(html_content)
-                print("HTML очищен успешно")
+                log.debug("Обнаружен HTML контент, выполняется очистка...")
+                clean_text = self.clean_html_to_text(html_content, self.PREVIEW_CHARS)
+                log.debug("HTML очищен успешно")
             else:
                 clean_text = "Текст письма отсутствует или не может быть прочитан"
             
             return clean_text
             
         except Exception as e:
-            print(f"Ошибка извлечения текста: {e}")
+            log.error(f"Ошибка извлечения текста: {e}")
             return "Ошибка при чтении содержимого письма"
     
-    def extract_attachments(self, msg):
-        """Извлечение всех вложений из письма"""
+    def classify_attachment(self, filename, content_type, encoding, size):
+        """Решение по вложению до декодирования: (изображение ли, загружать ли).
+        
+        size - размер части в письме; base64 раздувает данные на треть,
+        поэтому размер после декодирования оценивается.
+        """
+        estimated_size = size * 3 // 4 if encoding == 'base64' else size
+        # Большие фото будут уменьшены, поэтому принимаем их до лимита документов
+        image_limit = self.TELEGRAM_DOCUMENT_LIMIT if self.image_max_dimension else self.TELEGRAM_PHOTO_LIMIT
+        is_image = content_type.startswith("image/") and estimated_size <= image_limit
+        if not is_image and estimated_size > self.TELEGRAM_DOCUMENT_LIMIT:
+            log.warning(f"Вложение {filename} ({self.format_file_size(estimated_size)}) превышает лимит Telegram, не загружаем")
+            return is_image, estimated_size, False
+        return is_image, estimated_size, True
+    
+    def extract_attachments(self, index, uid):
+        """Извлечение вложений из разобранного письма (MimeIndex).
+        
+        Части классифицируются по заголовкам, в спул декодируются только
+        вложения, проходящие по лимитам Telegram, - без промежуточной копии.
+        """
         images = []
         files = []
         
         try:
-            print("Начало извлечения вложений...")
-            if msg.is_multipart():
-                for part in msg.walk():
-                    content_type = part.get_content_type()
-                    content_disposition = str(part.get("Content-Disposition", ""))
-                    filename = part.get_filename()
-                    
-                    # Если есть имя файла, это вложение
-                    if filename:
-                        filename = self.decode_mime_words(filename)
-                        print(f"Обнаружено вложение: {filename} ({content_type})")
-                        
-                        # Декодируем содержимое вложения
-                        try:
-                            file_data = part.get_payload(decode=True)
-                            if file_data:
-                                file_info = {
-                                    'filename': filename,
-                                    'data': file_data,
-                                    'type': content_type,
-                                    'size': len(file_data)
-                                }
-                                
-                                print(f"Вложение {filename} успешно извлечено, размер: {len(file_data)} байт")
-                                
-                                # Разделяем на изображения и другие файлы
-                                if content_type.startswith("image/"):
-                                    images.append(file_info)
-                                    print(f"Добавлено изображение: {filename}")
-                                else:
-                                    files.append(file_info)
-                                    print(f"Добавлен файл: {filename}")
-                            else:
-                                print(f"Пустые данные для вложения: {filename}")
-                                
-                        except Exception as e:
-                            print(f"Ошибка декодирования вложения {filename}: {e}")
-            
-            print(f"Итог: изображений - {len(images)}, файлов - {len(files)}")
+            for number, part in enumerate(index.parts, 1):
+                # Если есть имя файла, это вложение
+                if not part.filename:
+                    continue
+                filename = self.decode_mime_words(part.filename)
+                content_type = part.type
+                log.debug(f"Обнаружено вложение: {filename} ({content_type})")
+                
+                is_image, estimated_size, fits = self.classify_attachment(
+                    filename, content_type, part.encoding, part.size
+                )
+                if not fits:
+                    files.append({'filename': filename, 'spool': None, 'type': content_type, 'size': estimated_size})
+                    continue
+                
+                spool = self.new_spool(filename)
+                try:
+                    for data in index.iter_payload(part, self.attachment_chunk_bytes):
+                        spool.write(data)
+                except Exception as e:
+                    log.warning(f"Ошибка декодирования вложения {filename}: {e}")
+                    spool.close()
+                    continue
+                if not spool.size:
+                    log.warning(f"Пустые данные для вложения: {filename}")
+                    spool.close()
+                    continue
+                
+                file_info = {
+                    'filename': filename,
+                    'spool': spool,
+                    'type': content_type,
+                    'size': spool.size,
+                    # Ключ в архиве: номер листовой части (в режиме 'structure' - секция IMAP)
+                    'uid': uid,
+                    'part': f"#{number}",
+                }
+                log.debug(f"Вложение {filename} успешно извлечено, размер: {spool.size} байт")
+                
+                # Разделяем на изображения и другие файлы
+                if is_image:
+                    images.append(file_info)
+                else:
+                    files.append(file_info)
+            
+            log.debug(f"Итог: изображений - {len(images)}, файлов - {len(files)}")
             return images, files
             
         except Exception as e:
-            print(f"Ошибка при извлечении вложений: {e}")
+            log.error(f"Ошибка при извлечении вложений: {e}")
             return [], []
     
-    def save_attachment(self, file_data, filename):
-        """Сохраняет вложение в папку и возвращает путь"""
-        try:
-            # Очищаем имя файла от недопустимых символов
-            clean_filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
-            filepath = os.path.join(self.attachments_dir, clean_filename)
+    def new_spool(self, filename):
+        return AttachmentSpool(filename, self.memory_budget, self.attachment_memory_threshold)
+    
+    def archive_key(self, uid, part):
+        return self.mailbox_key, self.sync_state.uidvalidity, uid, part
+    
+    def release_attachments(self, images, files):
+        """Освобождает память и временные файлы вложений письма (исходные вложения - в архив)"""
+        for file_info in images + files:
+            spool = file_info.get('spool')
+            if spool is None:
+                continue
+            if self.archive is not None and file_info.get('part'):
+                self.archive.store(self.archive_key(file_info['uid'], file_info['part']), file_info)
+            else:
+                spool.close()
+    
+    def image_job(self, image):
+        """Аргументы prepare_image для изображения (данные читаются из спула)"""
+        return (image['spool'].getvalue(), image['filename'], self.image_max_dimension,
+                self.TELEGRAM_PHOTO_LIMIT, self.image_format, self.image_quality)
+    
+    def image_source(self, image):
+        """Ключ исходного изображения для кэша file_id: от него и настроек зависит, что уйдет в Telegram"""
+        return f"{image['spool'].sha256}:{self.image_max_dimension}:{self.image_format}:{self.image_quality}"
+    
+    def cached_photo(self, image):
+        """Есть ли file_id фото для исходного изображения - тогда пережимать его не нужно"""
+        cache = self.file_id_cache
+        if cache is None:
+            return False
+        return cache.get(self.file_id_key('photo', dict(image, source=self.image_source(image)))) is not None
+    
+    def apply_image_results(self, images, results):
+        """Подменяет изображения результатами prepare_image.
+        
+        Возвращает (фото, документы): не влезающие в ограничения фото
+        отправляются как файлы. Результат None - фото есть в кэше file_id,
+        изображение не пережималось.
+        """
+        photos = []
+        documents = []
+        for image, result in zip(images, results):
+            image = dict(image, source=self.image_source(image))
+            if result is None:
+                log.debug(f"Изображение {image['filename']} уже отправлялось, пережатие пропущено")
+                # Если file_id перестанет действовать, пережмем при загрузке (upload_file)
+                photos.append(dict(image, unprepared=True))
+                continue
+            if isinstance(result, BaseException):
+                log.warning(f"Ошибка обработки изображения {image['filename']}: {result}")
+                action, data, filename = 'keep', None, image['filename']
+            else:
+                action, data, filename = result
             
-            with open(filepath, 'wb') as f:
-                f.write(file_data)
+            if action == 'photo':
+                spool = self.new_spool(filename)
+                spool.write(data)
+                log.debug(f"Изображение {image['filename']}: {self.format_file_size(image['size'])} -> "
+                      f"{self.format_file_size(spool.size)}")
+                # В архив уходит исходное изображение, пережатое только отправляется
+                self.release_attachments([image], [])
+                image = dict(image, filename=filename, spool=spool, size=spool.size, part=None,
+                             type='image/webp' if self.image_format == 'WEBP' else 'image/jpeg')
+            elif action == 'keep' and image['size'] > self.TELEGRAM_PHOTO_LIMIT:
+                action = 'document'
             
-            print(f"Файл сохранен: {filepath}")
-            return filepath
-        except Exception as e:
-            print(f"Ошибка сохранения файла {filename}: {e}")
-            return None
+            if action == 'document':
+                log.debug(f"Изображение {image['filename']} будет отправлено файлом")
+                documents.append(image)
+            else:
+                photos.append(image)
+        return photos, documents
     
     def format_file_size(self, size_bytes):
         """Форматирует размер файла в читаемый вид"""
@@ -318,18 +2894,16 @@ class YandexMailToTelegramBot:
         else:
             return f"{size_bytes / (1024 * 1024):.1f} MB"
     
-    def format_email_message(self, msg, files):
-        """Форматирование письма для отправки в Telegram"""
+    def format_email_message(self, msg, files, text_content):
+        """Форматирование письма для отправки в Telegram (текст уже извлечен при разборе)"""
         try:
             subject = self.decode_mime_words(msg.get("Subject", "Без темы"))
             from_ = self.decode_mime_words(msg.get("From", "Неизвестный отправитель"))
             date = msg.get("Date", "Неизвестная дата")
             
-            text_content = self.extract_text_from_email(msg)
-            
             # Обрезаем длинный текст
-            if len(text_content) > 1500:
-                text_content = text_content[:1500] + "...\n\n[Текст обрезан]"
+            if len(text_content) > self.PREVIEW_CHARS:
+                text_content = text_content[:self.PREVIEW_CHARS] + "...\n\n[Текст обрезан]"
             
             message = f"📧 *Новое письмо*\n\n"
             message += f"🤵 *От:* {from_}\n"
@@ -341,253 +2915,1641 @@ class YandexMailToTelegramBot:
                 message += f"💾 \n*Вложения ({len(files)}):*\n"
                 for i, file_info in enumerate(files, 1):
                     file_size = self.format_file_size(file_info['size'])
-                    message += f"💾 {i}. {file_info['filename']} ({file_size})\n"
+                    message += f"💾 {i}. {file_info['filename']} ({file_size})"
+                    if file_info.get('spool') is None:
+                        message += " - слишком большой для Telegram, не загружен"
+                    message += "\n"
             
             message += f"\n*Содержимое:*\n{text_content}"
             
             return message
         except Exception as e:
-            print(f"Ошибка форматирования письма: {e}")
+            log.error(f"Ошибка форматирования письма: {e}")
             base_message = "📧 *Новое письмо*\n\n"
             base_message += f"🤵 *От:* {msg.get('From', 'Неизвестный отправитель')}\n"
             base_message += f"📣 *Тема:* {msg.get('Subject', 'Без темы')}\n"
             base_message += "\nНе удалось полностью прочитать содержимое письма"
             return base_message
     
+    def file_id_key(self, kind, file_info):
+        """Ключ кэша file_id: file_id действителен только для своего бота и типа файла"""
+        bot_id = self.telegram_config['bot_token'].split(':')[0]
+        # Фото - по исходному вложению и настройкам пережатия, чтобы проверять кэш до prepare_image
+        source = file_info.get('source') if kind == 'photo' else None
+        return f"{bot_id}:{kind}:{source or file_info['spool'].sha256}"
+    
+    def upload_file(self, file_info):
+        """Файлоподобный объект для загрузки в Telegram.
+        
+        Изображение, не пережатое из-за file_id в кэше, пережимается здесь,
+        в потоке отправки: file_id не подошел и фото загружается заново.
+        """
+        if file_info.get('unprepared'):
+            action, data, _ = prepare_image(*self.image_job(file_info))
+            file_info['unprepared'] = False
+            if action == 'photo':
+                file_info['upload'] = data
+        if file_info.get('upload') is not None:
+            return io.BytesIO(file_info['upload'])
+        return file_info['spool'].open()
+    
+    @staticmethod
+    def message_file_id(message, kind):
+        """file_id из ответа Bot API (для фото - самый большой размер)"""
+        if kind == 'photo' and getattr(message, 'photo', None):
+            return message.photo[-1].file_id
+        if kind == 'document' and getattr(message, 'document', None):
+            return message.document.file_id
+        return None
+    
+    def send_cached(self, kind, file_info, send):
+        """Отправляет файл по file_id, если он уже загружался, иначе загружает и запоминает.
+        
+        send(media) получает file_id или файлоподобный объект и возвращает Message.
+        """
+        import telebot
+        
+        cache = self.file_id_cache
+        if cache is None:
+            return send(self.upload_file(file_info))
+        
+        key = self.file_id_key(kind, file_info)
+        file_id = cache.get(key)
+        if file_id:
+            try:
+                message = send(file_id)
+                log.debug(f"Файл {file_info['filename']} отправлен повторно по file_id")
+                return message
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                log.warning(f"file_id для {file_info['filename']} больше не действует, загружаем заново")
+                cache.discard(key)
+        
+        message = send(self.upload_file(file_info))
+        file_id = self.message_file_id(message, kind)
+        if file_id:
+            cache.put(key, file_id)
+        return message
+    
+    def send_media_group(self, chat_id, items, kind='photo'):
+        """Медиагруппа фото или альбом документов: уже загружавшиеся - по file_id, остальные - файлами"""
+        import telebot
+        
+        cache = self.file_id_cache
+        keys = [self.file_id_key(kind, item) for item in items] if cache is not None else []
+        file_ids = [cache.get(key) for key in keys] if keys else [None] * len(items)
+        
+        def send(file_ids):
+            media_group = []
+            for item, file_id in zip(items, file_ids):
+                # При повторе после 429 файлы читаются с начала
+                media = file_id or self.upload_file(item)
+                if kind == 'photo':
+                    media_group.append(telebot.types.InputMediaPhoto(media))
+                else:
+                    media_group.append(telebot.types.InputMediaDocument(
+                        media, caption=f"Файл из письма: {item['filename']}"
+                    ))
+            return self.bot.send_media_group(chat_id, media_group)
+        
+        try:
+            messages = send(file_ids)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 400 or not any(file_ids):
+                raise
+            log.warning("file_id из кэша больше не действуют, загружаем файлы заново")
+            for key, file_id in zip(keys, file_ids):
+                if file_id:
+                    cache.discard(key)
+            file_ids = [None] * len(items)
+            messages = send(file_ids)
+        
+        if keys:
+            for key, file_id, message in zip(keys, file_ids, messages or []):
+                new_file_id = self.message_file_id(message, kind)
+                if not file_id and new_file_id:
+                    cache.put(key, new_file_id)
+        return messages
+    
+    def send_markdown(self, chat_id, text):
+        """send_message с Markdown; если Telegram не разобрал разметку - тот же текст без нее"""
+        try:
+            return self.bot.send_message(chat_id, text, parse_mode='Markdown')
+        except Exception as e:
+            if "can't parse entities" not in str(e):
+                raise
+            log.warning(f"Telegram не разобрал разметку, сообщение отправлено без нее: {e}")
+            return self.bot.send_message(chat_id, self.MARKDOWN_ESCAPED.sub(r'\1', text))
+    
+    @classmethod
+    def escape_markdown(cls, text):
+        return cls.MARKDOWN_SPECIAL.sub(r'\\\1', text)
+    
+    @classmethod
+    def image_groups(cls, images):
+        """Медиагруппы изображений письма с частями журнала: ('images:N', до 10 изображений)"""
+        limit = cls.TELEGRAM_MEDIA_GROUP_LIMIT
+        return [
+            (f"images:{number}", images[start:start + limit])
+            for number, start in enumerate(range(0, len(images), limit), 1)
+        ]
+    
+    def deliver_part(self, uid, part, request, cost=1):
+        """Отправляет часть письма, если она не ушла в прошлый раз.
+        
+        Как и все методы отправки, это генератор: выдает (чат, запрос, стоимость),
+        выполняет их MailPipeline.run_requests, результат или ошибка возвращаются в yield.
+        """
+        if self.journal.is_sent(uid, part):
+            log.debug(f"Часть '{part}' уже была отправлена, пропускаем")
+            return
+        yield self.chat_for(uid), request, cost
+        self.journal.record(uid, part)
+    
+    def photo_request(self, images, chat_id):
+        """Запрос Bot API для группы до 10 фото: одно - send_photo, несколько - медиагруппа"""
+        if len(images) == 1:
+            return lambda: self.send_cached(
+                'photo', images[0], lambda media: self.bot.send_photo(chat_id, media)
+            )
+        return lambda: self.send_media_group(chat_id, images)
+    
+    def document_request(self, files, chat_id):
+        """Запрос Bot API для группы до 10 файлов: один - send_document, несколько - альбом"""
+        if len(files) > 1:
+            return lambda: self.send_media_group(chat_id, files, 'document')
+        file_info = files[0]
+        # Данные читаются прямо из спула
+        return lambda: self.send_cached(
+            'document', file_info, lambda media: self.bot.send_document(
+                chat_id,
+                media,
+                visible_file_name=file_info['filename'],
+                caption=f"Файл из письма: {file_info['filename']}"
+            )
+        )
+    
+    def send_files(self, uid, files):
+        """Отправляет файлы письма (не изображения) альбомами документов до 10 штук"""
+        chat_id = self.chat_for(uid)
+        log.debug(f"Отправка {len(files)} файлов...")
+        
+        numbered = []
+        for i, file_info in enumerate(files, 1):
+            if file_info.get('spool') is None:
+                log.debug(f"Файл {file_info['filename']} не загружался, пропускаем")
+            else:
+                numbered.append((i, file_info))
+        
+        limit = self.TELEGRAM_MEDIA_GROUP_LIMIT
+        for start in range(0, len(numbered), limit):
+            group = numbered[start:start + limit]
+            names = ", ".join(file_info['filename'] for _, file_info in group)
+            # Одиночный файл - прежняя запись журнала, альбом - по номерам первого и последнего файла
+            if len(group) == 1:
+                part = f"file:{group[0][0]}:{group[0][1]['filename']}"
+            else:
+                part = f"files:{group[0][0]}-{group[-1][0]}"
+            try:
+                yield from self.deliver_part(
+                    uid, part, self.document_request([file_info for _, file_info in group], chat_id), cost=len(group)
+                )
+                log.debug(f"✓ Отправлено файлов: {len(group)} ({names})")
+            except Exception as e:
+                log.error(f"Ошибка отправки файлов {names}: {e}")
+    
     def send_to_telegram(self, email_message, images, files, email_id):
         """Отправка письма, изображений и информации о файлах в Telegram"""
-        success = False
+        with self.metrics.timer('deliver'):
+            return (yield from self._send_to_telegram(email_message, images, files, email_id))
+    
+    def _send_to_telegram(self, email_message, images, files, email_id):
         try:
-            chat_id = self.telegram_config['chat_id']
+            uid = int(email_id)
+            chat_id = self.chat_for(uid)
             
-            print("Начало отправки в Telegram...")
+            log.debug("Начало отправки в Telegram...")
             
             # Сначала отправляем текст письма
             try:
-                self.bot.send_message(chat_id, email_message, parse_mode='Markdown')
-                print("✓ Текст письма отправлен")
-                success = True
+                yield from self.deliver_part(uid, 'text', lambda: self.send_markdown(chat_id, email_message))
+                log.debug("✓ Текст письма отправлен")
             except Exception as e:
-                print(f"✗ Ошибка отправки текста: {e}")
+                log.error(f"✗ Ошибка отправки текста: {e}")
                 return False
             
             # Затем отправляем изображения (если есть)
             if images:
-                print(f"Отправка {len(images)} изображений...")
+                log.debug(f"Отправка {len(images)} изображений...")
                 
                 try:
-                    # Для изображений используем медиагруппу если их несколько
-                    if len(images) > 1:
-                        media_group = []
-                        for img in images:
-                            photo = io.BytesIO(img['data'])
-                            photo.name = img['filename']
-                            media_group.append(telebot.types.InputMediaPhoto(photo))
-                        
-                        self.bot.send_media_group(chat_id, media_group)
-                        print(f"✓ Отправлено {len(images)} изображений медиагруппой")
-                    else:
-                        # Одно изображение
-                        img = images[0]
-                        photo = io.BytesIO(img['data'])
-                        photo.name = img['filename']
-                        self.bot.send_photo(chat_id, photo)
-                        print(f"✓ Изображение отправлено")
+                    # Несколько изображений - медиагруппами, не больше 10 в группе
+                    for part, group in self.image_groups(images):
+                        yield from self.deliver_part(uid, part, self.photo_request(group, chat_id), cost=len(group))
+                    log.debug(f"✓ Отправлено изображений: {len(images)}")
                         
                 except Exception as e:
-                    print(f"Ошибка отправки изображений: {e}")
+                    log.error(f"Ошибка отправки изображений: {e}")
                     # Продолжаем обработку даже если изображения не отправились
             
             # Обрабатываем файлы (не изображения)
             if files:
-                print(f"Отправка {len(files)} файлов...")
-                
-                for i, file_info in enumerate(files, 1):
-                    try:
-                        print(f"Отправка файла {i}/{len(files)}: {file_info['filename']}")
-                        
-                        # Для файлов используем send_document
-                        file_io = io.BytesIO(file_info['data'])
-                        file_io.name = file_info['filename']
-                        
-                        self.bot.send_document(
-                            chat_id, 
-                            file_io, 
-                            visible_file_name=file_info['filename'],
-                            caption=f"Файл из письма: {file_info['filename']}"
-                        )
-                        print(f"✓ Файл {file_info['filename']} отправлен")
-                        
-                        # Небольшая пауза между отправкой файлов
-                        time.sleep(1)
-                        
-                    except Exception as e:
-                        print(f"Ошибка отправки файла {file_info['filename']}: {e}")
+                yield from self.send_files(uid, files)
             
-            print("✓ Все данные отправлены в Telegram")
+            log.debug("✓ Все данные отправлены в Telegram")
             return True
             
         except Exception as e:
-            print(f"✗ Критическая ошибка отправки в Telegram: {e}")
+            log.error(f"✗ Критическая ошибка отправки в Telegram: {e}")
+            return False
+    
+    def record_delivery_delay(self, msg):
+        """Задержка от заголовка Date до подтверждения Telegram"""
+        try:
+            sent_at = parsedate_to_datetime(msg.get('Date'))
+        except Exception:
+            return
+        if sent_at.tzinfo is None:
+            return
+        delay = max(0.0, time.time() - sent_at.timestamp())
+        self.metrics.observe('delivery_delay_seconds', delay, self.metrics.DELAY_BUCKETS)
+        self.metrics.set('last_delivery_delay_seconds', round(delay, 3), mailbox=self.mailbox_key)
+    
+    def record_arrivals(self, count):
+        """Учитывает новые письма прохода для автоматического режима дайджеста"""
+        now = time.monotonic()
+        self.arrivals.append((now, count))
+        while self.arrivals and self.arrivals[0][0] < now - self.DIGEST_RATE_WINDOW:
+            self.arrivals.popleft()
+    
+    def digest_active(self):
+        if self.digest_mode == 'always':
+            return True
+        if self.digest_mode != 'auto':
             return False
+        return sum(count for _, count in self.arrivals) >= self.digest_threshold
+    
+    def format_digest_entry(self, msg, images, files, text_content):
+        """Короткая запись о письме для дайджеста"""
+        escape = self.escape_markdown
+        subject = self.decode_mime_words(msg.get("Subject", "Без темы"))
+        from_ = self.decode_mime_words(msg.get("From", "Неизвестный отправитель"))
+        text = ' '.join((text_content or '').split())
+        if len(text) > self.DIGEST_PREVIEW_CHARS:
+            text = text[:self.DIGEST_PREVIEW_CHARS] + "..."
+        
+        entry = f"📧 *{escape(from_)}*\n📣 {escape(subject)}\n{escape(text)}"
+        if images:
+            entry += f"\n🖼 Изображений: {len(images)}"
+        if files:
+            entry += "\n💾 " + escape(", ".join(file_info['filename'] for file_info in files))
+        return entry
+    
+    def pack_digest(self, entries, total):
+        """Раскладывает записи по сообщениям до 4096 символов, не разрывая записи.
+        
+        Возвращает список (UID в сообщении, текст сообщения).
+        """
+        limit = self.TELEGRAM_MESSAGE_LIMIT
+        messages = []
+        uids = []
+        text = f"📬 *Дайджест, новых писем: {total}*"
+        for uid, entry in entries:
+            entry = entry[:limit - 2]
+            if len(text) + 2 + len(entry) > limit:
+                if uids:
+                    messages.append((uids, text))
+                    uids, text = [], ""
+                else:
+                    # Первая запись не помещается вместе с заголовком - укорачиваем ее
+                    entry = entry[:limit - 2 - len(text)]
+            text = f"{text}\n\n{entry}" if text else entry
+            uids.append(uid)
+        if uids:
+            messages.append((uids, text))
+        return messages
+    
+    def send_digest(self, items):
+        """Отправляет пачку писем дайджестом.
+        
+        Тексты - одним или несколькими сообщениями, изображения всех писем -
+        общими медиагруппами до 10 штук, файлы - как обычно. items - список
+        (uid, результат parse_message); возвращает список доставленных UID.
+        """
+        with self.metrics.timer('deliver_digest'):
+            # Письма, направленные правилами в другие чаты, - отдельным дайджестом
+            chats = {}
+            for item in items:
+                chats.setdefault(self.chat_for(item[0]), []).append(item)
+            delivered = []
+            for chat_id, chat_items in chats.items():
+                delivered += yield from self._send_digest(chat_items, chat_id)
+            return delivered
+    
+    def _send_digest(self, items, chat_id):
+        journal = self.journal
+        log.info(f"Отправка дайджеста из {len(items)} писем...")
+        
+        failed = set()
+        entries = [
+            (uid, self.format_digest_entry(msg, images, files, text_content))
+            for uid, (msg, images, files, _, text_content) in items
+            if not journal.is_sent(uid, 'text')
+        ]
+        for uids, text in self.pack_digest(entries, len(items)):
+            try:
+                yield chat_id, lambda: self.send_markdown(chat_id, text), 1
+                for uid in uids:
+                    journal.record(uid, 'text')
+            except Exception as e:
+                log.error(f"✗ Ошибка отправки дайджеста: {e}")
+                failed.update(uids)
+        
+        # Изображения разных писем - в общих медиагруппах; в журнал идут те же части
+        # 'images:N', что и при обычной доставке, - смена режима не повторит отправку
+        photos = [
+            ((uid, part), image)
+            for uid, prepared in items
+            if uid not in failed
+            for part, group in self.image_groups(prepared[1])
+            if not journal.is_sent(uid, part)
+            for image in group
+        ]
+        remaining = Counter(key for key, _ in photos)
+        limit = self.TELEGRAM_MEDIA_GROUP_LIMIT
+        for start in range(0, len(photos), limit):
+            group = photos[start:start + limit]
+            try:
+                yield chat_id, self.photo_request([image for _, image in group], chat_id), len(group)
+            except Exception as e:
+                log.error(f"Ошибка отправки изображений дайджеста: {e}")
+                continue
+            for key, _ in group:
+                remaining[key] -= 1
+                if not remaining[key]:
+                    journal.record(*key)
+        if photos:
+            log.debug(f"✓ Отправлено изображений: {len(photos)}")
+        
+        for uid, prepared in items:
+            if uid not in failed and prepared[2]:
+                yield from self.send_files(uid, prepared[2])
+        
+        return [uid for uid, _ in items if uid not in failed]
+    
+    def select_text_parts(self, parts):
+        """Текстовые части для превью и лимит байт.
+        
+        HTML берется, только если текстовой версии нет или она пустая.
+        """
+        body_parts = [part for part in parts if part['disposition'] != 'attachment']
+        plain_parts = [part for part in body_parts if part['type'] == 'text/plain']
+        html_parts = [part for part in body_parts if part['type'] == 'text/html']
+        if sum(part['size'] for part in plain_parts) > 16 or not html_parts:
+            return plain_parts, self.text_preview_bytes
+        return html_parts, self.html_preview_bytes
+    
+    def fetch_text_parts(self, messages, session):
+        """Загружает только начало текстовых частей, достаточное для превью, сразу у пакета писем.
+        
+        messages - список (UID, части из BODYSTRUCTURE). Одна команда FETCH на
+        каждую пару (секция, лимит) - у большинства писем это BODY.PEEK[1]<0.N>.
+        Возвращает {UID: [(часть, сырые байты, обрезано ли)]}.
+        """
+        plans = {}
+        requests = {}
+        for uid, parts in messages:
+            selected, limit = self.select_text_parts(parts)
+            plans[uid] = (selected, limit)
+            for part in selected:
+                max_bytes = limit if part['size'] > limit else None
+                requests.setdefault((part['section'], max_bytes), []).append(uid)
+        
+        fetched = {}
+        for (section, max_bytes), uids in requests.items():
+            for uid, raw in session.fetch_sections(uids, section, max_bytes).items():
+                fetched[uid, section] = raw
+        
+        text_parts = {}
+        for uid, (selected, limit) in plans.items():
+            text_parts[uid] = []
+            total = 0
+            for part in selected:
+                raw = fetched.get((uid, part['section']))
+                if raw:
+                    text_parts[uid].append((part, raw, part['size'] > limit))
+                    total += len(raw)
+                if total >= limit:
+                    break
+        return text_parts
+    
+    def render_text_preview(self, text_parts):
+        """Декодирует загруженные текстовые части в превью (HTML очищается)"""
+        text = ""
+        content_type = None
+        for part, raw, partial in text_parts:
+            try:
+                payload = self.decode_transfer_encoding(raw, part['encoding'], partial)
+            except Exception as e:
+                log.warning(f"Ошибка декодирования части {part['section']}: {e}")
+                continue
+            text += self.decode_text_payload(payload, part['charset'])
+            content_type = part['type']
+        
+        if not text.strip():
+            return "Текст письма отсутствует или не может быть прочитан"
+        if content_type == 'text/html':
+            log.debug("Обнаружен HTML контент, выполняется очистка...")
+            text = self.clean_html_to_text(text, self.PREVIEW_CHARS)
+            log.debug("HTML очищен успешно")
+        return text
+    
+    def spool_attachment(self, uid, part, filename, session):
+        """Потоково загружает часть письма кусками: IMAP -> декодер -> спул.
+        
+        Каждый кусок резервирует память в общем бюджете, поэтому
+        при нехватке памяти загрузка ждет, а не раздувает процесс.
+        """
+        spool = self.new_spool(filename)
+        decoder = TransferDecoder(part['encoding'])
+        chunk_bytes = self.attachment_chunk_bytes
+        offset = 0
+        try:
+            while True:
+                self.memory_budget.acquire(chunk_bytes)
+                try:
+                    raw = session.fetch_part(uid, part['section'], chunk_bytes, offset)
+                    if not raw:
+                        break
+                    offset += len(raw)
+                    spool.write(decoder.feed(raw))
+                finally:
+                    self.memory_budget.release(chunk_bytes)
+                if len(raw) < chunk_bytes:
+                    break
+            spool.write(decoder.finish())
+        except Exception as e:
+            log.error(f"Ошибка загрузки вложения {filename}: {e}")
+            spool.close()
+            return None
+        
+        if not spool.size:
+            spool.close()
+            return None
+        return spool
+    
+    def fetch_selected_attachments(self, uid, parts, session):
+        """Загружает по одному только вложения, проходящие по лимитам Telegram"""
+        images = []
+        files = []
+        
+        for part in parts:
+            if not part['filename']:
+                continue
+            filename = self.decode_mime_words(part['filename'])
+            content_type = part['type']
+            is_image, estimated_size, fits = self.classify_attachment(
+                filename, content_type, part['encoding'], part['size']
+            )
+            if not fits:
+                files.append({'filename': filename, 'spool': None, 'type': content_type, 'size': estimated_size})
+                continue
+            
+            # Повторная доставка (письмо не отправилось в прошлый раз) - из архива, без IMAP
+            spool = self.archive.open(self.archive_key(uid, part['section']), filename) if self.archive else None
+            if spool is not None:
+                log.debug(f"Вложение {filename} взято из архива")
+            else:
+                log.debug(f"Загрузка вложения: {filename} ({content_type})")
+                spool = self.spool_attachment(uid, part, filename, session)
+            if spool is None:
+                log.warning(f"Пустые данные для вложения: {filename}")
+                continue
+            
+            file_info = {
+                'filename': filename,
+                'spool': spool,
+                'type': content_type,
+                'size': spool.size,
+                'uid': uid,
+                'part': part['section'],
+            }
+            if is_image:
+                images.append(file_info)
+            else:
+                files.append(file_info)
+        
+        log.debug(f"Итог: изображений - {len(images)}, файлов - {len(files)}")
+        return images, files
+    
+    def fetch_new_messages(self, uids, session=None):
+        """Стадия загрузки: выдает по одному словарю на письмо.
+        
+        В режиме 'full' - {'uid', 'raw'} с письмом целиком. В режиме
+        'structure' - заголовки, начало текстовых частей и вложения,
+        проходящие по лимитам Telegram. 'raw' = None - письмо не получено.
+        Письма, отфильтрованные правилами, - {'uid', 'action'} без загрузки тела.
+        session - соединение для загрузки (при догоне - одно из нескольких).
+        """
+        session = session or self.session
+        if self.fetch_mode == 'full':
+            if self.rules is not None:
+                uids, skipped = self.filter_by_headers(uids, session)
+                yield from skipped
+            for uid, raw_email in session.fetch_messages(uids):
+                yield {'uid': uid, 'raw': raw_email or None}
+            return
+        
+        for start in range(0, len(uids), session.FETCH_BATCH_MAX_MESSAGES):
+            messages = []
+            for item in session.fetch_structures(uids[start:start + session.FETCH_BATCH_MAX_MESSAGES]):
+                uid = int(item['UID'])
+                header = item.get('BODY[HEADER]')
+                header = header if isinstance(header, bytes) else b''
+                rule = self.apply_rules(uid, header)
+                if rule is not None and rule.action in MailRules.SKIP_ACTIONS:
+                    yield {'uid': uid, 'action': rule.action}
+                    continue
+                try:
+                    parts = session.parse_bodystructure(item.get('BODYSTRUCTURE'))
+                except Exception as e:
+                    # Непонятная структура - загружаем письмо целиком
+                    log.warning(f"Не удалось разобрать BODYSTRUCTURE письма {uid}: {e}")
+                    yield {'uid': uid, 'raw': session.fetch_part(uid, '') or None}
+                    continue
+                messages.append((uid, header, parts))
+            
+            # Превью всего пакета - по запросу на секцию, а не по запросу на письмо
+            text_parts = self.fetch_text_parts([(uid, parts) for uid, _, parts in messages], session)
+            for uid, header, parts in messages:
+                images, files = self.fetch_selected_attachments(uid, parts, session)
+                yield {
+                    'uid': uid,
+                    'header': header,
+                    'text_parts': text_parts[uid],
+                    'images': images,
+                    'files': files,
+                }
+    
+    def parse_message(self, item):
+        """Стадия разбора: MIME, очистка HTML и форматирование сообщения.
+        
+        Возвращает (msg, images, files, email_message, text_content)
+        или None, если письмо не получено.
+        """
+        with self.metrics.timer('parse'):
+            prepared = self._parse_message(item)
+        if prepared is not None:
+            for kind, attachments in (('image', prepared[1]), ('file', prepared[2])):
+                for file_info in attachments:
+                    self.metrics.inc('attachments_total', kind=kind)
+                    self.metrics.inc('attachment_bytes_total', file_info['size'])
+        return prepared
+    
+    def _parse_message(self, item):
+        uid = item['uid']
+        log.debug(f"Обработка письма ID: {uid}")
+        
+        if 'header' in item:
+            msg = email.message_from_bytes(item['header'])
+            images, files = item['images'], item['files']
+            text_content = self.render_text_preview(item['text_parts'])
+        elif item['raw']:
+            # Один проход по письму: заголовки частей и смещения тел
+            index = MimeIndex(item['raw'])
+            msg = index.headers
+            images, files = self.extract_attachments(index, uid)
+            text_content = self.extract_text_from_email(index)
+            index.release()
+        else:
+            log.error(f"✗ Пустые данные письма {uid}")
+            return None
+        
+        from_header = msg.get('From', 'Неизвестный отправитель')
+        subject_header = msg.get('Subject', 'Без темы')
+        log.debug(f"Письмо от: {from_header}")
+        log.debug(f"Тема: {subject_header}")
+        
+        if images:
+            log.debug(f" - Найдено изображений: {len(images)}")
+        if files:
+            log.debug(f" - Найдено файлов: {len(files)}")
+        
+        email_message = self.format_email_message(msg, files, text_content)
+        return msg, images, files, email_message, text_content
     
     def process_new_emails(self):
-        """Обработка новых писем"""
-        mail_connection = None
+        """Обработка новых писем (один проход конвейера)"""
+        return asyncio.run(MailPipeline(self).run_once())
+    
+    def search_new_uids(self):
+        """Поиск непрочитанных писем с UID выше сохраненной отметки"""
+        state = self.sync_state
+        mail_connection = self.mail
+        
+        if state.uidvalidity != self.session.uidvalidity:
+            # UID прежней "эпохи" папки больше ничего не значат
+            if state.uidvalidity is not None:
+                log.warning(f"UIDVALIDITY изменился ({state.uidvalidity} → {self.session.uidvalidity}), полная синхронизация")
+            state.reset(self.session.uidvalidity)
+            self.delivered_uids.clear()
+            state.save()
+        
+        if self.journal.uidvalidity != state.uidvalidity:
+            # Письма, доставленные до перезапуска, но не помеченные прочитанными
+            self.journal.load(state.uidvalidity)
+            self.delivered_uids |= self.journal.delivered_uids()
+        
+        if state.last_uid:
+            criteria = f'UID {state.last_uid + 1}:* UNSEEN'
+        else:
+            criteria = 'UNSEEN'
+        
+        log.debug("Поиск непрочитанных писем...")
+        with self.metrics.timer('imap_search'):
+            status, messages = mail_connection.uid('SEARCH', None, criteria)
+        
+        if status != 'OK':
+            log.error("✗ Ошибка поиска писем")
+            return None
+        
+        # "n:*" всегда включает последний UID папки, даже если он меньше n
+        return sorted(uid for uid in map(int, messages[0].split()) if uid > state.last_uid)
+    
+    def advance_sync_state(self, uids, failed_uids):
+        """Сдвигает отметку до первого недоставленного письма и сохраняет ее"""
+        state = self.sync_state
+        if failed_uids:
+            new_last = min(failed_uids) - 1
+        else:
+            new_last = max(uids)
+        
+        if new_last > state.last_uid:
+            state.last_uid = new_last
+            state.save()
+        
+        # Все, что ниже отметки, повторно не найдется - забываем
+        self.delivered_uids = {uid for uid in self.delivered_uids if uid > state.last_uid}
+        self.journal.prune(state.last_uid)
+        self.journal.flush()
+    
+    def start_monitoring(self, interval=60):
+        """Запуск мониторинга почты"""
+        log.info(f"🚀 Запуск мониторинга почты")
+        log.info(f"📧 Email: {self.email_config['email']}")
+        log.info(f"⏱  Максимальный интервал опроса без IDLE: {interval} секунд")
+        log.info(f"💬 Telegram чат: {self.telegram_config['chat_id']}")
+        if self.archive is not None:
+            log.info(f"📁 Архив вложений: {self.attachments_dir} (до {self.archive.max_bytes // (1024 * 1024)} МБ)")
+        log.info("Мониторинг запущен. Для остановки нажмите Ctrl+C")
+        
+        self.start_metrics_server()
+        try:
+            asyncio.run(MailPipeline(self).run(interval))
+        except KeyboardInterrupt:
+            log.info("Мониторинг остановлен пользователем")
+
+class ReorderBuffer:
+    """Передает письма дальше в заданном порядке UID, в каком бы порядке их ни загрузили.
+    
+    Загрузчик не уходит вперед очереди больше чем на max_ahead писем,
+    чтобы один медленный диапазон не копил в памяти все остальные.
+    """
+    
+    MISSING = object()
+    
+    def __init__(self, order, emit, max_ahead):
+        self.order = order
+        self.position = {uid: index for index, uid in enumerate(order)}
+        self.emit = emit
+        self.max_ahead = max_ahead
+        self.next = 0
+        self.pending = {}
+        self.lock = asyncio.Lock()
+        self.moved = asyncio.Condition()
+    
+    async def wait_turn(self, uids):
+        """Ждет, пока диапазон не окажется в пределах окна"""
+        first = self.position[uids[0]]
+        async with self.moved:
+            await self.moved.wait_for(lambda: first - self.next <= self.max_ahead)
+    
+    async def put(self, uid, item):
+        if uid not in self.position:
+            return
+        self.pending[uid] = item
+        # Под замком: иначе два загрузчика могли бы передавать письма вперемешку
+        async with self.lock:
+            while self.next < len(self.order) and self.order[self.next] in self.pending:
+                item = self.pending.pop(self.order[self.next])
+                self.next += 1
+                if item is not self.MISSING:
+                    await self.emit(item)
+        async with self.moved:
+            self.moved.notify_all()
+    
+    async def skip(self, uids, received=()):
+        """Письма диапазона, не пришедшие в ответах FETCH, больше не ждем"""
+        for uid in uids:
+            if uid not in received:
+                await self.put(uid, self.MISSING)
+
+class MailPipeline:
+    """Асинхронный конвейер: загрузка IMAP -> разбор MIME -> доставка в Telegram.
+    
+    Стадии связаны ограниченными очередями: пока доставляется письмо N,
+    письмо N+1 уже загружается и разбирается. Команды IMAP выполняются
+    в пуле потоков строго по одной (соединение не потокобезопасно),
+    ожидание IDLE не занимает поток. Изображения пережимаются в пуле
+    процессов, чтобы декодирование не конкурировало с остальными стадиями.
+    """
+    
+    QUEUE_SIZE = 4
+    _DONE = object()
+    
+    def __init__(self, bot, io_executor=None, cpu_executor=None, image_executor=None):
+        self.bot = bot
+        self.session = bot.session
+        self.io_executor = io_executor or ThreadPoolExecutor(max_workers=4, thread_name_prefix="mail-io")
+        self.cpu_executor = cpu_executor or ThreadPoolExecutor(max_workers=2, thread_name_prefix="mail-parse")
+        self._owns_executors = io_executor is None
+        # Свой пул процессов для изображений создается при первом письме с картинками
+        self.image_executor = image_executor
+        self._owns_image_executor = image_executor is None
+        # Ограничение заданий на изображения в работе, создается вместе с пулом
+        self.image_slots = None
+        self.imap_lock = asyncio.Lock()
+    
+    async def imap(self, func, *args):
+        """Выполняет блокирующую операцию над IMAP-соединением в пуле потоков"""
+        async with self.imap_lock:
+            return await self.run_in(self.io_executor, func, *args)
+    
+    async def run_in(self, executor, func, *args):
+        """run_in_executor с профилированием задачи, если оно включено.
+        
+        Контекст логов (письмо, стадия) переносится в поток пула, как в asyncio.to_thread.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(executor, context.run, self.bot.metrics.profiler.call, func, *args)
+    
+    async def run_requests(self, requests):
+        """Выполняет генератор отправки (send_to_telegram, send_digest) и возвращает его результат.
+        
+        Лимиты Telegram ожидаются в цикле событий, сам запрос уходит в пул потоков.
+        """
+        limiter = self.bot.rate_limiter
+        submit = lambda request: self.run_in(self.io_executor, request)
+        result, error = None, None
+        try:
+            while True:
+                try:
+                    if error is not None:
+                        chat_id, request, cost = requests.throw(error)
+                    else:
+                        chat_id, request, cost = requests.send(result)
+                except StopIteration as stop:
+                    return stop.value
+                result, error = None, None
+                try:
+                    result = await limiter.call(chat_id, request, submit, cost)
+                except Exception as e:
+                    error = e
+        finally:
+            requests.close()
+    
+    async def connect(self):
+        if self.session.mail is None:
+            # Пауза перед переподключением - без блокировки потока
+            delay = self.session.backoff_delay()
+            if delay:
+                log.warning(f"Повторное подключение через {delay:.0f} сек...")
+                await asyncio.sleep(delay)
+        return await self.imap(self.bot.connect_to_email, False)
+    
+    async def run_pass(self):
+        """Один проход: поиск новых писем и их обработка через конвейер"""
+        bot = self.bot
+        # Проход идет в своей задаче asyncio - значение не выходит за ее пределы
+        LOG_CONTEXT.set({**LOG_CONTEXT.get(), 'mailbox': bot.mailbox_key})
+        bot.last_found_count = 0
+        bot.last_failed_count = 0
+        bot.message_chats.clear()
         try:
-            if not self.connect_to_email():
+            if not await self.connect():
                 return False
             
-            mail_connection = self.mail
-            
-            # Поиск непрочитанных писем
-            print("Поиск непрочитанных писем...")
-            status, messages = mail_connection.search(None, 'UNSEEN')
+            # Уведомления, пришедшие до поиска, им и будут покрыты
+            await self.imap(self.session.reset_pending_changes)
             
-            if status != 'OK':
-                print("✗ Ошибка поиска писем")
+            email_ids = await self.imap(bot.search_new_uids)
+            if email_ids is None:
                 return False
             
-            email_ids = messages[0].split()
+            bot.last_found_count = len(email_ids)
+            bot.record_arrivals(len(email_ids))
             
             if not email_ids:
-                print("✓ Новых писем нет")
+                log.info("✓ Новых писем нет")
+                # Письма, которые не удалось пометить в прошлых проходах
+                await self.imap(bot.mark_delivered_read, [])
+                bot.metrics.set('backlog', 0, mailbox=bot.mailbox_key)
+                bot.metrics.log_summary(bot.metrics_log_interval)
                 return True
             
-            print(f"Найдено {len(email_ids)} новых писем")
+            log.info(f"Найдено {len(email_ids)} новых писем")
+            bot.metrics.set('backlog', len(email_ids), mailbox=bot.mailbox_key)
             
             for email_id in email_ids:
-                email_id_str = email_id.decode('utf-8')
-                
-                if email_id_str in self.processed_emails:
-                    print(f"Письмо {email_id_str} уже обработано, пропускаем")
-                    continue
-                
-                print(f"Обработка письма ID: {email_id_str}")
-                
-                status, msg_data = mail_connection.fetch(email_id, '(RFC822)')
-                
-                if status != 'OK':
-                    print(f"✗ Ошибка получения письма {email_id_str}")
+                if email_id in bot.delivered_uids:
+                    log.debug(f"Письмо {email_id} уже обработано, пропускаем")
+            pending_uids = [uid for uid in email_ids if uid not in bot.delivered_uids]
+            
+            digest = bot.digest_active()
+            if digest:
+                log.info(f"Режим дайджеста: до {bot.digest_max_items} писем в одной отправке")
+            
+            catchup = bot.catchup_active(len(pending_uids))
+            result = {'fetched': set(), 'failed': [], 'delivered': [], 'mark_read': []}
+            await self.run_stages(pending_uids, result, digest, catchup)
+            failed_uids = result['failed']
+            
+            # Письма, не вернувшиеся в ответах FETCH, попробуем в следующий раз
+            for email_id in pending_uids:
+                if email_id not in result['fetched']:
+                    log.error(f"✗ Ошибка получения письма {email_id}")
+                    failed_uids.append(email_id)
+            
+            # Флаги \Seen для всех доставленных писем - одной командой
+            await self.imap(bot.mark_delivered_read, result['delivered'] + result['mark_read'])
+            
+            await self.imap(bot.advance_sync_state, email_ids, failed_uids)
+            
+            bot.last_failed_count = len(failed_uids)
+            if failed_uids:
+                bot.metrics.inc('mails_total', len(failed_uids), mailbox=bot.mailbox_key, status='failed')
+            bot.metrics.set('backlog', len(failed_uids), mailbox=bot.mailbox_key)
+            
+            for cache in bot.caches():
+                log.info(f"Статистика: {cache.stats()}")
+                await asyncio.get_running_loop().run_in_executor(self.io_executor, cache.save)
+            if bot.rules is not None:
+                log.info(f"Статистика: {bot.rules.stats()}")
+            if bot.archive is not None:
+                log.info(f"Статистика: {bot.archive.stats()}")
+            
+            bot.metrics.log_summary(bot.metrics_log_interval)
+            
+            # Соединение остается открытым для IDLE и следующих проходов
+            return True
+            
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"✗ Ошибка обработки писем: {e}")
+            bot.metrics.inc('errors_total', stage='pass')
+            # Отправленное до ошибки не должно уйти повторно
+            await asyncio.get_running_loop().run_in_executor(self.io_executor, bot.journal.flush)
+            # Состояние соединения неизвестно - переподключимся на следующем проходе
+            await self.imap(bot.drop_connection)
+            return False
+    
+    async def run_stages(self, uids, result, digest=False, catchup=False):
+        """Запускает стадии конвейера и дожидается их завершения"""
+        parse_queue = asyncio.Queue(self.QUEUE_SIZE)
+        image_queue = asyncio.Queue(self.QUEUE_SIZE)
+        deliver_queue = asyncio.Queue(self.QUEUE_SIZE)
+        fetch_stage = self.catchup_fetch_stage if catchup else self.fetch_stage
+        stages = [
+            asyncio.create_task(fetch_stage(uids, parse_queue, result), context=self.stage_context('fetch')),
+            asyncio.create_task(self.parse_stage(parse_queue, image_queue), context=self.stage_context('parse')),
+            asyncio.create_task(self.image_stage(image_queue, deliver_queue), context=self.stage_context('image')),
+            asyncio.create_task(self.deliver_stage(deliver_queue, result, digest),
+                                context=self.stage_context('deliver')),
+        ]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            for task in stages:
+                task.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            # Незавершенные письма: освобождаем память и временные файлы вложений
+            for queue in (parse_queue, image_queue, deliver_queue):
+                while not queue.empty():
+                    self.release_item(queue.get_nowait())
+            raise
+    
+    @staticmethod
+    def stage_context(stage):
+        """Копия текущего контекста с полем stage для задачи стадии"""
+        context = contextvars.copy_context()
+        context.run(LOG_CONTEXT.set, {**LOG_CONTEXT.get(), 'stage': stage})
+        return context
+    
+    def release_item(self, item):
+        if item is self._DONE or item is None:
+            return
+        if isinstance(item, dict):
+            self.bot.release_attachments(item.get('images', []), item.get('files', []))
+        else:
+            _, prepared = item
+            if prepared:
+                self.bot.release_attachments(prepared[1], prepared[2])
+    
+    async def fetch_stage(self, uids, parse_queue, result):
+        messages = self.bot.fetch_new_messages(uids)
+        try:
+            while True:
+                start = time.perf_counter()
+                item = await self.imap(next, messages, None)
+                if item is None:
+                    break
+                self.bot.metrics.observe('stage_seconds', time.perf_counter() - start, stage='imap_fetch')
+                await self.pass_fetched(item, parse_queue, result)
+        finally:
+            messages.close()
+        await parse_queue.put(self._DONE)
+    
+    async def pass_fetched(self, item, parse_queue, result):
+        """Загруженное письмо - на разбор, отфильтрованное правилом - сразу в итог"""
+        result['fetched'].add(item['uid'])
+        if 'action' in item:
+            self.skip_message(item, result)
+        else:
+            await parse_queue.put(item)
+    
+    async def catchup_fetch_stage(self, uids, parse_queue, result):
+        """Догон большой очереди: диапазоны UID загружаются по нескольким соединениям.
+        
+        Основное соединение работает наравне с дополнительными; письма идут
+        на разбор и доставку в порядке расписания диапазонов, поэтому
+        в каждый чат они приходят в исходном порядке поступления.
+        """
+        bot = self.bot
+        ranges = deque(bot.catchup_ranges(uids))
+        order = [uid for uid_range in ranges for uid in uid_range]
+        extra = min(bot.catchup_connections - 1, len(ranges) - 1)
+        sessions = await asyncio.gather(
+            *(self.run_in(self.io_executor, bot.open_catchup_session) for _ in range(extra))
+        )
+        sessions = [session for session in sessions if session is not None]
+        if len(sessions) < extra:
+            log.warning(f"Дополнительных соединений для догона открыто {len(sessions)} из {extra}: "
+                        f"исчерпан imap_max_connections или не удалось подключиться")
+        log.info(f"Догон очереди: {len(uids)} писем, {len(ranges)} диапазонов, соединений: {len(sessions) + 1}")
+        
+        buffer = ReorderBuffer(
+            order,
+            lambda item: self.pass_fetched(item, parse_queue, result),
+            bot.catchup_range_size * (len(sessions) + 1) * 2,
+        )
+        
+        async def worker(session, call):
+            while ranges:
+                uid_range = ranges.popleft()
+                await buffer.wait_turn(uid_range)
+                received = set()
+                messages = bot.fetch_new_messages(uid_range, session)
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        item = await call(next, messages, None)
+                        if item is None:
+                            break
+                        bot.metrics.observe('stage_seconds', time.perf_counter() - start, stage='imap_fetch')
+                        received.add(item['uid'])
+                        await buffer.put(item['uid'], item)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Соединение сломалось - остаток диапазона повторим в следующем проходе,
+                    # оставшиеся диапазоны заберут другие соединения
+                    log.error(f"✗ Ошибка загрузки диапазона {session.format_uid_set(uid_range)}: {e}")
+                    return
+                finally:
+                    messages.close()
+                    await buffer.skip(uid_range, received)
+        
+        async def pooled(func, *args):
+            # У дополнительного соединения один загрузчик - блокировка не нужна
+            return await self.run_in(self.io_executor, func, *args)
+        
+        try:
+            await asyncio.gather(
+                worker(self.session, self.imap),
+                *(worker(session, pooled) for session in sessions)
+            )
+            # Диапазоны, которые некому было загрузить
+            while ranges:
+                await buffer.skip(ranges.popleft())
+        except BaseException:
+            for item in buffer.pending.values():
+                if item is not buffer.MISSING:
+                    self.release_item(item)
+            raise
+        finally:
+            for session in sessions:
+                await self.run_in(self.io_executor, bot.close_catchup_session, session)
+        await parse_queue.put(self._DONE)
+    
+    async def parse_stage(self, parse_queue, image_queue):
+        while True:
+            item = await parse_queue.get()
+            if item is self._DONE:
+                break
+            try:
+                with log_context(uid=item['uid']):
+                    prepared = await self.run_in(self.cpu_executor, self.bot.parse_message, item)
+            except Exception as e:
+                log.error(f"✗ Ошибка разбора письма {item['uid']}: {e}")
+                self.release_item(item)
+                prepared = None
+            await image_queue.put((item['uid'], prepared))
+        await image_queue.put(self._DONE)
+    
+    async def image_stage(self, image_queue, deliver_queue):
+        while True:
+            item = await image_queue.get()
+            if item is self._DONE:
+                break
+            email_id, prepared = item
+            if prepared is not None and prepared[1] and self.bot.image_max_dimension:
+                msg, images, files = prepared[:3]
+                try:
+                    start = time.perf_counter()
+                    with log_context(uid=email_id):
+                        photos, documents = await self.prepare_images(images)
+                    self.bot.metrics.observe('stage_seconds', time.perf_counter() - start, stage='image')
+                    prepared = (msg, photos, files + documents) + prepared[3:]
+                except asyncio.CancelledError:
+                    self.release_item(item)
+                    raise
+                except Exception as e:
+                    self.bot.metrics.inc('errors_total', stage='image')
+                    # Не получилось - отправляем изображения как есть
+                    log.error(f"✗ Ошибка обработки изображений письма {email_id}: {e}")
+            await deliver_queue.put((email_id, prepared))
+        await deliver_queue.put(self._DONE)
+    
+    async def prepare_images(self, images):
+        """Уменьшает и пережимает изображения письма параллельно в пуле процессов.
+        
+        Задание держит данные изображения в памяти целиком, поэтому в работе
+        не больше image_workers заданий и их байты резервируются в MemoryBudget.
+        Изображения, чей file_id фото уже в кэше, в пул не отправляются.
+        """
+        loop = asyncio.get_running_loop()
+        bot = self.bot
+        if self.image_executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.image_executor = ProcessPoolExecutor(max_workers=bot.image_workers)
+        if self.image_slots is None:
+            self.image_slots = asyncio.Semaphore(bot.image_workers)
+        
+        async def prepare(image):
+            if bot.cached_photo(image):
+                return None
+            size = image['spool'].size
+            async with self.image_slots:
+                await loop.run_in_executor(self.io_executor, bot.memory_budget.acquire, size)
+                try:
+                    # Спул может лежать на диске - читаем его в пуле потоков
+                    job = await loop.run_in_executor(self.io_executor, bot.image_job, image)
+                    return await loop.run_in_executor(self.image_executor, prepare_image, *job)
+                finally:
+                    bot.memory_budget.release(size)
+        
+        results = await asyncio.gather(*(prepare(image) for image in images), return_exceptions=True)
+        return bot.apply_image_results(images, results)
+    
+    async def deliver_stage(self, deliver_queue, result, digest=False):
+        bot = self.bot
+        # Письма, копящиеся для дайджеста
+        batch = []
+        # Очередь и задача отправки на каждый чат: разные чаты - параллельно, в чате - по порядку
+        lanes = {}
+        try:
+            while True:
+                item = await deliver_queue.get()
+                if item is self._DONE:
+                    break
+                email_id, prepared = item
+                if prepared is None:
+                    result['failed'].append(email_id)
                     continue
                 
-                if not msg_data or not msg_data[0]:
-                    print(f"✗ Пустые данные письма {email_id_str}")
+                if digest:
+                    batch.append(item)
+                    if len(batch) >= bot.digest_max_items:
+                        batch, full_batch = [], batch
+                        await self.deliver_digest(full_batch, result)
                     continue
                 
-                msg = email.message_from_bytes(msg_data[0][1])
-                from_header = msg.get('From', 'Неизвестный отправитель')
-                subject_header = msg.get('Subject', 'Без темы')
-                print(f"Письмо от: {from_header}")
-                print(f"Тема: {subject_header}")
-                
-                # Извлекаем вложения
-                images, files = self.extract_attachments(msg)
-                
-                if images:
-                    print(f" - Найдено изображений: {len(images)}")
-                if files:
-                    print(f" - Найдено файлов: {len(files)}")
-                
-                email_message = self.format_email_message(msg, files)
-                
-                # Отправка в Telegram
-                if self.send_to_telegram(email_message, images, files, email_id_str):
-                    # Помечаем письмо как прочитанное только если отправка успешна
-                    self.mark_as_read(email_id)
-                    self.processed_emails.add(email_id_str)
-                    print("✓ Письмо успешно обработано и помечено как прочитанное")
-                else:
-                    print("✗ Не удалось отправить письмо в Telegram, оставляем непрочитанным")
-                
-                # Пауза между отправками
-                print("Пауза 3 секунды перед следующим письмом...")
-                time.sleep(3)
+                chat_id = bot.chat_for(email_id)
+                if chat_id not in lanes:
+                    lane_queue = asyncio.Queue(self.QUEUE_SIZE)
+                    lanes[chat_id] = (lane_queue, asyncio.create_task(self.deliver_lane(lane_queue, result)))
+                lane_queue, lane_task = lanes[chat_id]
+                if lane_task.done():
+                    # Задача чата упала - не ждем места в ее очереди вечно
+                    lane_task.result()
+                await lane_queue.put(item)
             
-            mail_connection.close()
-            mail_connection.logout()
-            return True
+            for lane_queue, _ in lanes.values():
+                await lane_queue.put(self._DONE)
+            await asyncio.gather(*(lane_task for _, lane_task in lanes.values()))
             
-        except Exception as e:
-            print(f"✗ Ошибка обработки писем: {e}")
-            if mail_connection:
-                try:
-                    mail_connection.close()
-                    mail_connection.logout()
-                except:
-                    pass
+            if batch:
+                batch, full_batch = [], batch
+                await self.deliver_digest(full_batch, result)
+        except BaseException:
+            for item in batch:
+                self.release_item(item)
+            for lane_queue, lane_task in lanes.values():
+                lane_task.cancel()
+            await asyncio.gather(*(lane_task for _, lane_task in lanes.values()), return_exceptions=True)
+            for lane_queue, _ in lanes.values():
+                while not lane_queue.empty():
+                    self.release_item(lane_queue.get_nowait())
+            raise
+    
+    async def deliver_lane(self, lane_queue, result):
+        """Отправляет письма одного чата по очереди"""
+        while True:
+            item = await lane_queue.get()
+            if item is self._DONE:
+                return
+            await self.deliver_message(item, result)
+    
+    async def deliver_message(self, item, result):
+        bot = self.bot
+        email_id, prepared = item
+        _, images, files, email_message, _ = prepared
+        start = time.perf_counter()
+        with log_context(uid=email_id):
+            try:
+                # Отправка в Telegram
+                sent = await self.run_requests(
+                    bot.send_to_telegram(email_message, images, files, str(email_id))
+                )
+            finally:
+                bot.release_attachments(images, files)
+            
+            duration = round(time.perf_counter() - start, 3)
+            if sent:
+                self.mark_delivered(email_id, prepared[0], result)
+                log.info("✓ Письмо успешно обработано", extra={'duration': duration})
+            else:
+                log.warning("✗ Не удалось отправить письмо в Telegram, оставляем непрочитанным",
+                            extra={'duration': duration})
+                result['failed'].append(email_id)
+        
+        if bot.rate_limiter.queue_depth:
+            log.debug(f"Запросов в очереди ограничителя Telegram: {bot.rate_limiter.queue_depth}")
+    
+    def skip_message(self, item, result):
+        """Письмо, отфильтрованное правилом: не пересылается, при mark_read - помечается прочитанным"""
+        bot = self.bot
+        if item['action'] == 'mark_read':
+            result['mark_read'].append(item['uid'])
+            bot.metrics.inc('mails_total', mailbox=bot.mailbox_key, status='marked_read')
+        else:
+            bot.metrics.inc('mails_total', mailbox=bot.mailbox_key, status='dropped')
+    
+    def mark_delivered(self, email_id, msg, result):
+        # Помечаем письмо как прочитанное только если отправка успешна
+        bot = self.bot
+        result['delivered'].append(email_id)
+        bot.delivered_uids.add(email_id)
+        bot.journal.record(email_id, DeliveryJournal.DONE)
+        bot.metrics.inc('mails_total', mailbox=bot.mailbox_key, status='delivered')
+        bot.record_delivery_delay(msg)
+    
+    async def deliver_digest(self, batch, result):
+        bot = self.bot
+        try:
+            delivered = await self.run_requests(bot.send_digest(batch))
+        finally:
+            for item in batch:
+                self.release_item(item)
+        
+        for email_id, prepared in batch:
+            if email_id in delivered:
+                self.mark_delivered(email_id, prepared[0], result)
+            else:
+                result['failed'].append(email_id)
+        log.info(f"✓ Дайджест: доставлено {len(delivered)} из {len(batch)} писем")
+    
+    async def wait_readable(self, sock, timeout):
+        """Ожидает данных на сокете, не занимая поток"""
+        loop = asyncio.get_running_loop()
+        try:
+            ready = loop.create_future()
+            loop.add_reader(sock.fileno(), lambda: ready.done() or ready.set_result(True))
+        except NotImplementedError:
+            # Proactor-цикл Windows не умеет add_reader - короткие select в пуле
+            readable, _, _ = await loop.run_in_executor(
+                self.io_executor, select.select, [sock], [], [], min(timeout, 1.0)
+            )
+            return bool(readable)
+        try:
+            return await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
             return False
+        finally:
+            loop.remove_reader(sock.fileno())
     
-    def start_monitoring(self, interval=60):
-        """Запуск мониторинга почты"""
-        print(f"🚀 Запуск мониторинга почты")
-        print(f"📧 Email: {self.email_config['email']}")
-        print(f"⏱  Интервал проверки: {interval} секунд")
-        print(f"💬 Telegram чат: {self.telegram_config['chat_id']}")
-        print(f"📁 Папка для вложений: {self.attachments_dir}")
-        print("-" * 50)
-        
-        def monitor():
+    async def idle(self):
+        """IDLE: True, если сервер сообщил о новых письмах, False - по таймауту"""
+        session = self.session
+        if not await self.imap(session.idle_start):
+            return True
+        
+        deadline = time.monotonic() + session.IDLE_REARM_SECONDS
+        new_mail = False
+        while not new_mail:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not session.has_buffered_data():
+                if not await self.wait_readable(session.mail.socket(), remaining):
+                    continue
+            new_mail = await self.imap(session.idle_read_response)
+        
+        return await self.imap(session.idle_done) or new_mail
+    
+    async def wait_for_new_mail(self, interval):
+        """Ожидание новых писем: IDLE, если сервер умеет, иначе адаптивный опрос"""
+        bot = self.bot
+        if self.session.supports_idle():
+            try:
+                log.debug("Ожидание новых писем (IDLE)...")
+                if await self.idle():
+                    log.info("✓ Сервер сообщил о новых письмах")
+                    if bot.digest_active() and bot.digest_window:
+                        # Поток писем - копим их, чтобы отправить одним дайджестом
+                        log.info(f"Режим дайджеста: собираем письма {bot.digest_window} сек")
+                        await asyncio.sleep(bot.digest_window)
+                return
+            except (imaplib.IMAP4.error, OSError) as e:
+                log.warning(f"✗ Соединение IDLE прервано: {e}")
+                await self.imap(bot.drop_connection)
+                return
+        
+        if bot.mail is None:
+            # Нет соединения - паузу выдержит connect перед следующей попыткой
+            return
+        
+        # Письма пошли - проверяем чаще, тишина - реже, но не реже interval
+        if bot.last_found_count:
+            bot.poll_interval = bot.MIN_POLL_INTERVAL
+        else:
+            bot.poll_interval = min(interval, bot.poll_interval * 2)
+        log.info(f"IDLE недоступен, следующая проверка через {bot.poll_interval} сек")
+        await asyncio.sleep(bot.poll_interval)
+    
+    async def run_once(self):
+        """Один проход; соединение остается открытым для следующего вызова"""
+        try:
+            return await self.run_pass()
+        finally:
+            self.close_executors()
+    
+    async def run(self, interval):
+        """Бесконечный цикл проходов до отмены (Ctrl+C)"""
+        try:
             while True:
                 try:
-                    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Проверка почты...")
-                    self.process_new_emails()
-                    time.sleep(interval)
+                    log.info("Проверка почты...")
+                    await self.run_pass()
+                    await self.wait_for_new_mail(interval)
+                except asyncio.CancelledError:
+                    raise
                 except Exception as e:
-                    print(f"Ошибка в мониторинге: {e}")
-                    time.sleep(interval)
+                    log.error(f"Ошибка в мониторинге: {e}")
+                    await self.imap(self.bot.drop_connection)
+                    await asyncio.sleep(interval)
+        finally:
+            await self.shutdown()
+    
+    async def shutdown(self):
+        """Корректное завершение: закрытие соединения и пулов потоков"""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.io_executor, self.bot.drop_connection)
+        except Exception:
+            pass
+        if self.bot.archive is not None:
+            # Вложения, переданные архиву, дописываются до выхода
+            await loop.run_in_executor(self.io_executor, self.bot.archive.flush)
+        for cache in self.bot.caches():
+            cache.save()
+        self.bot.journal.flush()
+        self.close_executors()
+    
+    def close_executors(self):
+        if self._owns_executors:
+            self.io_executor.shutdown(wait=False, cancel_futures=True)
+            self.cpu_executor.shutdown(wait=False, cancel_futures=True)
+        if self._owns_image_executor and self.image_executor is not None:
+            # Без ожидания процессов пул падает в atexit на закрытом канале
+            self.image_executor.shutdown(wait=True, cancel_futures=True)
+            self.image_executor = None
+
+class MailSupervisor:
+    """Пересылка нескольких ящиков и папок в одном процессе.
+    
+    Конфигурация (TOML, YAML или JSON) описывает аккаунты, их папки и чаты.
+    Каждая папка - свое IMAP-соединение и свой конвейер, но все они
+    работают на одном цикле событий: ожидание IDLE не занимает потоков,
+    блокирующие команды выполняются в общих пулах. Бот Telegram,
+    ограничитель запросов, бюджет памяти и кэш текста - общие.
+    Ошибки одной папки не останавливают остальные.
+    """
+    
+    # Разброс старта, чтобы все ящики не подключались одновременно
+    START_SPREAD_SECONDS = 5
+    # Коды выхода --once
+    EXIT_OK = 0
+    EXIT_UNDELIVERED = 1
+    EXIT_PASS_FAILED = 2
+    EXIT_CONFIG_ERROR = 3
+    # Переменные окружения для одного ящика без файла конфигурации
+    ENV_PREFIX = "MAIL2TG_"
+    
+    def __init__(self, config):
+        self.config = config
+        self.settings = config.get('settings', {})
+        self.shared = {}
+        self.bots = []
+    
+    @staticmethod
+    def load_config(path):
+        """Читает конфигурацию: .toml, .yaml/.yml (нужен PyYAML) или .json"""
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.toml':
+            import tomllib
+            with open(path, 'rb') as f:
+                return tomllib.load(f)
+        if extension in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("для YAML-конфигурации установите PyYAML (pip install pyyaml)")
+            with open(path, 'r', encoding='utf-8') as f:
+                return yaml.safe_load(f) or {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    @classmethod
+    def from_file(cls, path):
+        return cls(cls.load_config(path))
+    
+    @classmethod
+    def from_env(cls, environ=None):
+        """Один ящик из MAIL2TG_EMAIL, MAIL2TG_PASSWORD, MAIL2TG_BOT_TOKEN, MAIL2TG_CHAT_ID.
+        
+        Необязательные: MAIL2TG_FOLDERS (через запятую), MAIL2TG_IMAP_HOST,
+        MAIL2TG_INTERVAL, MAIL2TG_STATE_FILE, MAIL2TG_JOURNAL_FILE.
+        None, если MAIL2TG_EMAIL не задан.
+        """
+        environ = os.environ if environ is None else environ
+        
+        def env(name, default=None):
+            return environ.get(cls.ENV_PREFIX + name) or default
         
-        monitor_thread = threading.Thread(target=monitor)
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        if not env('EMAIL'):
+            return None
+        missing = [name for name in ('PASSWORD', 'BOT_TOKEN', 'CHAT_ID') if not env(name)]
+        if missing:
+            raise RuntimeError(f"не заданы переменные окружения: {', '.join(cls.ENV_PREFIX + name for name in missing)}")
+        settings = {}
+        for name, key in (('IMAP_HOST', 'imap_host'), ('STATE_FILE', 'state_file'), ('JOURNAL_FILE', 'journal_file')):
+            if env(name):
+                settings[key] = env(name)
+        if env('INTERVAL'):
+            settings['interval'] = int(env('INTERVAL'))
+        folders = [folder.strip() for folder in env('FOLDERS', "INBOX").split(',') if folder.strip()]
+        return cls({
+            'settings': settings,
+            'telegram': {'bot_token': env('BOT_TOKEN'), 'chat_id': env('CHAT_ID')},
+            'accounts': [{'email': env('EMAIL'), 'password': env('PASSWORD'), 'folders': folders}],
+        })
+    
+    def iter_workers(self):
+        """Пары (email_config, telegram_config) для каждой папки каждого аккаунта.
         
-        print("Мониторинг запущен. Для остановки нажмите Ctrl+C\n")
+        Настройки email_config наследуются: settings -> аккаунт -> папка;
+        chat_id папки перекрывает chat_id аккаунта и [telegram];
+        остальные ключи [telegram] (api_url, rate_limits) передаются как есть.
+        """
+        telegram = self.config.get('telegram', {})
+        defaults = {key: value for key, value in self.settings.items() if key != 'interval'}
+        # Общие [[rules]] - для всех папок; rules аккаунта или папки их заменяют
+        if self.config.get('rules'):
+            defaults.setdefault('rules', self.config['rules'])
+        for account in self.config.get('accounts', []):
+            account_config = dict(defaults)
+            account_config.update({key: value for key, value in account.items() if key != 'folders'})
+            for folder in account.get('folders') or ["INBOX"]:
+                if isinstance(folder, str):
+                    folder = {'mailbox': folder}
+                email_config = dict(account_config)
+                email_config.update(folder)
+                chat_id = email_config.pop('chat_id', None) or telegram.get('chat_id')
+                bot_token = email_config.pop('bot_token', None) or telegram.get('bot_token')
+                telegram_config = dict(telegram)
+                telegram_config.update({'bot_token': bot_token, 'chat_id': chat_id})
+                yield email_config, telegram_config
+    
+    def build_bots(self):
+        """Создает ботов; папка с ошибкой в настройках пропускается"""
+        self.bots = []
+        for email_config, telegram_config in self.iter_workers():
+            name = f"{email_config.get('email')}/{email_config.get('mailbox', 'INBOX')}"
+            try:
+                if not telegram_config['bot_token'] or not telegram_config['chat_id']:
+                    raise ValueError("не указаны bot_token или chat_id")
+                self.bots.append(YandexMailToTelegramBot(email_config, telegram_config, self.shared))
+                log.info(f"✓ {name} -> чат {telegram_config['chat_id']}")
+            except Exception as e:
+                log.error(f"✗ {name}: {e}, папка пропущена")
+        return self.bots
+    
+    async def run_worker(self, pipeline, delay, interval):
+        await asyncio.sleep(delay)
+        try:
+            await pipeline.run(interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # pipeline.run сам переживает ошибки проходов - сюда попадает только непредвиденное
+            name = f"{pipeline.bot.email_config['email']}/{pipeline.session.mailbox}"
+            log.error(f"✗ Обработчик {name} остановлен: {e}")
+    
+    def create_executors(self, bot_count):
+        """Общие пулы потоков: команды IMAP и Bot API, разбор писем"""
+        # Поток пула занят только на время одной команды IMAP или запроса Bot API
+        io_executor = ThreadPoolExecutor(
+            max_workers=self.settings.get('io_workers', min(32, 4 + 2 * bot_count)),
+            thread_name_prefix="mail-io"
+        )
+        cpu_executor = ThreadPoolExecutor(
+            max_workers=self.settings.get('parse_workers', 2), thread_name_prefix="mail-parse"
+        )
+        return io_executor, cpu_executor
+    
+    async def run(self, interval):
+        """Запускает конвейеры всех папок на общем цикле событий и общих пулах"""
+        bots = self.bots or self.build_bots()
+        if not bots:
+            log.error("✗ В конфигурации нет ни одной рабочей папки")
+            return
+        bots[0].start_metrics_server()
         
+        from concurrent.futures import ProcessPoolExecutor
+        io_executor, cpu_executor = self.create_executors(len(bots))
+        image_executor = ProcessPoolExecutor(max_workers=self.settings.get('image_workers', 2))
+        spread = min(self.START_SPREAD_SECONDS, 0.2 * len(bots))
+        workers = [
+            asyncio.create_task(self.run_worker(
+                MailPipeline(bot, io_executor, cpu_executor, image_executor),
+                random.uniform(0, spread), interval
+            ))
+            for bot in bots
+        ]
         try:
-            while True:
-                time.sleep(1)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            io_executor.shutdown(wait=False, cancel_futures=True)
+            cpu_executor.shutdown(wait=False, cancel_futures=True)
+            # Без ожидания процессов пул падает в atexit на закрытом канале
+            image_executor.shutdown(wait=True, cancel_futures=True)
+    
+    async def run_once(self):
+        """Один проход по всем папкам (cron, systemd timer); возвращает код выхода"""
+        bots = self.bots or self.build_bots()
+        if not bots:
+            log.error("✗ В конфигурации нет ни одной рабочей папки")
+            return self.EXIT_CONFIG_ERROR
+        
+        io_executor, cpu_executor = self.create_executors(len(bots))
+        # Пул процессов для изображений каждый конвейер создаст сам, если попадутся картинки
+        pipelines = [MailPipeline(bot, io_executor, cpu_executor) for bot in bots]
+        try:
+            results = await asyncio.gather(
+                *(pipeline.run_pass() for pipeline in pipelines), return_exceptions=True
+            )
+        finally:
+            for pipeline in pipelines:
+                await pipeline.shutdown()
+            io_executor.shutdown(wait=False, cancel_futures=True)
+            cpu_executor.shutdown(wait=False, cancel_futures=True)
+        
+        if any(result is not True for result in results):
+            return self.EXIT_PASS_FAILED
+        if any(bot.last_failed_count for bot in bots):
+            return self.EXIT_UNDELIVERED
+        return self.EXIT_OK
+    
+    def start(self, once=False):
+        if once:
+            try:
+                return asyncio.run(self.run_once())
+            except KeyboardInterrupt:
+                log.info("Проход прерван")
+                return self.EXIT_PASS_FAILED
+        interval = self.settings.get('interval', 60)
+        log.info(f"🚀 Запуск мониторинга {len(self.build_bots())} папок")
+        log.info("Мониторинг запущен. Для остановки нажмите Ctrl+C")
+        try:
+            asyncio.run(self.run(interval))
         except KeyboardInterrupt:
-            print("\n\nМониторинг остановлен пользователем")
+            log.info("Мониторинг остановлен пользователем")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Пересылка писем из Яндекс.Почты в Telegram",
+        epilog="Без файла конфигурации используются переменные окружения MAIL2TG_* "
+               "(см. MailSupervisor.from_env) или config.toml в текущем каталоге. "
+               "Коды выхода --once: 0 - успешно, 1 - часть писем не доставлена, "
+               "2 - ошибка прохода (почта недоступна), 3 - ошибка конфигурации."
+    )
+    parser.add_argument('config', nargs='?', help="файл конфигурации (.toml, .yaml, .json)")
+    parser.add_argument('--once', action='store_true', help="один проход и выход (cron, systemd timer)")
+    parser.add_argument('--log-level', type=str.upper, choices=LOG_LEVELS,
+                        default=os.environ.get(MailSupervisor.ENV_PREFIX + "LOG_LEVEL", 'INFO').upper(),
+                        help="DEBUG показывает каждое вложение и длительность этапов (по умолчанию INFO)")
+    parser.add_argument('--log-format', choices=LOG_FORMATS,
+                        default=os.environ.get(MailSupervisor.ENV_PREFIX + "LOG_FORMAT", 'text'),
+                        help="json - одна строка на запись с полями mailbox, uid, stage, duration")
+    parser.add_argument('--log-file', default=os.environ.get(MailSupervisor.ENV_PREFIX + "LOG_FILE"),
+                        help="дополнительно писать лог в файл (переоткрывается после logrotate)")
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        # Ошибка в аргументах - ошибка конфигурации, а не код 2 argparse (ошибка прохода)
+        return e.code if not e.code else MailSupervisor.EXIT_CONFIG_ERROR
+    
+    # Значения по умолчанию из окружения argparse не проверяет
+    for name, value, allowed in (('LOG_LEVEL', args.log_level, LOG_LEVELS), ('LOG_FORMAT', args.log_format, LOG_FORMATS)):
+        if value not in allowed:
+            print(f"❌ Ошибка конфигурации: {MailSupervisor.ENV_PREFIX}{name}={value!r}, "
+                  f"допустимо: {', '.join(allowed)}", file=sys.stderr)
+            return MailSupervisor.EXIT_CONFIG_ERROR
+    try:
+        listener = setup_logging(args.log_level, args.log_format, args.log_file)
+    except OSError as e:
+        print(f"❌ Ошибка конфигурации: не удалось открыть файл лога: {e}", file=sys.stderr)
+        return MailSupervisor.EXIT_CONFIG_ERROR
+    try:
+        return run(args)
+    finally:
+        listener.stop()
 
-def main():
-    print("Yandex Mail to Telegram Bot")
-    print("=" * 30)
+def run(args):
+    """Проверка зависимостей, загрузка конфигурации и запуск (логирование уже настроено)"""
+    log.info("Yandex Mail to Telegram Bot")
     
     # Проверка зависимостей
     if not check_dependencies():
-        print("Пожалуйста, установите зависимости и запустите снова")
-        return
+        log.error("Пожалуйста, установите зависимости и запустите снова")
+        return MailSupervisor.EXIT_CONFIG_ERROR
     
-    # Конфигурация - ЗАМЕНИТЕ НА СВОИ ДАННЫЕ!
-    email_config = {
-        'email': 'почта@yandex.ru',  # ЗАМЕНИТЕ
-        'password': 'пароль почты'    # ЗАМЕНИТЕ (пароль приложения)
-    }
+    # Файл из аргумента или MAIL2TG_CONFIG, затем переменные окружения, затем ./config.toml
+    try:
+        config_path = args.config or os.environ.get(MailSupervisor.ENV_PREFIX + "CONFIG")
+        if config_path:
+            supervisor = MailSupervisor.from_file(config_path)
+        else:
+            supervisor = MailSupervisor.from_env()
+            if supervisor is None and os.path.exists("config.toml"):
+                supervisor = MailSupervisor.from_file("config.toml")
+    except Exception as e:
+        log.error(f"❌ Ошибка конфигурации: {e}")
+        return MailSupervisor.EXIT_CONFIG_ERROR
     
-    telegram_config = {
-        'bot_token': 'бот токен',     # ЗАМЕНИТЕ
-        'chat_id': 'ваш чат ID '          # ЗАМЕНИТЕ
-    }
+    if supervisor is None:
+        log.error("❌ ОШИБКА: Не настроена конфигурация!")
+        log.info("Скопируйте config.example.toml в config.toml и впишите свои данные")
+        log.info("или задайте переменные окружения:")
+        log.info("- MAIL2TG_EMAIL и MAIL2TG_PASSWORD (пароль приложения)")
+        log.info("- MAIL2TG_BOT_TOKEN (токен Telegram бота)")
+        log.info("- MAIL2TG_CHAT_ID (ID Telegram чата)")
+        return MailSupervisor.EXIT_CONFIG_ERROR
     
-    # Проверка заполнения конфигурации
-    if (email_config['email'] == 'your_email@yandex.ru' or 
-        telegram_config['bot_token'] == 'your_bot_token'):
-        print("\n❌ ОШИБКА: Не настроена конфигурация!")
-        print("Пожалуйста, откройте файл yandex_mail_bot.py")
-        print("и замените значения в секции конфигурации на свои данные:")
-        print("- Яндекс email и пароль приложения")
-        print("- Токен Telegram бота")
-        print("- ID Telegram чата")
-        input("Нажмите Enter для выхода...")
-        return
-    
-    # Создание и запуск бота
+    # systemd останавливает службу сигналом SIGTERM - завершаемся так же, как по Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
-        mail_bot = YandexMailToTelegramBot(email_config, telegram_config)
-        mail_bot.start_monitoring(interval=60)  # Проверка каждые 60 секунд
+        return supervisor.start(once=args.once)
     except Exception as e:
-        print(f"❌ Критическая ошибка: {e}")
-        input("Нажмите Enter для выхода...")
+        log.exception(f"❌ Критическая ошибка: {e}")
+        return MailSupervisor.EXIT_PASS_FAILED if args.once else MailSupervisor.EXIT_CONFIG_ERROR
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())